@@ -0,0 +1,286 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from utility.logger import get_logger, start_request
+
+logger = get_logger("async_server")
+
+# thread dell'executor che eseguono gli handler (lavoro bloccante su SQLite e bcrypt)
+ASYNC_EXECUTOR_WORKERS = int(os.environ.get("ASYNC_EXECUTOR_WORKERS", "16"))
+# secondi di inattivita' dopo cui una connessione keep-alive viene chiusa
+ASYNC_KEEPALIVE_TIMEOUT = float(os.environ.get("ASYNC_KEEPALIVE_TIMEOUT", "75"))
+# dimensione massima (byte) della riga di richiesta piu' gli header
+ASYNC_MAX_HEADER_SIZE = int(os.environ.get("ASYNC_MAX_HEADER_SIZE", "65536"))
+# dimensione massima (byte) del corpo di una richiesta
+ASYNC_MAX_BODY_SIZE = int(os.environ.get("ASYNC_MAX_BODY_SIZE", str(10 * 1024 * 1024)))
+
+
+class BadRequest(Exception):
+    """Richiesta HTTP non valida: chiude la connessione con il codice indicato."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class StreamWriterBridge:
+    """
+    Oggetto file-like usato come wfile dagli handler.
+    Le scritture avvengono in un thread dell'executor e vengono inoltrate allo
+    StreamWriter dell'event loop, attendendo il drain per rispettare il backpressure.
+    """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data):
+        if not data:
+            return 0
+        data = bytes(data)
+        asyncio.run_coroutine_threadsafe(self._write(data), self._loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class AsyncHandlerAdapter:
+    """
+    Mixin che permette di eseguire un BaseHTTPRequestHandler (es. MyHandler) su una
+    richiesta gia' letta dall'event loop: espone headers, rfile, wfile e path come
+    l'handler originale senza possedere il socket della connessione.
+    """
+
+    def __init__(self, server, client_address, command, path, request_version, headers, body, wfile):
+        # non chiama BaseHTTPRequestHandler.__init__: la connessione e' gestita da AsyncHTTPServer
+        self.server = server
+        self.client_address = client_address
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.requestline = f"{command} {path} {request_version}"
+        self.headers = headers
+        self.rfile = io.BytesIO(body)
+        self.wfile = wfile
+        self.close_connection = _wants_close(request_version, headers)
+
+    def dispatch(self):
+        """Invoca il metodo do_<METODO> dell'handler."""
+        start_request(self.headers)
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED, f"Unsupported method ({self.command!r})")
+            return
+        method()
+
+
+def _wants_close(request_version, headers):
+    """Determina se la connessione va chiusa dopo la risposta (regole HTTP/1.0 e 1.1)."""
+    connection = headers.get("Connection", "").lower()
+    if request_version == "HTTP/1.1":
+        return connection == "close"
+    return connection != "keep-alive"
+
+
+class AsyncHTTPServer:
+    """
+    Server HTTP/1.1 basato su asyncio streams.
+    Le connessioni inattive restano sull'event loop senza occupare thread;
+    gli handler, bloccanti, vengono eseguiti in un ThreadPoolExecutor.
+    Espone la stessa interfaccia di HTTPServer usata da run_server
+    (serve_forever, shutdown, server_close).
+    """
+
+    def __init__(self, server_address, handler_class, executor_workers=ASYNC_EXECUTOR_WORKERS):
+        self.server_address = server_address
+        self.adapter_class = type(
+            "Async" + handler_class.__name__, (AsyncHandlerAdapter, handler_class), {})
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_workers, thread_name_prefix="async-handler")
+        self.executor_workers = executor_workers
+        self._loop = None
+        self._stopped = None
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._active_requests = 0
+        self._requests = 0
+        self._errors = 0
+
+    def serve_forever(self):
+        """Avvia l'event loop nel thread corrente fino a shutdown() o Ctrl + C."""
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self._handle_connection, host, port, limit=ASYNC_MAX_HEADER_SIZE)
+        async with server:
+            await self._stopped.wait()
+
+    def shutdown(self):
+        """Ferma l'event loop (chiamabile da un altro thread)."""
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def server_close(self):
+        """Attende la fine degli handler in esecuzione."""
+        self.executor.shutdown(wait=True)
+
+    async def _handle_connection(self, reader, writer):
+        """Gestisce una connessione: legge le richieste in sequenza (keep-alive)."""
+        client_address = writer.get_extra_info("peername")
+        wfile = StreamWriterBridge(self._loop, writer)
+        with self._lock:
+            self._connections += 1
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader, writer)
+                except BadRequest as e:
+                    with self._lock:
+                        self._errors += 1
+                    await self._send_error(writer, e.code, e.message)
+                    break
+                if request is None:
+                    break
+
+                adapter = self.adapter_class(self, client_address, *request, wfile)
+                with self._lock:
+                    self._active_requests += 1
+                try:
+                    await self._loop.run_in_executor(self.executor, adapter.dispatch)
+                except ConnectionError:
+                    break
+                except Exception:
+                    # come HTTPServer.handle_error: registra l'errore e chiude la connessione
+                    logger.exception("Errore durante la gestione della richiesta da %s", client_address)
+                    break
+                finally:
+                    with self._lock:
+                        self._active_requests -= 1
+                        self._requests += 1
+                if adapter.close_connection:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            with self._lock:
+                self._connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    async def _read_request(self, reader, writer):
+        """
+        Legge riga di richiesta, header e corpo.
+        Ritorna (command, path, version, headers, body) oppure None se il client ha chiuso.
+        """
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), timeout=ASYNC_KEEPALIVE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise BadRequest(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Header troppo grandi")
+
+        request_line, _, header_block = head.partition(b"\r\n")
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise BadRequest(HTTPStatus.BAD_REQUEST, "Riga di richiesta non valida")
+        command, path, version = parts
+        if version not in ("HTTP/1.0", "HTTP/1.1"):
+            raise BadRequest(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED, "Versione HTTP non supportata")
+        try:
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+        except http.client.HTTPException:
+            raise BadRequest(HTTPStatus.BAD_REQUEST, "Header non validi")
+
+        if headers.get("Expect", "").lower() == "100-continue":
+            writer.write(f"{version} 100 Continue\r\n\r\n".encode("latin-1"))
+            await writer.drain()
+
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = await self._read_chunked_body(reader)
+            # l'handler legge il corpo tramite Content-Length
+            del headers["Transfer-Encoding"]
+            headers["Content-Length"] = str(len(body))
+        else:
+            try:
+                content_length = int(headers.get("Content-Length", 0))
+            except ValueError:
+                raise BadRequest(HTTPStatus.BAD_REQUEST, "Content-Length non valido")
+            if content_length < 0:
+                raise BadRequest(HTTPStatus.BAD_REQUEST, "Content-Length non valido")
+            if content_length > ASYNC_MAX_BODY_SIZE:
+                raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Corpo della richiesta troppo grande")
+            try:
+                body = await reader.readexactly(content_length)
+            except asyncio.IncompleteReadError:
+                return None
+        return command, path, version, headers, body
+
+    async def _read_chunked_body(self, reader):
+        """Decodifica un corpo inviato con Transfer-Encoding: chunked."""
+        chunks = []
+        total = 0
+        try:
+            while True:
+                size_line = await reader.readuntil(b"\r\n")
+                try:
+                    size = int(size_line.split(b";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise BadRequest(HTTPStatus.BAD_REQUEST, "Chunk non valido")
+                if size == 0:
+                    # salta eventuali trailer fino alla riga vuota
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    return b"".join(chunks)
+                total += size
+                if total > ASYNC_MAX_BODY_SIZE:
+                    raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Corpo della richiesta troppo grande")
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise BadRequest(HTTPStatus.BAD_REQUEST, "Corpo chunked incompleto")
+
+    async def _send_error(self, writer, code, message):
+        """Invia una risposta di errore JSON direttamente dall'event loop."""
+        body = json.dumps({"error": message}).encode("utf-8")
+        status = HTTPStatus(code)
+        writer.write((
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1") + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def stats(self):
+        """Ritorna connessioni aperte e richieste servite dall'event loop."""
+        with self._lock:
+            return {
+                "engine": "asyncio",
+                "open_connections": self._connections,
+                "active_requests": self._active_requests,
+                "executor_workers": self.executor_workers,
+                "requests": self._requests,
+                "bad_requests": self._errors,
+            }
@@ -1,76 +1,280 @@
+import csv
+import io
 import json
 from db import get_connection
 from utility.utility import (
-    set_headers
+    cache_validator_headers,
+    set_headers,
+    parse_query,
+    send_json_rows,
+    send_not_modified,
+    send_stream_rows
+)
+from utility.pagination import (
+    QueryError,
+    decode_cursor,
+    keyset_batches,
+    keyset_condition,
+    order_clause,
+    pagination_headers,
+    parse_date,
+    parse_int,
+    parse_limit,
+    parse_sort,
+    split_page,
 )
 from utility.booking_utility import (
-    get_service_capacity,
-    check_availability,
-    save_booking,
+    BOOKING_BATCH_MAX_SIZE,
+    ReservationError,
+    create_reservation,
+    create_reservations,
+    delete_reservation,
+    update_reservation,
     validate_booking_data,
 )
+from utility.query_cache import query_cache
+from utility.versions import is_not_modified, record_write, row_etag
+
+# campi ordinabili di GET /bookings -> colonna SQL
+BOOKING_SORT_FIELDS = {
+    "id": "b.id",
+    "start_date": "b.start_date",
+    "end_date": "b.end_date",
+    "status": "b.status",
+}
 
 def handle_get_all_bookings(handler, authenticated_user):
     """
     GET /bookings - Ritorna tutte le prenotazioni per admin o solo quelle
     dell'utente corrente se non è un admin.
+    Parametri di query opzionali:
+    - limit, cursor: paginazione keyset; il cursore della pagina successiva
+      è restituito nell'header X-Next-Cursor
+    - sort: id, start_date, end_date, status (prefisso "-" per l'ordine decrescente)
+    - status, service_id, user_id (solo admin): filtri
+    - from, to: prenotazioni che si sovrappongono al periodo indicato (YYYY-MM-DD)
     """
 
     user_id = authenticated_user["id"]
     role = authenticated_user["role"]
 
-    with get_connection() as conn:
-        c = conn.cursor()
+    query = parse_query(handler.path)
+    try:
+        limit = parse_limit(query)
+        sort_field, sort_column, descending = parse_sort(query, BOOKING_SORT_FIELDS)
+        cursor = decode_cursor(query.get("cursor"))
+        service_id = parse_int(query, "service_id")
+        filter_user_id = parse_int(query, "user_id")
+        date_from = parse_date(query, "from")
+        date_to = parse_date(query, "to")
+    except QueryError as e:
+        _send_error(handler, 400, str(e))
+        return
 
-        if role == "admin":
-            # recupera tutte le prenotazioni presenti per tutti gli utenti se l'utente è un admin
-            c.execute("""
-                SELECT b.id, b.user_id, b.service_id, b.start_date, b.end_date, b.status, b.total_price,
-                    s.name AS service_name, s.description AS service_description,
-                    u.username AS user_name
-                FROM bookings b
-                JOIN services s ON b.service_id = s.id
-                JOIN users u ON b.user_id = u.id
-            """)
-        else:
-            # recupera solo le prenotazioni dell'utente corrente con ruolo user
-            c.execute("""
-                SELECT b.id, b.user_id, b.service_id, b.start_date, b.end_date, b.status, b.total_price,
-                    s.name AS service_name, s.description AS service_description
-                FROM bookings b
-                JOIN services s ON b.service_id = s.id
-                WHERE b.user_id = ?
-            """, (user_id,))
-
-        rows = c.fetchall()
-
-    results = []
-    for row in rows:
-        results.append({
-            "id": row["id"],
-            "user_id": row["user_id"],
-            "username": row["user_name"] if "user_name" in row.keys() else None,
-            "service_id": row["service_id"],
-            "service_name": row["service_name"],
-            "service_description": row["service_description"],
-            "start_date": row["start_date"],
-            "end_date": row["end_date"],
-            "status": row["status"],
-            "total_price": row["total_price"]
-        })
+    conditions = []
+    params = []
+    if role == "admin":
+        # recupera le prenotazioni di tutti gli utenti se l'utente è un admin
+        select = """
+            SELECT b.id, b.user_id, b.service_id, b.start_date, b.end_date, b.status, b.total_price,
+                s.name AS service_name, s.description AS service_description,
+                u.username AS user_name
+            FROM bookings b
+            JOIN services s ON b.service_id = s.id
+            JOIN users u ON b.user_id = u.id
+        """
+        if filter_user_id is not None:
+            conditions.append("b.user_id = ?")
+            params.append(filter_user_id)
+    else:
+        # recupera solo le prenotazioni dell'utente corrente con ruolo user
+        select = """
+            SELECT b.id, b.user_id, b.service_id, b.start_date, b.end_date, b.status, b.total_price,
+                s.name AS service_name, s.description AS service_description,
+                NULL AS user_name
+            FROM bookings b
+            JOIN services s ON b.service_id = s.id
+        """
+        conditions.append("b.user_id = ?")
+        params.append(user_id)
+
+    if query.get("status"):
+        conditions.append("b.status = ?")
+        params.append(query["status"])
+    if service_id is not None:
+        conditions.append("b.service_id = ?")
+        params.append(service_id)
+    if date_from:
+        conditions.append("b.end_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("b.start_date <= ?")
+        params.append(date_to)
+    if cursor:
+        condition, cursor_params = keyset_condition(sort_column, "b.id", descending, cursor)
+        conditions.append(condition)
+        params.extend(cursor_params)
+
+    if limit is None and role == "admin":
+        # lista completa delle prenotazioni di tutti gli utenti: le righe vengono
+        # lette a blocchi e inviate in streaming, senza passare dalla cache
+        batches = keyset_batches(select, conditions, params, sort_column, "b.id", descending,
+            lambda row: (row[sort_field], row["id"]))
+        send_json_rows(handler, batches, _serialize_booking, extra_headers=pagination_headers(None))
+        return
 
-    response_data = json.dumps(results).encode("utf-8")
-    set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
+    sql = select
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " " + order_clause(sort_column, "b.id", descending)
+    if limit is not None:
+        # una riga in piu' per sapere se esiste una pagina successiva
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    def build():
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(sql, params)
+            rows = c.fetchall() if limit is None else c.fetchmany(limit + 1)
+        next_cursor = None
+        if limit is not None:
+            rows, next_cursor = split_page(rows, limit, sort_field)
+        results = [_serialize_booking(row) for row in rows]
+        return json.dumps(results).encode("utf-8"), pagination_headers(next_cursor)
+
+    # liste del singolo utente e pagine: la risposta resta in cache fino alla
+    # prossima scrittura sulle tabelle lette dalla query
+    tables = ("bookings", "services", "users") if role == "admin" else ("bookings", "services")
+    response_data, headers = query_cache.cached(sql, params, tables, build)
+    set_headers(handler, 200, response_data, extra_headers=headers)
+
+def _serialize_booking(row):
+    """Converte una riga della lista prenotazioni nel dizionario restituito al client."""
+    return {
+        "id": row["id"],
+        "user_id": row["user_id"],
+        "username": row["user_name"],
+        "service_id": row["service_id"],
+        "service_name": row["service_name"],
+        "service_description": row["service_description"],
+        "start_date": row["start_date"],
+        "end_date": row["end_date"],
+        "status": row["status"],
+        "total_price": row["total_price"]
+    }
     
+# colonne di GET /bookings/export -> espressione SQL, nell'ordine predefinito
+EXPORT_COLUMNS = {
+    "id": "b.id",
+    "user_id": "b.user_id",
+    "username": "u.username",
+    "service_id": "b.service_id",
+    "service_name": "s.name",
+    "start_date": "b.start_date",
+    "end_date": "b.end_date",
+    "status": "b.status",
+    "capacity_requested": "b.capacity_requested",
+    "total_price": "b.total_price",
+}
+EXPORT_CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+def handle_export_bookings(handler, authenticated_user):
+    """
+    GET /bookings/export - Esporta le prenotazioni in CSV o NDJSON (tutte per
+    admin, solo le proprie per gli altri utenti), in streaming a blocchi:
+    la memoria usata non dipende dal numero di righe.
+    Parametri di query opzionali:
+    - format: csv (default) o ndjson
+    - columns: colonne da esportare separate da virgola (default tutte)
+    - from, to: prenotazioni che si sovrappongono al periodo indicato (YYYY-MM-DD)
+    - status, service_id: filtri
+    """
+    query = parse_query(handler.path)
+    export_format = query.get("format", "csv")
+    if export_format not in EXPORT_CONTENT_TYPES:
+        _send_error(handler, 400, "format deve essere 'csv' o 'ndjson'")
+        return
+    columns = [column.strip() for column in query.get("columns", ",".join(EXPORT_COLUMNS)).split(",")]
+    unknown = [column for column in columns if column not in EXPORT_COLUMNS]
+    if unknown or not columns:
+        _send_error(handler, 400, f"Colonne non valide: {', '.join(unknown)}. "
+            f"Valori ammessi: {', '.join(EXPORT_COLUMNS)}")
+        return
+    try:
+        service_id = parse_int(query, "service_id")
+        date_from = parse_date(query, "from")
+        date_to = parse_date(query, "to")
+    except QueryError as e:
+        _send_error(handler, 400, str(e))
+        return
+
+    # b.id in coda alle colonne richieste: serve a leggere le righe a blocchi
+    sql = "SELECT " + ", ".join(EXPORT_COLUMNS[column] for column in columns) + ", b.id FROM bookings b"
+    # le join servono solo per le colonne che le richiedono
+    if "service_name" in columns:
+        sql += " JOIN services s ON b.service_id = s.id"
+    if "username" in columns:
+        sql += " JOIN users u ON b.user_id = u.id"
+    conditions = []
+    params = []
+    if authenticated_user["role"] != "admin":
+        conditions.append("b.user_id = ?")
+        params.append(authenticated_user["id"])
+    if query.get("status"):
+        conditions.append("b.status = ?")
+        params.append(query["status"])
+    if service_id is not None:
+        conditions.append("b.service_id = ?")
+        params.append(service_id)
+    if date_from:
+        conditions.append("b.end_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("b.start_date <= ?")
+        params.append(date_to)
+
+    if export_format == "csv":
+        header = _encode_csv([columns])
+        encode_rows = lambda rows: _encode_csv(row[:-1] for row in rows)
+    else:
+        header = b""
+        # zip si ferma alle colonne richieste, escludendo b.id
+        encode_rows = lambda rows: "".join(
+            json.dumps(dict(zip(columns, row))) + "\n" for row in rows).encode("utf-8")
+
+    extra_headers = {"Content-Disposition": f'attachment; filename="bookings.{export_format}"'}
+    # tuple invece di sqlite3.Row: le righe vanno solo serializzate
+    batches = keyset_batches(sql, conditions, params, "b.id", "b.id", False,
+        lambda row: (row[-1], row[-1]), plain_rows=True)
+    send_stream_rows(handler, batches, encode_rows, EXPORT_CONTENT_TYPES[export_format],
+        header=header, extra_headers=extra_headers)
+
+def _encode_csv(rows):
+    """Converte un blocco di righe in righe CSV."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
 def handle_get_booking_by_id(handler, booking_id):
-    """GET /bookings/<id> - Ritorna la singola prenotazione, se esiste."""
+    """
+    GET /bookings/<id> - Ritorna la singola prenotazione, se esiste.
+    Risponde 304 se né la prenotazione né servizi e utenti sono cambiati dall'ETag in If-None-Match.
+    """
     try:
         booking_id = int(booking_id)
     except ValueError:
         error_response = json.dumps({"error": "Invalid ID"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
+        return
+
+    # la risposta include nome del servizio e username
+    etag = row_etag("bookings", booking_id, "services", "users")
+    if is_not_modified(handler, etag):
+        send_not_modified(handler, etag)
         return
 
     with get_connection() as conn:
@@ -101,12 +305,10 @@ def handle_get_booking_by_id(handler, booking_id):
             "total_price": row["total_price"]
         }
         response_data = json.dumps(result).encode("utf-8")
-        set_headers(handler, 200, response_data)
-        handler.wfile.write(response_data)
+        set_headers(handler, 200, response_data, extra_headers=cache_validator_headers(etag))
     else:
         error_response = json.dumps({"error": "Booking not found"}).encode("utf-8")
         set_headers(handler, 404, error_response)
-        handler.wfile.write(error_response)
 
 def handle_create_booking(handler, authenticated_user):
     """Handler per POST /bookings - Crea una nuova prenotazione."""
@@ -130,55 +332,88 @@ def handle_create_booking(handler, authenticated_user):
         return
 
     user_id = data["user_id"] if data.get("user_id") else user_id
-    service_id = data["service_id"]
-    start_date = validation_result["start_date"]
-    end_date = validation_result["end_date"]
-    capacity_requested = data.get("capacity_requested", 1)
-    status = data.get("status", "pending")
-
-    # verifica servizio e disponibilità
-    service_capacity = get_service_capacity(service_id)
-    if service_capacity is None:
-        _send_error(handler, 404, "Servizio non trovato")
-        return
 
-    if not check_availability(service_id, start_date, end_date, capacity_requested, service_capacity):
-        _send_error(handler, 400, "Disponibilita' del servizio insufficiente per il periodo selezionato")
-        return
-
-    # salvataggio prenotazione
-    new_booking_id = save_booking(user_id, service_id, start_date, end_date, capacity_requested, status)
-    if new_booking_id is None:
-        _send_error(handler, 400, "Errore durante il salvataggio della prenotazione")
+    # verifica della disponibilità e salvataggio in un'unica transazione
+    try:
+        new_booking = create_reservation(
+            user_id,
+            data["service_id"],
+            validation_result["start_date"],
+            validation_result["end_date"],
+            data.get("capacity_requested", 1),
+            data.get("status", "pending"))
+    except ReservationError as e:
+        _send_error(handler, e.code, e.message)
         return
+    record_write("bookings", created=True)
 
     # risposta al client
-    new_booking = {
-        "id": new_booking_id,
-        "user_id": user_id,
-        "service_id": service_id,
-        "start_date": start_date.strftime("%Y-%m-%d"),
-        "end_date": end_date.strftime("%Y-%m-%d"),
-        "capacity_requested": capacity_requested,
-        "status": status,
-    }
     response_data = json.dumps(new_booking).encode("utf-8")
     set_headers(handler, 201, response_data)
-    handler.wfile.write(response_data)
+
+def handle_create_bookings_batch(handler, authenticated_user):
+    """
+    POST /bookings/batch - Crea più prenotazioni in un'unica transazione.
+    Body JSON: {"mode": "atomic" | "partial", "bookings": [{...}, ...]} oppure
+    direttamente la lista delle prenotazioni (modalità "atomic").
+    - atomic: se una prenotazione non è valida non ne viene creata nessuna (400)
+    - partial: vengono create solo le prenotazioni valide (201 se tutte, 207 altrimenti)
+    La risposta contiene un risultato per ogni prenotazione, nello stesso ordine.
+    """
+    content_length = int(handler.headers.get("Content-Length", 0))
+    body = handler.rfile.read(content_length).decode("utf-8")
+
+    try:
+        data = json.loads(body)
+    except json.JSONDecodeError:
+        _send_error(handler, 400, "JSON non valido")
+        return
+
+    if isinstance(data, list):
+        data = {"bookings": data}
+    if not isinstance(data, dict) or not isinstance(data.get("bookings"), list):
+        _send_error(handler, 400, "Campo obbligatorio mancante: bookings")
+        return
+    mode = data.get("mode", "atomic")
+    if mode not in ("atomic", "partial"):
+        _send_error(handler, 400, "mode deve essere 'atomic' o 'partial'")
+        return
+    items = data["bookings"]
+    if not items:
+        _send_error(handler, 400, "Nessuna prenotazione nel lotto")
+        return
+    if len(items) > BOOKING_BATCH_MAX_SIZE:
+        _send_error(handler, 413, f"Massimo {BOOKING_BATCH_MAX_SIZE} prenotazioni per lotto")
+        return
+
+    results = create_reservations(items, authenticated_user, atomic=(mode == "atomic"))
+    created = sum(1 for result in results if result["status"] == 201)
+    if created:
+        record_write("bookings", created=True)
+    if created == len(results):
+        code = 201
+    elif mode == "atomic" or created == 0:
+        code = 400
+    else:
+        code = 207
+
+    response_data = json.dumps({
+        "mode": mode,
+        "created": created,
+        "failed": len(results) - created,
+        "results": results,
+    }).encode("utf-8")
+    set_headers(handler, code, response_data)
 
 def _send_error(handler, code, message):
     """Invia un errore al client."""
     error_response = json.dumps({"error": message}).encode("utf-8")
     set_headers(handler, code, error_response)
-    handler.wfile.write(error_response)
 
 def handle_update_booking(handler, authenticated_user, booking_id):
     """
     PUT /bookings/<id> - Aggiorna una prenotazione esistente per id.
     """
-    user_id = authenticated_user["id"]
-    role = authenticated_user["role"]
-
     try:
         booking_id = int(booking_id)
     except ValueError:
@@ -194,131 +429,32 @@ def handle_update_booking(handler, authenticated_user, booking_id):
         _send_error(handler, 400, "JSON non valido")
         return
 
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,))
-        existing_booking = c.fetchone()
-
-    if not existing_booking:
-        _send_error(handler, 404, "Prenotazione non trovata")
-        return
-
-    # controllo sul ruolo dell'utente per vedere se può modificare la prenotazione 
-    # se è un admin può modificare tutte le prenotazioni, altrimenti solo le sue
-    
-    if existing_booking["user_id"] != user_id and role != "admin":
-        _send_error(handler, 403, "Accesso negato alla prenotazione")
-        return
-
-    # aggiorna o mantieni i dati
-    updated_service_id = data.get("service_id", existing_booking["service_id"])
-    updated_start_date = data.get("start_date", existing_booking["start_date"])
-    updated_end_date = data.get("end_date", existing_booking["end_date"])
-    updated_capacity_requested = data.get("capacity_requested", existing_booking["capacity_requested"])
-    updated_status = "pending" if role == "user" else data.get("status", existing_booking["status"])
-
-    validation_result = validate_booking_data({
-        "service_id": updated_service_id,
-        "start_date": updated_start_date,
-        "end_date": updated_end_date
-    })
-    if validation_result.get("error"):
-        _send_error(handler, 400, validation_result["error"])
-        return
-
-    start_date = validation_result["start_date"]
-    end_date = validation_result["end_date"]
-    
-    service_capacity = get_service_capacity(updated_service_id)
-    if service_capacity is None:
-        _send_error(handler, 404, "Servizio non trovato")
-        return
-
-    if not check_availability(
-        updated_service_id,
-        start_date,
-        end_date,
-        updated_capacity_requested,
-        service_capacity,
-        exclude_booking_id=booking_id):
-        _send_error(handler, 400, "Disponibilita' del servizio insufficiente per il periodo selezionato")
-        return
-
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("SELECT price FROM services WHERE id = ?", (updated_service_id,))
-        service = c.fetchone()
-    if not service:
-        _send_error(handler, 404, "Servizio non trovato")
+    # rilettura, controlli e scrittura in un'unica transazione
+    try:
+        response_data = update_reservation(booking_id, data, authenticated_user)
+    except ReservationError as e:
+        _send_error(handler, e.code, e.message)
         return
+    record_write("bookings", booking_id)
 
-    daily_price = service["price"]
-    num_days = (end_date - start_date).days + 1
-    total_price = daily_price * num_days * updated_capacity_requested
-
-    # aggiorna la prenotazione
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("""
-            UPDATE bookings
-            SET service_id = ?, start_date = ?, end_date = ?, capacity_requested = ?, status = ?, total_price = ?
-            WHERE id = ?
-        """, (updated_service_id, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
-            updated_capacity_requested, updated_status, total_price, booking_id))
-        conn.commit()
-
-    response_data = {
-        "id": booking_id,
-        "service_id": updated_service_id,
-        "start_date": start_date.strftime("%Y-%m-%d"),
-        "end_date": end_date.strftime("%Y-%m-%d"),
-        "capacity_requested": updated_capacity_requested,
-        "status": updated_status,
-        "total_price": total_price
-    }
     set_headers(handler, 200, json.dumps(response_data).encode("utf-8"))
-    handler.wfile.write(json.dumps(response_data).encode("utf-8"))
 
 def handle_delete_booking(handler, authenticated_user, booking_id):
     """DELETE /bookings/<id> - Elimina una prenotazione."""
-    
-    role = authenticated_user["role"] 
     try:
         booking_id = int(booking_id)
     except ValueError:
         error_response = json.dumps({"error": "ID prenotazione non valido"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
-    user_id = authenticated_user["id"]
-
-    # cerca la prenotazione nel database
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT user_id
-            FROM bookings
-            WHERE id = ?
-        """, (booking_id,))
-        booking = c.fetchone()
-
-        if not booking:
-            error_response = json.dumps({"error": "Prenotazione non trovata"}).encode("utf-8")
-            set_headers(handler, 404, error_response)
-            handler.wfile.write(error_response)
-            return
-
-        if booking["user_id"] != user_id and role != "admin":
-            error_response = json.dumps({"error": "Accesso negato alla prenotazione"}).encode("utf-8")
-            set_headers(handler, 403, error_response)
-            handler.wfile.write(error_response)
-            return
-
-        # elimina la prenotazione
-        c.execute("DELETE FROM bookings WHERE id = ?", (booking_id,))
-        conn.commit()
+    # rilettura, controlli ed eliminazione in un'unica transazione
+    try:
+        delete_reservation(booking_id, authenticated_user)
+    except ReservationError as e:
+        _send_error(handler, e.code, e.message)
+        return
+    record_write("bookings", booking_id)
 
     success_response = {"messaggio": f"Prenotazione {booking_id} eliminata con successo"}
     set_headers(handler, 200, json.dumps(success_response).encode("utf-8"))
-    handler.wfile.write(json.dumps(success_response).encode("utf-8"))
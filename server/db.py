@@ -1,15 +1,381 @@
+import os
+import queue
 import sqlite3
-import bcrypt
+import threading
+from utility.logger import get_logger
+from utility.metrics import register_metrics
+from utility.passwords import hash_password
+from utility.query_cache import ALL_TABLES, query_cache, written_tables
 
 DATABASE_NAME = "database.db"
 
+logger = get_logger("db")
+
+# numero massimo di connessioni aperte contemporaneamente dal pool
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+# secondi di attesa massima per ottenere una connessione libera
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+
+# profili di configurazione SQLite applicati a ogni connessione del pool.
+# "performance": WAL (letture concorrenti alle scritture), fsync solo ai checkpoint,
+# cache e mmap più grandi; "safe": journal classico e fsync a ogni commit
+DB_PROFILES = {
+    "performance": {
+        "journal_mode": "WAL",
+        "busy_timeout": 5000,          # millisecondi di attesa su un database bloccato
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,        # 256 MiB
+        "cache_size": -65536,          # negativo: KiB, quindi 64 MiB per connessione
+        "temp_store": "MEMORY",
+    },
+    "safe": {
+        "journal_mode": "DELETE",
+        "busy_timeout": 5000,
+        "synchronous": "FULL",
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "temp_store": "DEFAULT",
+    },
+}
+# profilo attivo; ogni impostazione può essere sovrascritta con DB_<NOME>
+# (es. DB_SYNCHRONOUS=FULL, DB_CACHE_SIZE=-16384)
+DB_PROFILE = os.environ.get("DB_PROFILE", "performance")
+
+# valori ammessi per i pragma non numerici, nell'ordine del codice ritornato da SQLite
+_PRAGMA_CHOICES = {
+    "journal_mode": ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"),
+    "synchronous": ("OFF", "NORMAL", "FULL", "EXTRA"),
+    "temp_store": ("DEFAULT", "FILE", "MEMORY"),
+}
+
+def load_db_settings(profile=DB_PROFILE, environ=os.environ):
+    """
+    Ritorna le impostazioni del profilo indicato con le eventuali sovrascritture
+    dalle variabili d'ambiente DB_<NOME>. Solleva ValueError per valori non validi.
+    """
+    if profile not in DB_PROFILES:
+        raise ValueError(f"Profilo SQLite sconosciuto: {profile}")
+    settings = {}
+    for name, default in DB_PROFILES[profile].items():
+        value = environ.get(f"DB_{name.upper()}", default)
+        if name in _PRAGMA_CHOICES:
+            value = str(value).upper()
+            if value not in _PRAGMA_CHOICES[name]:
+                raise ValueError(f"Valore non valido per {name}: {value}")
+        else:
+            value = int(value)
+        settings[name] = value
+    return settings
+
+DB_SETTINGS = load_db_settings()
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """Sollevata quando nessuna connessione si libera entro il timeout del pool."""
+
+
+# tabella -> tabelle che la referenziano con azioni ON DELETE/UPDATE (letto dallo schema)
+_dependent_tables = None
+
+def _load_dependent_tables(conn):
+    """Ritorna la mappa tabella -> tabelle figlie modificate a cascata dalle sue scritture."""
+    dependents = {}
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in tables:
+        for row in conn.execute(f"PRAGMA foreign_key_list('{table}')"):
+            # colonne: id, seq, table, from, to, on_update, on_delete, match
+            if {row[5], row[6]} & {"CASCADE", "SET NULL", "SET DEFAULT"}:
+                dependents.setdefault(row[2].lower(), set()).add(table.lower())
+    return dependents
+
+
+class TrackedCursor(sqlite3.Cursor):
+    """Cursore che registra sulla connessione le tabelle modificate da ogni istruzione."""
+
+    def execute(self, sql, *args):
+        self.connection._track(written_tables(sql))
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self.connection._settle()
+
+    def executemany(self, sql, *args):
+        self.connection._track(written_tables(sql))
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self.connection._settle()
+
+    def executescript(self, script):
+        self.connection._track((ALL_TABLES,))
+        try:
+            return super().executescript(script)
+        finally:
+            self.connection._settle()
+
+
+class TrackedConnection(sqlite3.Connection):
+    """
+    Connessione che invalida la cache delle query (utility.query_cache) quando
+    le scritture vengono confermate: al commit, o subito per le istruzioni
+    eseguite fuori da una transazione. Il rollback scarta le tabelle registrate.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._written = set()
+
+    def cursor(self, factory=TrackedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def commit(self):
+        super().commit()
+        self._settle()
+
+    def rollback(self):
+        super().rollback()
+        self._written.clear()
+
+    def _track(self, tables):
+        self._written.update(tables)
+
+    def _settle(self):
+        """Invalida le tabelle scritte se non c'è più una transazione aperta."""
+        global _dependent_tables
+        if not self._written or self.in_transaction:
+            return
+        written, self._written = self._written, set()
+        if ALL_TABLES in written:
+            # possibile modifica dello schema: le dipendenze vengono rilette
+            _dependent_tables = None
+        elif query_cache.enabled:
+            if _dependent_tables is None:
+                _dependent_tables = _load_dependent_tables(self)
+            pending = list(written)
+            while pending:
+                for table in _dependent_tables.get(pending.pop(), ()):
+                    if table not in written:
+                        written.add(table)
+                        pending.append(table)
+        query_cache.invalidate(written)
+
+
+class ConnectionPool:
+    """
+    Pool di connessioni SQLite riutilizzabili.
+    Le connessioni vengono create una sola volta (row factory e foreign keys gia'
+    impostate) e restituite al pool alla chiusura del blocco ``with``.
+    Ogni connessione e' legata al thread che l'ha ottenuta: chiamate annidate
+    a get_connection() nello stesso thread riutilizzano la stessa connessione.
+    """
+
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, settings=None):
+        self.database = database
+        self.settings = settings if settings is not None else DB_SETTINGS
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquisitions = 0
+        self._reused = 0
+        self._waits = 0
+        self._timeouts = 0
+
+    def _create_connection(self):
+        """Apre e configura una nuova connessione verso il database."""
+        connection = sqlite3.connect(self.database, check_same_thread=False, factory=TrackedConnection)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys = ON;")
+        # i valori sono già validati da load_db_settings
+        for name, value in self.settings.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        with self._lock:
+            self._created += 1
+        return connection
+
+    def acquire(self):
+        """Restituisce la connessione del thread corrente, prelevandola dal pool se necessario."""
+        local = self._local
+        if getattr(local, "depth", 0) > 0:
+            local.depth += 1
+            return local.connection
+
+        # attende uno slot libero solo se il pool e' esaurito
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._timeouts += 1
+                raise PoolTimeoutError("Nessuna connessione disponibile nel pool")
+
+        try:
+            connection = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            try:
+                connection = self._create_connection()
+            except Exception:
+                self._slots.release()
+                raise
+            reused = False
+
+        with self._lock:
+            self._in_use += 1
+            self._acquisitions += 1
+            if reused:
+                self._reused += 1
+
+        local.connection = connection
+        local.depth = 1
+        return connection
+
+    def release(self, exc_type=None):
+        """
+        Rilascia la connessione del thread corrente. Solo l'uscita dal blocco
+        piu' esterno chiude la transazione (commit o rollback in caso di errore)
+        e rimette la connessione nel pool.
+        """
+        local = self._local
+        local.depth -= 1
+        if local.depth > 0:
+            return
+
+        connection = local.connection
+        local.connection = None
+        try:
+            if connection.in_transaction:
+                if exc_type is None:
+                    connection.commit()
+                else:
+                    connection.rollback()
+        except sqlite3.Error:
+            # una connessione in stato non valido non viene rimessa nel pool
+            connection.close()
+            connection = None
+            with self._lock:
+                self._created -= 1
+
+        if connection is not None:
+            self._idle.put(connection)
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def close(self):
+        """Chiude tutte le connessioni inattive del pool."""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        """Ritorna un dizionario con le statistiche di utilizzo del pool."""
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "acquisitions": self._acquisitions,
+                "reused": self._reused,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+            }
+
+
+class _PooledConnection:
+    """Context manager restituito da get_connection()."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __enter__(self):
+        return self._pool.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool.release(exc_type)
+        return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Ritorna il pool di connessioni, creandolo al primo utilizzo."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_NAME)
+    return _pool
+
+def configure_pool(size=None, timeout=None):
+    """(Ri)crea il pool con dimensione e timeout indicati. Da chiamare all'avvio."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(
+            DATABASE_NAME,
+            size=size if size is not None else DB_POOL_SIZE,
+            timeout=timeout if timeout is not None else DB_POOL_TIMEOUT,
+        )
+    return _pool
+
+def close_pool():
+    """Chiude le connessioni inattive del pool (es. alla chiusura del server)."""
+    if _pool is not None:
+        _pool.close()
+
+def check_db_settings():
+    """
+    Legge i valori effettivi dei pragma su una connessione del pool e li confronta
+    con quelli richiesti: SQLite ignora in silenzio alcune impostazioni (es. WAL
+    su filesystem che non lo supportano, mmap oltre il limite di compilazione).
+    Ritorna il dizionario dei valori effettivi.
+    """
+    effective = {}
+    with get_connection() as conn:
+        for name, requested in get_pool().settings.items():
+            value = conn.execute(f"PRAGMA {name}").fetchone()[0]
+            if name in _PRAGMA_CHOICES:
+                choices = _PRAGMA_CHOICES[name]
+                value = choices[value] if isinstance(value, int) else str(value).upper()
+            effective[name] = value
+            if value != requested:
+                logger.warning("SQLite %s = %s invece di %s", name, value, requested)
+    logger.info("Profilo SQLite %s: %s", DB_PROFILE, effective)
+    return effective
+
+def pool_stats():
+    """Ritorna le statistiche del pool di connessioni."""
+    return get_pool().stats()
+
+register_metrics("db_pool", pool_stats)
+
 def get_connection():
-    """Ritorna una connessione SQLite al file database.
-    db con Row factory."""
-    connection = sqlite3.connect(DATABASE_NAME)
-    connection.row_factory = sqlite3.Row  
-    connection.execute("PRAGMA foreign_keys = ON;")
-    return connection
+    """Ritorna una connessione SQLite dal pool, da usare con ``with``.
+    La connessione ha gia' la Row factory e le foreign keys attive e
+    viene restituita al pool all'uscita dal blocco."""
+    return _PooledConnection(get_pool())
 
 def seed_services():
     """Popola la tabella services con dati di default."""
@@ -28,7 +394,7 @@ def seed_services():
                 VALUES (?, ?, ?, ?, ?)
             """, (service["name"], service["description"], service["capacity"], service["price"], service["active"]))
         conn.commit()
-        print("Servizi di default inseriti.")
+        logger.info("Servizi di default inseriti")
 
 def seed_bookings():
     """Popola la tabella bookings con dati di default."""
@@ -45,15 +411,14 @@ def seed_bookings():
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (booking["user_id"], booking["service_id"], booking["start_date"], booking["end_date"], booking["status"], booking["capacity_requested"], booking["total_price"]))
         conn.commit()
-        print("Prenotazioni di default inserite.")
+        logger.info("Prenotazioni di default inserite")
+    rebuild_occupancy()
 
 def seed_users():
     """Popola la tabella users con utenti di default."""
-    import bcrypt
-
     users = [
-        {"username": "mario", "password": bcrypt.hashpw("test".encode("utf-8"), bcrypt.gensalt()).decode("utf-8"), "email": "mario@example.com", "role": "user"},
-        {"username": "marco", "password": bcrypt.hashpw("test123".encode("utf-8"), bcrypt.gensalt()).decode("utf-8"), "email": "marco@example.com", "role": "user"},
+        {"username": "mario", "password": hash_password("test"), "email": "mario@example.com", "role": "user"},
+        {"username": "marco", "password": hash_password("test123"), "email": "marco@example.com", "role": "user"},
     ]
 
     with get_connection() as conn:
@@ -64,14 +429,147 @@ def seed_users():
                 VALUES (?, ?, ?, ?)
             """, (user["username"], user["password"], user["email"], user["role"]))
         conn.commit()
-        print("Utenti di default inseriti.")
+        logger.info("Utenti di default inseriti")
+
+def rebuild_occupancy():
+    """
+    Ricostruisce la tabella service_day_occupancy a partire dalle prenotazioni
+    esistenti. Ogni prenotazione occupa tutti i giorni da start_date a end_date inclusi.
+    Ritorna il numero di righe (servizio, giorno) generate.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM service_day_occupancy")
+        # espande ogni prenotazione in un giorno per riga tramite CTE ricorsiva
+        c.execute("""
+            WITH RECURSIVE booking_days(service_id, day, end_date, capacity_requested) AS (
+                SELECT service_id, start_date, end_date, capacity_requested FROM bookings
+                UNION ALL
+                SELECT service_id, date(day, '+1 day'), end_date, capacity_requested
+                FROM booking_days
+                WHERE day < end_date
+            )
+            INSERT INTO service_day_occupancy (service_id, day, booked)
+            SELECT service_id, day, SUM(capacity_requested)
+            FROM booking_days
+            GROUP BY service_id, day
+        """)
+        c.execute("SELECT changes() AS rows")
+        rows = c.fetchone()["rows"]
+        conn.commit()
+    logger.info("Indice di occupazione ricostruito: %s giorni", rows)
+    return rows
 
 def seed_all():
     """Esegue tutti i seed di default."""
     seed_services()
     seed_users()
     seed_bookings()
-    print("Database inizializzato con dati di default.")
+    logger.info("Database inizializzato con dati di default")
+
+# migrazioni dello schema, applicate in ordine: la migrazione in posizione N porta
+# PRAGMA user_version a N. Le nuove migrazioni vanno solo aggiunte in fondo.
+MIGRATIONS = (
+    ("indici per la verifica di disponibilità e le prenotazioni per utente", (
+        "CREATE INDEX IF NOT EXISTS idx_bookings_service_dates ON bookings(service_id, start_date, end_date)",
+        "CREATE INDEX IF NOT EXISTS idx_bookings_user ON bookings(user_id)",
+    )),
+    ("indici per la pulizia delle sessioni scadute e per utente", (
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)",
+    )),
+)
+
+def schema_version():
+    """Ritorna la versione dello schema registrata nel database (PRAGMA user_version)."""
+    with get_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations():
+    """
+    Applica le migrazioni non ancora eseguite, ciascuna in una propria transazione
+    insieme all'aggiornamento di PRAGMA user_version: una migrazione fallita non
+    lascia lo schema a metà. Ritorna la versione finale dello schema.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        for version, (description, statements) in enumerate(MIGRATIONS, start=1):
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                # la versione viene riletta dentro la transazione: un altro processo
+                # potrebbe aver applicato la migrazione nel frattempo
+                if c.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    c.execute(statement)
+                c.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.exception("Migrazione %s fallita: %s", version, description)
+                raise
+            logger.info("Migrazione %s applicata: %s", version, description)
+    return schema_version()
+
+
+# query più frequenti dell'applicazione, con parametri di esempio, usate per
+# verificare che il piano di esecuzione sfrutti gli indici
+HOT_QUERIES = (
+    ("verifica disponibilità", """
+        SELECT MAX(booked) AS max_booked
+        FROM service_day_occupancy
+        WHERE service_id = ? AND day BETWEEN ? AND ?
+    """, (1, "2025-01-01", "2025-01-31")),
+    ("servizi disponibili nel periodo", """
+        SELECT s.id, s.capacity - COALESCE(MAX(o.booked), 0) AS available
+        FROM services s
+        LEFT JOIN service_day_occupancy o
+            ON o.service_id = s.id AND o.day BETWEEN ? AND ?
+        WHERE s.active = 1
+        GROUP BY s.id
+        HAVING available >= ?
+    """, ("2025-01-01", "2025-01-31", 1)),
+    ("prenotazioni di un servizio nel periodo", """
+        SELECT id, start_date, end_date, capacity_requested
+        FROM bookings
+        WHERE service_id = ? AND start_date <= ? AND end_date >= ?
+    """, (1, "2025-01-31", "2025-01-01")),
+    ("prenotazioni di un utente", """
+        SELECT b.id, b.service_id, b.start_date, b.end_date, b.status, s.name AS service_name
+        FROM bookings b
+        JOIN services s ON b.service_id = s.id
+        WHERE b.user_id = ?
+        ORDER BY b.id
+        LIMIT ?
+    """, (1, 50)),
+    ("sessione dell'utente", """
+        SELECT u.id, u.username, u.email, u.role, s.expires_at
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.session_id = ?
+    """, ("00000000-0000-0000-0000-000000000000",)),
+    ("pulizia delle sessioni scadute", """
+        DELETE FROM sessions WHERE expires_at < ?
+    """, ("2025-01-01 00:00:00",)),
+)
+
+def explain_hot_queries():
+    """
+    Ritorna il piano di esecuzione (EXPLAIN QUERY PLAN) di ciascuna query in
+    HOT_QUERIES, come lista di coppie (nome, righe del piano indentate).
+    """
+    report = []
+    with get_connection() as conn:
+        for name, sql, params in HOT_QUERIES:
+            depth = {0: 0}
+            lines = []
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+                depth[row["id"]] = depth.get(row["parent"], 0) + 1
+                lines.append("  " * depth[row["id"]] + row["detail"])
+            report.append((name, lines))
+    return report
 
 def init_db():
     """Crea le tabelle bookings, users e sessions se non esistono."""
@@ -129,25 +627,48 @@ def init_db():
             );
         """)
 
+        # Creazione tabella service_day_occupancy: indice persistente dei posti
+        # prenotati per servizio e giorno, aggiornato nella stessa transazione
+        # delle scritture sulla tabella bookings
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS service_day_occupancy (
+                service_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                booked INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (service_id, day),
+                FOREIGN KEY (service_id) REFERENCES services(id) ON DELETE CASCADE
+            ) WITHOUT ROWID;
+        """)
+
+        # indici e modifiche successive allo schema di base
+        apply_migrations()
+
         # Crea un amministratore di default se non esiste
         c.execute("SELECT COUNT(*) as count FROM users WHERE role = 'admin'")
         admin_count = c.fetchone()["count"]
         if admin_count == 0:
             default_admin_username = "admin"
-            default_admin_password = bcrypt.hashpw("admin".encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+            default_admin_password = hash_password("admin")
             default_admin_email = "admin@example.com"
             c.execute("""
                 INSERT INTO users (username, password, email, role)
                 VALUES (?, ?, ?, 'admin')
             """, (default_admin_username, default_admin_password, default_admin_email))
-            print("Amministratore di default creato: username='admin', password='admin'")
-            print("Inizializzazione del resto delle tabelle...")
+            logger.warning("Amministratore di default creato: username='admin', password='admin'")
+            logger.info("Inizializzazione del resto delle tabelle")
             conn.commit()
             seed_all()
-            print("Tabelle inizializzate")
+            logger.info("Tabelle inizializzate")
             
         else:
-            print("Tabelle già inizializzate")
+            logger.debug("Tabelle già inizializzate")
             conn.commit()
 
+        # database creati prima dell'indice di occupazione: lo ricostruisce dalle prenotazioni
+        c.execute("SELECT EXISTS (SELECT 1 FROM service_day_occupancy) AS has_index")
+        has_index = c.fetchone()["has_index"]
+        c.execute("SELECT EXISTS (SELECT 1 FROM bookings) AS has_bookings")
+        if not has_index and c.fetchone()["has_bookings"]:
+            rebuild_occupancy()
+
     
\ No newline at end of file
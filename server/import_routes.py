@@ -0,0 +1,34 @@
+import json
+from utility.bulk_import import BoundedStream, IMPORT_FORMATS, import_records
+from utility.utility import set_headers, parse_query
+from utility.versions import record_write
+
+def handle_import(handler, authenticated_user, table):
+    """
+    POST /import/<tabella> - Importa services, users o bookings (solo admin).
+    Il corpo è un file NDJSON (una riga JSON per record) o CSV con intestazione,
+    letto in streaming. Il formato si indica con ?format=ndjson|csv oppure con
+    Content-Type text/csv. Ritorna il numero di righe inserite e quelle scartate.
+    """
+    if authenticated_user["role"] != "admin":
+        error_response = json.dumps({"error": "Autorizzazione richiesta"}).encode("utf-8")
+        set_headers(handler, 403, error_response)
+        return
+
+    query = parse_query(handler.path)
+    content_type = handler.headers.get("Content-Type", "").split(";")[0].strip()
+    format = query.get("format", "csv" if content_type == "text/csv" else "ndjson")
+    if format not in IMPORT_FORMATS:
+        error_response = json.dumps({"error": "format deve essere 'ndjson' o 'csv'"}).encode("utf-8")
+        set_headers(handler, 400, error_response)
+        return
+
+    content_length = int(handler.headers.get("Content-Length", 0))
+    try:
+        report = import_records(table, BoundedStream(handler.rfile, content_length), format)
+    finally:
+        # i blocchi gia' inseriti restano anche se l'import si interrompe
+        record_write(table, created=True)
+
+    response_data = json.dumps(report.as_dict()).encode("utf-8")
+    set_headers(handler, 200, response_data)
@@ -0,0 +1,77 @@
+import argparse
+import sys
+from db import init_db, rebuild_occupancy, schema_version, explain_hot_queries
+from utility.bulk_import import IMPORTERS, IMPORT_FORMATS, import_records
+from utility.logger import setup_logging, shutdown_logging
+
+def run_import(args):
+    """Esegue l'import da file e stampa avanzamento e righe scartate."""
+    format = args.format or ("csv" if args.path.lower().endswith(".csv") else "ndjson")
+
+    def progress(report):
+        print(f"{report.processed} righe lette, {report.inserted} inserite, {report.rejected} scartate",
+            file=sys.stderr)
+
+    if args.path == "-":
+        report = import_records(args.table, sys.stdin.buffer, format, args.batch_size, progress)
+    else:
+        with open(args.path, "rb") as stream:
+            report = import_records(args.table, stream, format, args.batch_size, progress)
+
+    for error in report.as_dict()["errors"]:
+        print(f"riga {error['line']}: {error['error']}")
+    if report.rejected > len(report.errors):
+        print(f"... altre {report.rejected - len(report.errors)} righe scartate")
+    print(f"Import {report.table}: {report.inserted} righe inserite, {report.rejected} scartate")
+
+def main(argv=None):
+    """Comandi di amministrazione del database da riga di comando."""
+    parser = argparse.ArgumentParser(description="Comandi di amministrazione del server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "rebuild-occupancy",
+        help="ricostruisce l'indice di occupazione giornaliera dalle prenotazioni esistenti")
+    subparsers.add_parser(
+        "migrate",
+        help="applica le migrazioni dello schema non ancora eseguite")
+    subparsers.add_parser(
+        "explain-queries",
+        help="mostra il piano di esecuzione (EXPLAIN QUERY PLAN) delle query più frequenti")
+
+    import_parser = subparsers.add_parser(
+        "import",
+        help="importa services, users o bookings da un file NDJSON o CSV")
+    import_parser.add_argument("table", choices=sorted(IMPORTERS))
+    import_parser.add_argument("path", help="file da importare ('-' per lo standard input)")
+    import_parser.add_argument(
+        "--format", choices=IMPORT_FORMATS,
+        help="formato del file (default: dedotto dall'estensione, NDJSON se non è .csv)")
+    import_parser.add_argument("--batch-size", type=int, help="righe per transazione")
+
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    try:
+        if args.command == "rebuild-occupancy":
+            init_db()
+            rebuild_occupancy()
+        elif args.command == "migrate":
+            # init_db crea le tabelle mancanti e applica le migrazioni
+            init_db()
+            print(f"Versione dello schema: {schema_version()}")
+        elif args.command == "explain-queries":
+            init_db()
+            for name, plan in explain_hot_queries():
+                print(f"{name}:")
+                for line in plan:
+                    print(line)
+                print()
+        elif args.command == "import":
+            init_db()
+            run_import(args)
+    finally:
+        shutdown_logging()
+
+if __name__ == "__main__":
+    main()
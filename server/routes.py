@@ -1,12 +1,18 @@
 import json
+import sqlite3
+import threading
+import time
 from booking_routes import (
     handle_get_all_bookings,
+    handle_export_bookings,
     handle_get_booking_by_id,
     handle_create_booking,
+    handle_create_bookings_batch,
     handle_update_booking,
     handle_delete_booking
 )
-from utility.utility import set_headers, parse_path
+from db import PoolTimeoutError
+from utility.utility import negotiate_compression, set_headers, parse_route_path
 from user_routes import (
     handle_get_current_user,
     handle_login,
@@ -20,121 +26,250 @@ from user_routes import (
 from service_routes import (
     handle_get_all_services,
     handle_get_service_by_id,
+    handle_get_service_availability,
+    handle_get_available_services,
     handle_create_service,
     handle_update_service,
     handle_delete_service
 )
+from import_routes import handle_import
 from utility.authentication import verify_authentication
+from utility.logger import get_logger
+from utility.metrics import collect_metrics, register_metrics
 
-def route_request(handler, method):
-    ''' Gestisce le richieste http provenienti da server.py
-    in base al metodo HTTP e al percorso richiesto. '''
-    
-    # rotte publiche che non richiedono autenticazione
-    public_routes = [
-        ("login", "POST"),
-        ("logout", "POST"),
-        ("users","POST")
-    ]
+logger = get_logger("routes")
 
-    # logica per analizzare il percorso della richiesta
-    resource, resource_id = parse_path(handler.path)
 
-    if (resource, method) not in public_routes:
-        authenticated_user = verify_authentication(handler)
-        if not authenticated_user:
-            print("Autenticazione fallita!")
-            return
-        print(f"Utente autenticato: {authenticated_user}")
-        
-    # rotta per le prenotazioni
-    if resource == "bookings":
-        if resource_id is None:
-            if method == "GET":
-                handle_get_all_bookings(handler,authenticated_user)
-            elif method == "POST":
-                handle_create_booking(handler,authenticated_user)
-            else:
-                handle_404(handler)
-        else:
-            if method == "GET":
-                handle_get_booking_by_id(handler, resource_id)
-            elif method == "PUT":
-                handle_update_booking(handler, authenticated_user, resource_id)
-            elif method == "DELETE":
-                handle_delete_booking(handler, authenticated_user, resource_id)
-            else:
-                handle_404(handler)
-        return
+class Route:
+    """
+    Rotta dichiarativa: metodo HTTP, pattern del percorso e funzione che la gestisce.
+    Nel pattern i segmenti ":id" corrispondono a un identificativo numerico.
+    La funzione riceve il RequestContext della richiesta.
+    """
 
-    # rotta per i servizi
-    if resource == "services":
-        if resource_id is None:
-            if method == "GET":
-                handle_get_all_services(handler)
-            elif method == "POST":
-                handle_create_service(handler)
-            else:
-                handle_404(handler)
-        else:
-            if method == "GET":
-                handle_get_service_by_id(handler, resource_id)
-            elif method == "PUT":
-                handle_update_service(handler, resource_id)
-            elif method == "DELETE":
-                handle_delete_service(handler, resource_id)
-            else:
-                handle_404(handler)
-        return
+    def __init__(self, method, pattern, endpoint, public=False):
+        self.method = method
+        self.pattern = pattern
+        self.endpoint = endpoint
+        # le rotte pubbliche non richiedono autenticazione
+        self.public = public
+        self.name = f"{method} /{pattern}"
 
-    # rotta per il login
-    if resource == "login":
-        if method == "POST":
-            handle_login(handler)
-        else:
-            handle_404(handler)
-        return
 
-    # rotta per il logout
-    if resource == "logout":
-        if method == "POST":
-            handle_logout(handler)
-        else:
-            handle_404(handler)
+class RequestContext:
+    """Dati della richiesta condivisi tra middleware e funzione della rotta."""
+
+    __slots__ = ("handler", "method", "route", "ids", "user")
+
+    def __init__(self, handler, method, route, ids):
+        self.handler = handler
+        self.method = method
+        self.route = route
+        self.ids = ids
+        self.user = None
+
+    @property
+    def resource_id(self):
+        """Primo identificativo presente nel percorso (stringa, come in parse_path)."""
+        return self.ids[0] if self.ids else None
+
+
+def handle_get_metrics(handler, authenticated_user):
+    ''' GET /metrics - Ritorna le metriche dei componenti del server (solo admin). '''
+    if authenticated_user["role"] != "admin":
+        error_response = json.dumps({"error": "Autorizzazione richiesta"}).encode("utf-8")
+        set_headers(handler, 403, error_response)
         return
+    response_data = json.dumps(collect_metrics()).encode("utf-8")
+    set_headers(handler, 200, response_data)
+
+
+# registro delle rotte dell'API
+ROUTES = (
+    # rotte per le prenotazioni
+    Route("GET", "bookings", lambda ctx: handle_get_all_bookings(ctx.handler, ctx.user)),
+    Route("POST", "bookings", lambda ctx: handle_create_booking(ctx.handler, ctx.user)),
+    Route("GET", "bookings/export", lambda ctx: handle_export_bookings(ctx.handler, ctx.user)),
+    Route("POST", "bookings/batch", lambda ctx: handle_create_bookings_batch(ctx.handler, ctx.user)),
+    Route("GET", "bookings/:id", lambda ctx: handle_get_booking_by_id(ctx.handler, ctx.resource_id)),
+    Route("PUT", "bookings/:id", lambda ctx: handle_update_booking(ctx.handler, ctx.user, ctx.resource_id)),
+    Route("DELETE", "bookings/:id", lambda ctx: handle_delete_booking(ctx.handler, ctx.user, ctx.resource_id)),
+
+    # rotte per i servizi
+    Route("GET", "services", lambda ctx: handle_get_all_services(ctx.handler)),
+    Route("POST", "services", lambda ctx: handle_create_service(ctx.handler)),
+    Route("GET", "services/available", lambda ctx: handle_get_available_services(ctx.handler)),
+    Route("GET", "services/:id", lambda ctx: handle_get_service_by_id(ctx.handler, ctx.resource_id)),
+    Route("GET", "services/:id/availability", lambda ctx: handle_get_service_availability(ctx.handler, ctx.resource_id)),
+    Route("PUT", "services/:id", lambda ctx: handle_update_service(ctx.handler, ctx.resource_id)),
+    Route("DELETE", "services/:id", lambda ctx: handle_delete_service(ctx.handler, ctx.resource_id)),
+
+    # rotte per login e logout
+    Route("POST", "login", lambda ctx: handle_login(ctx.handler), public=True),
+    Route("POST", "logout", lambda ctx: handle_logout(ctx.handler), public=True),
 
     # rotte per gli utenti
-    if resource == "users":
-        if resource_id is None:
-            if method == "GET":
-                handle_get_all_users(handler,authenticated_user)
-            elif method == "POST":
-                handle_create_user(handler)
-            else:
-                handle_404(handler)
-        else:
-            if method == "GET":
-                handle_get_user_by_id(handler, resource_id)
-            elif method == "PUT":
-                handle_update_user(handler, resource_id)
-            elif method == "DELETE":
-                handle_delete_user(handler, resource_id)
-            else:
-                handle_404(handler)
-        return
-    
+    Route("GET", "users", lambda ctx: handle_get_all_users(ctx.handler, ctx.user)),
+    Route("POST", "users", lambda ctx: handle_create_user(ctx.handler), public=True),
+    Route("GET", "users/:id", lambda ctx: handle_get_user_by_id(ctx.handler, ctx.resource_id)),
+    Route("PUT", "users/:id", lambda ctx: handle_update_user(ctx.handler, ctx.resource_id)),
+    Route("DELETE", "users/:id", lambda ctx: handle_delete_user(ctx.handler, ctx.resource_id)),
+
     # rotta per determinare se è presente un utente autenticato
-    if resource == "current-user":
-        if method == "GET":
-            handle_get_current_user(handler)
+    Route("GET", "current-user", lambda ctx: handle_get_current_user(ctx.handler, ctx.user)),
+
+    # rotte per l'import massivo da NDJSON o CSV (solo admin)
+    Route("POST", "import/services", lambda ctx: handle_import(ctx.handler, ctx.user, "services")),
+    Route("POST", "import/users", lambda ctx: handle_import(ctx.handler, ctx.user, "users")),
+    Route("POST", "import/bookings", lambda ctx: handle_import(ctx.handler, ctx.user, "bookings")),
+
+    # rotta per le metriche interne del server (solo admin)
+    Route("GET", "metrics", lambda ctx: handle_get_metrics(ctx.handler, ctx.user)),
+)
+
+
+def compile_routes(routes):
+    """
+    Compila il registro in una mappa (pattern, metodo) -> Route, in una mappa
+    pattern -> metodi ammessi, usata per distinguere 404 e 405, e nell'insieme
+    dei pattern con sole rotte pubbliche.
+    """
+    dispatch = {}
+    allowed_methods = {}
+    protected_patterns = set()
+    for route in routes:
+        key = (route.pattern, route.method)
+        if key in dispatch:
+            raise ValueError(f"Rotta duplicata: {route.name}")
+        dispatch[key] = route
+        allowed_methods.setdefault(route.pattern, set()).add(route.method)
+        if not route.public:
+            protected_patterns.add(route.pattern)
+    allowed = {pattern: ", ".join(sorted(methods)) for pattern, methods in allowed_methods.items()}
+    return dispatch, allowed, frozenset(allowed_methods) - protected_patterns
+
+_dispatch_map, _allowed_methods, _public_patterns = compile_routes(ROUTES)
+
+
+# --- middleware ---
+# ogni middleware riceve il contesto e la funzione successiva della catena
+
+_route_stats = {}
+_route_stats_lock = threading.Lock()
+
+def timing_middleware(ctx, call_next):
+    ''' Misura la durata di ogni richiesta e la aggrega per rotta. '''
+    started_at = time.perf_counter()
+    try:
+        return call_next(ctx)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        with _route_stats_lock:
+            stats = _route_stats.setdefault(ctx.route.name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+def compression_middleware(ctx, call_next):
+    ''' Negozia la compressione gzip della risposta; il corpo viene compresso all'invio. '''
+    negotiate_compression(ctx.handler)
+    return call_next(ctx)
+
+def error_middleware(ctx, call_next):
+    ''' Converte le eccezioni non gestite in risposte JSON (503 per il db occupato, 500 altrimenti). '''
+    try:
+        return call_next(ctx)
+    except (ConnectionError, TimeoutError):
+        # il client ha chiuso la connessione: non c'è nessuno a cui rispondere
+        ctx.handler.close_connection = True
+    except Exception as e:
+        logger.exception("Errore non gestito in %s", ctx.route.name)
+        handler = ctx.handler
+        handler.close_connection = True
+        if getattr(handler, "response_started", False):
+            # risposta gia' iniziata: si puo' solo chiudere la connessione
+            return
+        if isinstance(e, PoolTimeoutError) or (
+                isinstance(e, sqlite3.OperationalError) and "locked" in str(e)):
+            code, message, extra_headers = 503, "Database occupato, riprovare", {"Retry-After": "1"}
+        else:
+            code, message, extra_headers = 500, "Errore interno del server", None
+        error_response = json.dumps({"error": message}).encode("utf-8")
+        set_headers(handler, code, error_response, extra_headers=extra_headers)
+
+def auth_middleware(ctx, call_next):
+    ''' Verifica l'autenticazione per le rotte non pubbliche e salva l'utente nel contesto. '''
+    if not ctx.route.public:
+        authenticated_user = verify_authentication(ctx.handler)
+        if not authenticated_user:
+            logger.debug("Autenticazione fallita per %s", ctx.route.name)
+            return
+        logger.debug("Utente autenticato: %s", authenticated_user["id"])
+        ctx.user = authenticated_user
+    return call_next(ctx)
+
+# ordine di esecuzione: il primo middleware avvolge tutti i successivi
+MIDDLEWARE = (
+    timing_middleware,
+    compression_middleware,
+    error_middleware,
+    auth_middleware,
+)
+
+def build_pipeline(middleware, endpoint):
+    ''' Compone la catena dei middleware attorno alla funzione finale. '''
+    pipeline = endpoint
+    for layer in reversed(middleware):
+        pipeline = (lambda layer, call_next: lambda ctx: layer(ctx, call_next))(layer, pipeline)
+    return pipeline
+
+_pipeline = build_pipeline(MIDDLEWARE, lambda ctx: ctx.route.endpoint(ctx))
+
+
+def route_stats():
+    ''' Ritorna numero di richieste e latenze (ms) per rotta. '''
+    with _route_stats_lock:
+        return {
+            name: {
+                "requests": count,
+                "avg_ms": round(total / count * 1000, 2),
+                "max_ms": round(maximum * 1000, 2),
+            }
+            for name, (count, total, maximum) in _route_stats.items()
+        }
+
+register_metrics("routes", route_stats)
+
+
+def route_request(handler, method):
+    ''' Gestisce le richieste http provenienti da server.py
+    in base al metodo HTTP e al percorso richiesto. '''
+    handler.response_started = False
+
+    # logica per analizzare il percorso della richiesta
+    pattern, ids = parse_route_path(handler.path)
+
+    route = _dispatch_map.get((pattern, method))
+    if route is None:
+        # 404 e 405 rivelerebbero quali rotte protette esistono: senza autenticazione
+        # si risponde 401 a tutti i percorsi, tranne a quelli interamente pubblici
+        if pattern not in _public_patterns and not verify_authentication(handler):
+            return
+        allowed = _allowed_methods.get(pattern)
+        if allowed:
+            handle_405(handler, allowed)
         else:
             handle_404(handler)
         return
-    # se la rotta non è trovata
-    handle_404(handler)
+
+    _pipeline(RequestContext(handler, method, route, ids))
 
 def handle_404(handler):
     ''' Funzione di default per gestire le richieste HTTP per rotte non trovate. '''
     error_response = json.dumps({"error": "Rotta non trovata"}).encode("utf-8")
     set_headers(handler, 404,error_response)
-    handler.wfile.write(error_response)
+
+def handle_405(handler, allowed):
+    ''' Risposta per rotte esistenti richieste con un metodo HTTP non supportato. '''
+    error_response = json.dumps({"error": "Metodo non consentito"}).encode("utf-8")
+    set_headers(handler, 405, error_response, extra_headers={"Allow": allowed})
@@ -1,21 +1,327 @@
+import argparse
+import collections
 import json
 import os
+import selectors
+import socket
+import threading
+import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from routes import route_request
-from db import init_db
+from db import init_db, close_pool, check_db_settings
 from utility.utility import set_headers
+from utility.static_cache import AssetCache
+from utility.metrics import register_metrics
+from utility.session_reaper import session_reaper
+from utility.session_token import check_token_keys
+from utility.logger import get_logger, setup_logging, shutdown_logging, start_request, current_request_id
 from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+# motore del server: "threading" (un thread per connessione), "pool" (worker fissi)
+# o "asyncio" (event loop con handler eseguiti in un executor)
+SERVER_ENGINE = os.environ.get("SERVER_ENGINE", "threading")
+# numero di worker e dimensione della coda di connessioni in modalita' "pool"
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "16"))
+SERVER_QUEUE_SIZE = int(os.environ.get("SERVER_QUEUE_SIZE", "64"))
+# secondi massimi di attesa in coda prima di rispondere 503
+SERVER_QUEUE_TIMEOUT = float(os.environ.get("SERVER_QUEUE_TIMEOUT", "2"))
+# secondi massimi di inattivita' dopo cui una connessione keep-alive libera il worker
+SERVER_KEEPALIVE_TIMEOUT = float(os.environ.get("SERVER_KEEPALIVE_TIMEOUT", "5"))
+# valore dell'header Retry-After delle risposte 503
+SERVER_RETRY_AFTER = int(os.environ.get("SERVER_RETRY_AFTER", "1"))
+
+# cache in memoria dei file statici del frontend
+static_assets = AssetCache(os.path.join(os.getcwd(), "frontend"))
+register_metrics("static_assets", static_assets.stats)
+
+logger = get_logger("server")
+access_logger = get_logger("access")
 
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
     """Server HTTP che supporta il multi-threading."""
     # quando il server è terminato chiude i thread 
     daemon_threads = True
 
+class PooledHTTPServer(HTTPServer):
+    """
+    Server HTTP con un numero fisso di worker e una coda di connessioni limitata.
+    Se la coda è piena, o una connessione vi resta oltre queue_timeout secondi,
+    il client riceve subito 503 con Retry-After invece di accodare altro lavoro:
+    la scadenza viene controllata dal thread di accept, a ogni nuova connessione
+    e a ogni ciclo di serve_forever, senza attendere che un worker si liberi.
+    Con connessioni in coda, i worker fermi su una connessione keep-alive
+    inattiva la chiudono per servire quelle in attesa. Il timeout keepalive_timeout
+    vale per l'attesa e la lettura delle richieste, non per l'invio delle risposte.
+    """
+
+    def __init__(self, server_address, handler_class,
+                 workers=SERVER_WORKERS,
+                 queue_size=SERVER_QUEUE_SIZE,
+                 queue_timeout=SERVER_QUEUE_TIMEOUT,
+                 keepalive_timeout=SERVER_KEEPALIVE_TIMEOUT):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.keepalive_timeout = keepalive_timeout
+        # (socket, indirizzo, istante di accodamento), in ordine di arrivo
+        self._pending = collections.deque()
+        # socket delle connessioni keep-alive in attesa della richiesta successiva
+        self._idle = set()
+        # worker liberati da _reclaim_idle che non hanno ancora preso una connessione
+        self._freeing = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._stopping = False
+        self._busy = 0
+        self._processed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._reclaimed = 0
+        self._max_wait = 0.0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def serve_forever(self, poll_interval=0.1):
+        """Come HTTPServer.serve_forever, con un ciclo più frequente per la scadenza della coda."""
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        """Accoda la connessione accettata, o la rifiuta se la coda è piena."""
+        now = time.monotonic()
+        with self._lock:
+            expired = self._expire_pending(now)
+            accepted = len(self._pending) < self.queue_size
+            if accepted:
+                self._pending.append((request, client_address, now))
+                self._available.notify()
+            else:
+                self._rejected += 1
+        for stale in expired:
+            self._reject(stale)
+        if not accepted:
+            self._reject(request)
+        self._reclaim_idle()
+
+    def service_actions(self):
+        """Chiamata dal ciclo di serve_forever: rifiuta le connessioni scadute in coda."""
+        with self._lock:
+            expired = self._expire_pending(time.monotonic())
+        for stale in expired:
+            self._reject(stale)
+        self._reclaim_idle()
+
+    def _expire_pending(self, now):
+        """Rimuove dalla coda le connessioni in attesa da oltre queue_timeout (con _lock acquisito)."""
+        expired = []
+        while self._pending and now - self._pending[0][2] > self.queue_timeout:
+            expired.append(self._pending.popleft()[0])
+        self._expired += len(expired)
+        return expired
+
+    def _reclaim_idle(self):
+        """
+        Con connessioni in coda chiude in lettura le connessioni keep-alive inattive:
+        il worker che le attende riceve EOF e passa alla coda.
+        """
+        with self._lock:
+            # un worker liberato per ogni connessione in coda
+            wanted = min(len(self._idle), len(self._pending) - self._freeing)
+            if wanted <= 0:
+                return
+            # le connessioni su cui è appena arrivata una richiesta non vengono chiuse:
+            # il worker la sta per leggere (connection_active)
+            with selectors.DefaultSelector() as selector:
+                for connection in self._idle:
+                    selector.register(connection, selectors.EVENT_READ)
+                readable = {key.fileobj for key, _ in selector.select(0)}
+            for connection in [connection for connection in self._idle if connection not in readable][:wanted]:
+                self._idle.discard(connection)
+                self._reclaimed += 1
+                self._freeing += 1
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+    def connection_idle(self, connection):
+        """
+        Chiamata dall'handler prima di attendere la richiesta successiva su una
+        connessione keep-alive. Ritorna False se la connessione va chiusa subito
+        perché altre connessioni attendono un worker.
+        """
+        with self._lock:
+            if self._pending:
+                self._reclaimed += 1
+                return False
+            self._idle.add(connection)
+            return True
+
+    def connection_active(self, connection):
+        """
+        Chiamata dall'handler quando sulla connessione arrivano i dati della richiesta
+        successiva, prima di leggerla: da qui la connessione non può essere chiusa.
+        """
+        with self._lock:
+            self._idle.discard(connection)
+
+    def response_started(self, connection):
+        """
+        Chiamata dall'handler all'inizio della risposta: la richiesta è stata letta e
+        l'invio (es. un export in streaming verso un client lento) non ha timeout.
+        """
+        connection.settimeout(None)
+
+    def _worker(self):
+        """Ciclo di un worker: serve le connessioni in coda finché il server è attivo."""
+        while True:
+            with self._available:
+                while not self._pending and not self._stopping:
+                    self._available.wait()
+                if not self._pending:
+                    break
+                request, client_address, enqueued_at = self._pending.popleft()
+                self._freeing = max(0, self._freeing - 1)
+                waited = time.monotonic() - enqueued_at
+                expired = waited > self.queue_timeout
+                if expired:
+                    self._expired += 1
+                else:
+                    self._busy += 1
+                    self._max_wait = max(self._max_wait, waited)
+            if expired:
+                self._reject(request)
+                continue
+
+            try:
+                # limite massimo di inattività di una connessione keep-alive
+                request.settimeout(self.keepalive_timeout)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.connection_active(request)
+                self.shutdown_request(request)
+                with self._lock:
+                    self._busy -= 1
+                    self._processed += 1
+
+    def _reject(self, request):
+        """Risponde 503 con Retry-After e chiude la connessione."""
+        body = json.dumps({"error": "Server sovraccarico, riprovare più tardi"}).encode("utf-8")
+        response = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            f"Retry-After: {SERVER_RETRY_AFTER}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1") + body
+        try:
+            request.sendall(response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        """Chiude il socket e arresta i worker."""
+        super().server_close()
+        with self._available:
+            self._stopping = True
+            self._available.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=self.keepalive_timeout)
+
+    def stats(self):
+        """Ritorna l'utilizzo del pool di worker e della coda."""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "busy": self._busy,
+                "utilisation": round(self._busy / self.workers, 3),
+                "queued": len(self._pending),
+                "queue_size": self.queue_size,
+                "idle_keepalive": len(self._idle),
+                "processed": self._processed,
+                "rejected": self._rejected,
+                "expired": self._expired,
+                "reclaimed_keepalive": self._reclaimed,
+                "max_queue_wait": round(self._max_wait, 3),
+            }
+
 class MyHandler(BaseHTTPRequestHandler):
     server_version = "CustomHTTPServer"
     sys_version = ""
     protocol_version = "HTTP/1.1"
 
+    def handle(self):
+        """
+        Come BaseHTTPRequestHandler.handle: serve le richieste della connessione
+        finché resta aperta. Con il server a worker fissi, prima di attendere la
+        richiesta successiva verifica che nessun'altra connessione sia in coda.
+        """
+        connection_idle = getattr(self.server, "connection_idle", None)
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if connection_idle is not None:
+                if not connection_idle(self.connection):
+                    break
+                try:
+                    self.connection.settimeout(self.server.keepalive_timeout)
+                    # attende la richiesta successiva senza leggerla: finché non arriva
+                    # la connessione può essere chiusa per servire quelle in coda
+                    arrived = self.rfile.peek(1)
+                except OSError:
+                    arrived = b""
+                self.server.connection_active(self.connection)
+                if not arrived:
+                    break
+            self.handle_one_request()
+
+    def parse_request(self):
+        """Come BaseHTTPRequestHandler.parse_request, e assegna l'id di correlazione alla richiesta."""
+        self.request_started_at = time.perf_counter()
+        # la codifica viene negoziata dal middleware delle rotte API
+        self.response_encoding = None
+        parsed = super().parse_request()
+        start_request(self.headers if parsed else None)
+        return parsed
+
+    def send_response(self, code, message=None):
+        """
+        Come BaseHTTPRequestHandler.send_response, ma ricorda che la risposta è iniziata
+        e rimanda al client l'id di correlazione nell'header X-Request-ID.
+        """
+        self.response_started = True
+        response_started = getattr(self.server, "response_started", None)
+        if response_started is not None:
+            response_started(self.connection)
+        super().send_response(code, message)
+        request_id = current_request_id()
+        if request_id:
+            self.send_header("X-Request-ID", request_id)
+
+    def log_request(self, code="-", size="-"):
+        """Registra la richiesta nel log di accesso, con stato e durata."""
+        started_at = getattr(self, "request_started_at", None)
+        access_logger.info("%s %s %s", self.command, self.path, getattr(code, "value", code), extra={
+            "client": self.client_address[0],
+            "status": getattr(code, "value", code),
+            "duration_ms": round((time.perf_counter() - started_at) * 1000, 2) if started_at else None,
+        })
+
+    def log_error(self, format, *args):
+        """Errori di protocollo di BaseHTTPRequestHandler (richieste malformate, timeout)."""
+        logger.warning(format, *args, extra={"client": self.client_address[0]})
+
+    def log_message(self, format, *args):
+        logger.info(format, *args, extra={"client": self.client_address[0]})
+
     def do_OPTIONS(self):
         """Gestisce le richieste OPTIONS. 
         Utilizzato per la preflight CORS."""
@@ -32,65 +338,43 @@ class MyHandler(BaseHTTPRequestHandler):
             route_request(self, "GET")
 
     def serve_static_file(self):
-        """Serve i file statici dalla cartella 'frontend'."""
-        # costruisce il percorso per recuperare il file richiesto
-        base_path = os.path.join(os.getcwd(), "frontend")
-        requested_path = self.path.lstrip("/") 
-
-        # log per debug
-        print(f"Richiesta file statico: {requested_path}")
+        """Serve i file statici della cartella 'frontend' dalla cache in memoria."""
+        requested_path = urlparse(self.path).path.lstrip("/")
 
         # restituisce l'index.html di default se viene richiesta la root
         if not requested_path or requested_path.endswith("/"):
             requested_path = os.path.join(requested_path, "index.html")
 
-        # costruisce il percorso completo del file
-        file_path = os.path.join(base_path, requested_path)
-        print(f"Percorso completo: {file_path}")
+        try:
+            asset = static_assets.get(requested_path)
+        except Exception:
+            logger.exception("Errore durante il caricamento del file statico: %s", requested_path)
+            error_response = json.dumps({"error": "Errore interno del server"}).encode("utf-8")
+            set_headers(self, 500, error_response)
+            return
 
-        # verifica se il file esiste
-        if os.path.isfile(file_path):
-            try:
-                self._read_and_send_file(file_path)
-            except Exception as e:
-                print(f"Errore durante il caricamento del file statico: {e}")
-                error_response = json.dumps({"error": "Errore interno del server"}).encode("utf-8")
-                set_headers(self, 500, error_response )
-                self.wfile.write(error_response)
-        else:
-            print(f"File non trovato: {file_path}")
+        if asset is None:
             error_response = json.dumps({"error": "File non trovato"}).encode("utf-8")
             set_headers(self, 404, error_response )
-            # todo: inserire nel metodo set_headers self.wfile.write(***) visto che passo il parametro response_data
-            self.wfile.write(error_response)
-
-    def _read_and_send_file(self, file_path):
-        """Serve un singolo file statico."""
-        with open(file_path, "rb") as f:
-            file_content = f.read()
-
-        content_type = self._get_content_type(file_path)
-        set_headers(self, 200, file_content,content_type)
-        self.wfile.write(file_content);
-        print(f"File statico servito: {file_path}")
-
-    def _get_content_type(self, file_path):
-        """restituisce in base all'estensione del file il Content-Type."""
-        if file_path.endswith(".html"):
-            return "text/html"
-        elif file_path.endswith(".css"):
-            return "text/css"
-        elif file_path.endswith(".js"):
-            return "application/javascript"
-        elif file_path.endswith(".png"):
-            return "image/png"
-        elif file_path.endswith(".jpg") or file_path.endswith(".jpeg"):
-            return "image/jpeg"
-        elif file_path.endswith(".gif"):
-            return "image/gif"
-        elif file_path.endswith(".ico"):
-            return "image/x-icon"
-        return "application/octet-stream"
+            return
+
+        # sceglie la variante (br, gzip o non compressa) accettata dal client
+        content, headers = asset.select_variant(self.headers.get("Accept-Encoding"))
+        if asset.is_not_modified(self.headers, headers["ETag"]):
+            self._send_not_modified(headers)
+        else:
+            self._send_asset(asset, content, headers)
+
+    def _send_asset(self, asset, content, headers):
+        """Serve un singolo file statico dalla cache."""
+        set_headers(self, 200, content, asset.content_type, extra_headers=headers)
+
+    def _send_not_modified(self, headers):
+        """Risponde 304: la copia in cache del browser e' ancora valida."""
+        self.send_response(304)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
 
     def do_POST(self):
         """Gestisce le richieste POST."""
@@ -104,20 +388,42 @@ class MyHandler(BaseHTTPRequestHandler):
         """Gestisce le richieste DELETE."""
         route_request(self, "DELETE")
 
-def run_server(port=8000):
-    """Avvia il server multi-threaded."""
+def run_server(port=8000, engine=SERVER_ENGINE):
+    """Avvia il server con il motore indicato ("threading", "pool" o "asyncio")."""
+    setup_logging()
     init_db()
+    check_db_settings()
+    check_token_keys()
+    logger.info("File statici caricati in memoria: %s", static_assets.preload())
+    session_reaper.start()
     server_address = ("0.0.0.0", port)
-    httpd = ThreadingHTTPServer(server_address, MyHandler)
-    print(f"Server multi-threaded in esecuzione sulla porta {port}...")
+    if engine == "asyncio":
+        from async_server import AsyncHTTPServer
+        httpd = AsyncHTTPServer(server_address, MyHandler)
+        register_metrics("server", httpd.stats)
+        logger.info("Server asyncio in esecuzione sulla porta %s", port)
+    elif engine == "pool":
+        httpd = PooledHTTPServer(server_address, MyHandler)
+        register_metrics("server", httpd.stats)
+        logger.info("Server con %s worker in esecuzione sulla porta %s", httpd.workers, port)
+    else:
+        httpd = ThreadingHTTPServer(server_address, MyHandler)
+        logger.info("Server multi-threaded in esecuzione sulla porta %s", port)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
-        print("\nRicevuto Ctrl + C: chiusura del server...")
+        logger.info("Ricevuto Ctrl + C: chiusura del server")
     finally:
         httpd.shutdown()
         httpd.server_close()
-        print("Server terminato correttamente.")
+        session_reaper.stop()
+        close_pool()
+        logger.info("Server terminato correttamente")
+        shutdown_logging()
 
 if __name__ == "__main__":
-    run_server()
+    parser = argparse.ArgumentParser(description="Avvia il server HTTP")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--engine", choices=["threading", "pool", "asyncio"], default=SERVER_ENGINE)
+    args = parser.parse_args()
+    run_server(port=args.port, engine=args.engine)
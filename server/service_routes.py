@@ -1,34 +1,67 @@
+import itertools
 import json
 from db import get_connection
-from utility.utility import set_headers
+from utility.utility import (
+    cache_validator_headers,
+    parse_query,
+    send_json_rows,
+    send_not_modified,
+    set_headers,
+)
+from utility.booking_utility import AVAILABILITY_MAX_DAYS, available_services, service_calendar
+from utility.pagination import STREAM_FETCH_SIZE, QueryError, keyset_batches, parse_date_range, parse_int
+from utility.query_cache import query_cache
+from utility.versions import is_not_modified, record_write, row_etag, table_etag
+
+SERVICES_QUERY = """
+    SELECT id, name, description, capacity, price, active
+    FROM services
+"""
 
 def handle_get_all_services(handler):
     """
     GET /services - Ritorna tutti i servizi dal DB.
+    Se il catalogo non è cambiato dall'ETag indicato in If-None-Match risponde 304.
+    Un catalogo di al più STREAM_FETCH_SIZE servizi viene servito dalla cache delle
+    query, uno più grande viene letto a blocchi e inviato in streaming.
     """
+    etag = table_etag("services")
+    if is_not_modified(handler, etag, exists=True):
+        send_not_modified(handler, etag)
+        return
 
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT id, name, description, capacity, price, active
-            FROM services
-        """)
-        rows = c.fetchall()
-
-    results = []
-    for row in rows:
-        results.append({
-            "id": row["id"],
-            "name": row["name"],
-            "description": row["description"],
-            "capacity": row["capacity"],
-            "price": row["price"],
-            "active": bool(row["active"])
-        })
-
-    response_data = json.dumps(results).encode("utf-8")
-    set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
+    key = (SERVICES_QUERY, ())
+    cached = query_cache.get(key) if query_cache.enabled else None
+    if cached is not None:
+        set_headers(handler, 200, cached[0], extra_headers=cache_validator_headers(etag))
+        return
+
+    # generazione letta prima della query: un catalogo modificato nel frattempo non va in cache
+    generation = query_cache.generation(("services",))
+    batches = keyset_batches(SERVICES_QUERY, [], [], "id", "id", False, lambda row: (row["id"], row["id"]))
+    first = next(batches, [])
+    if len(first) < STREAM_FETCH_SIZE:
+        # il catalogo sta in un solo blocco: resta in cache fino alla prossima scrittura su services
+        response_data = json.dumps([_serialize_service(row) for row in first]).encode("utf-8")
+        if query_cache.enabled:
+            query_cache.put(key, (response_data, {}), ("services",), generation)
+        set_headers(handler, 200, response_data, extra_headers=cache_validator_headers(etag))
+        return
+
+    # catalogo più grande di un blocco: inviato in streaming come le liste complete, senza cache
+    send_json_rows(handler, itertools.chain([first], batches), _serialize_service,
+        extra_headers=cache_validator_headers(etag))
+
+def _serialize_service(row):
+    """Converte una riga della tabella services in dizionario."""
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "description": row["description"],
+        "capacity": row["capacity"],
+        "price": row["price"],
+        "active": bool(row["active"])
+    }
 
 def handle_get_service_by_id(handler, service_id):
     """
@@ -39,7 +72,11 @@ def handle_get_service_by_id(handler, service_id):
     except ValueError:
         error_response = json.dumps({"error": "Invalid ID"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
+        return
+
+    etag = row_etag("services", service_id)
+    if is_not_modified(handler, etag):
+        send_not_modified(handler, etag)
         return
 
     with get_connection() as conn:
@@ -61,12 +98,54 @@ def handle_get_service_by_id(handler, service_id):
             "active": bool(row[5])
         }
         response_data = json.dumps(result).encode("utf-8")
-        set_headers(handler, 200, response_data)
-        handler.wfile.write(response_data)
+        set_headers(handler, 200, response_data, extra_headers=cache_validator_headers(etag))
     else:
         error_response = json.dumps({"error": "Service not found"}).encode("utf-8")
         set_headers(handler, 404, error_response)
-        handler.wfile.write(error_response)
+
+def handle_get_service_availability(handler, service_id):
+    """
+    GET /services/<id>/availability - Posti disponibili per giorno nel periodo.
+    Parametri di query opzionali: from (default oggi), to (default from + 29 giorni).
+    """
+    service_id = int(service_id)
+    try:
+        start_date, end_date = parse_date_range(parse_query(handler.path), AVAILABILITY_MAX_DAYS)
+    except QueryError as e:
+        error_response = json.dumps({"error": str(e)}).encode("utf-8")
+        set_headers(handler, 400, error_response)
+        return
+
+    calendar = service_calendar(service_id, start_date, end_date)
+    if calendar is None:
+        error_response = json.dumps({"error": "Service not found"}).encode("utf-8")
+        set_headers(handler, 404, error_response)
+        return
+    response_data = json.dumps(calendar).encode("utf-8")
+    set_headers(handler, 200, response_data)
+
+def handle_get_available_services(handler):
+    """
+    GET /services/available - Servizi attivi prenotabili per l'intero periodo.
+    Parametri di query: from (default oggi), to (default from), capacity (posti
+    richiesti, default 1). Ogni servizio include i posti liberi e il prezzo totale.
+    """
+    query = parse_query(handler.path)
+    try:
+        start_date, end_date = parse_date_range(query, AVAILABILITY_MAX_DAYS, default_days=1)
+        capacity_requested = parse_int(query, "capacity")
+        if capacity_requested is None:
+            capacity_requested = 1
+        if capacity_requested < 1:
+            raise QueryError("Parametro capacity non valido")
+    except QueryError as e:
+        error_response = json.dumps({"error": str(e)}).encode("utf-8")
+        set_headers(handler, 400, error_response)
+        return
+
+    services = available_services(start_date, end_date, capacity_requested)
+    response_data = json.dumps(services).encode("utf-8")
+    set_headers(handler, 200, response_data)
 
 def handle_create_service(handler):
     """
@@ -81,7 +160,6 @@ def handle_create_service(handler):
     except json.JSONDecodeError:
         error_response = json.dumps({"error": "Invalid JSON"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     name = data.get("name", "")
@@ -100,6 +178,7 @@ def handle_create_service(handler):
         """, (name, description, capacity, price, active))
         conn.commit()
         new_id = c.lastrowid
+    record_write("services", created=True)
 
     new_service = {
         "id": new_id,
@@ -112,7 +191,6 @@ def handle_create_service(handler):
     response_data = json.dumps(new_service).encode("utf-8")
 
     set_headers(handler, 201, response_data)
-    handler.wfile.write(response_data)
 
 def handle_update_service(handler, service_id):
     """
@@ -123,7 +201,6 @@ def handle_update_service(handler, service_id):
     except ValueError:
         error_response = json.dumps({"error": "Invalid ID"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     content_length = int(handler.headers.get("Content-Length", 0))
@@ -134,7 +211,6 @@ def handle_update_service(handler, service_id):
     except json.JSONDecodeError:
         error_response = json.dumps({"error": "Invalid JSON"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     name = data.get("name", None)
@@ -155,7 +231,6 @@ def handle_update_service(handler, service_id):
         if not row:
             error_response = json.dumps({"error": "Service not found"}).encode("utf-8")
             set_headers(handler, 404, error_response)
-            handler.wfile.write(error_response)
             return
 
         existing_id, existing_name, existing_desc, existing_cap, existing_price, existing_active = row
@@ -172,6 +247,7 @@ def handle_update_service(handler, service_id):
             WHERE id = ?
         """, (updated_name, updated_desc, updated_cap, updated_price, updated_active, service_id))
         conn.commit()
+    record_write("services", service_id)
 
     updated_service = {
         "id": service_id,
@@ -183,7 +259,6 @@ def handle_update_service(handler, service_id):
     }
     response_data = json.dumps(updated_service).encode("utf-8")
     set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
 
 def handle_delete_service(handler, service_id):
     """
@@ -194,7 +269,6 @@ def handle_delete_service(handler, service_id):
     except ValueError:
         error_response = json.dumps({"error": "Invalid ID"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     with get_connection() as conn:
@@ -205,14 +279,13 @@ def handle_delete_service(handler, service_id):
         if not row:
             error_response = json.dumps({"error": "Service not found"}).encode("utf-8")
             set_headers(handler, 404, error_response)
-            handler.wfile.write(error_response)
             return
 
         # procediamo con la delete del servizio
         c.execute("DELETE FROM services WHERE id = ?", (service_id,))
         conn.commit()
+    record_write("services", service_id)
 
     response_data = json.dumps({"message": f"Service {service_id} deleted"}).encode("utf-8")
     set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
 
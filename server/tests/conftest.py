@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+
+# i moduli del server si importano dalla cartella server (es. "from db import ...")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# il database viene creato nella cartella corrente: i test usano una cartella temporanea
+os.chdir(tempfile.mkdtemp(prefix="booking-tests-"))
+# hash bcrypt veloci: il cost factor non cambia il comportamento verificato
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import db  # noqa: E402
+
+db.init_db()
+
+
+@pytest.fixture
+def service():
+    """Servizio nuovo con capacità 2 e prezzo 10, senza prenotazioni."""
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO services (name, description, capacity, price, active)
+            VALUES ('Servizio di test', '', 2, 10, 1)
+        """)
+        service_id = c.lastrowid
+        conn.commit()
+    return service_id
+
+@pytest.fixture
+def admin():
+    """Utente amministratore creato da init_db."""
+    with db.get_connection() as conn:
+        row = conn.execute("SELECT id, role FROM users WHERE username = 'admin'").fetchone()
+    return {"id": row["id"], "role": row["role"]}
+
+def future_day(days):
+    """Data (YYYY-MM-DD) a days giorni da oggi."""
+    return (date.today() + timedelta(days=days)).isoformat()
@@ -0,0 +1,19 @@
+import time
+
+from utility.passwords import check_password, password_hash_stats, rehash_in_background
+
+
+def test_background_rehash_is_counted_in_the_executor_metrics():
+    saved = []
+    before = password_hash_stats()
+    rehash_in_background("segreta", saved.append)
+
+    # il contatore viene aggiornato dal worker alla fine del rehash
+    deadline = time.monotonic() + 10
+    while password_hash_stats()["completed"] == before["completed"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    after = password_hash_stats()
+    assert after["completed"] - before["completed"] == 1
+    assert after["rehashed"] - before["rehashed"] == 1
+    assert check_password("segreta", saved[0])
@@ -0,0 +1,78 @@
+import time
+
+from db import get_connection
+from utility.query_cache import ALL_TABLES, QueryCache, query_cache, written_tables
+
+
+def cache_response(sql, tables):
+    """Inserisce in query_cache una risposta fittizia per sql e ritorna la chiave."""
+    query_cache.cached(sql, (), tables, lambda: (b"[]", {}))
+    key = (sql, ())
+    assert query_cache.get(key) is not None
+    return key
+
+
+def test_written_tables_classifies_reads_and_writes():
+    assert written_tables("SELECT * FROM bookings") == frozenset()
+    assert written_tables("-- lista\n/* servizi */ SELECT * FROM services") == frozenset()
+    assert written_tables("WITH recenti AS (SELECT id FROM bookings) SELECT * FROM recenti") == frozenset()
+    assert written_tables("WITH vecchie AS (SELECT id FROM sessions) DELETE FROM sessions WHERE id IN vecchie") \
+        == frozenset({"sessions"})
+    assert written_tables("INSERT OR REPLACE INTO service_day_occupancy VALUES (1, '2030-01-01', 1)") \
+        == frozenset({"service_day_occupancy"})
+    assert written_tables("/* prezzo */ UPDATE services SET price = 1") == frozenset({"services"})
+    assert written_tables("DROP INDEX idx") == frozenset({ALL_TABLES})
+
+def test_commit_invalidates_only_the_tables_written(service):
+    services_key = cache_response("SELECT * FROM services -- test commit", ("services",))
+    users_key = cache_response("SELECT * FROM users -- test commit", ("users",))
+
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("UPDATE services SET price = 11 WHERE id = ?", (service,))
+        # prima del commit la scrittura non è visibile agli altri: la voce resta valida
+        assert query_cache.get(services_key) is not None
+        conn.commit()
+
+    assert query_cache.get(services_key) is None
+    assert query_cache.get(users_key) is not None
+
+def test_rollback_keeps_cached_entries(service):
+    key = cache_response("SELECT * FROM services -- test rollback", ("services",))
+
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("UPDATE services SET price = 12 WHERE id = ?", (service,))
+        conn.rollback()
+
+    assert query_cache.get(key) is not None
+
+def test_cascade_deletes_invalidate_child_tables(service):
+    key = cache_response("SELECT * FROM service_day_occupancy -- test cascade", ("service_day_occupancy",))
+
+    with get_connection() as conn:
+        conn.execute("DELETE FROM services WHERE id = ?", (service,))
+        conn.commit()
+
+    assert query_cache.get(key) is None
+
+def test_response_built_before_an_invalidation_is_not_stored():
+    cache = QueryCache(max_bytes=1 << 20)
+
+    def build():
+        # scrittura confermata mentre la query è in esecuzione
+        cache.invalidate(("services",))
+        return b"[]", {}
+
+    cache.cached("SELECT * FROM services", (), ("services",), build)
+    assert cache.get(("SELECT * FROM services", ())) is None
+    assert cache.stats()["skipped"] == 1
+
+def test_entries_expire_after_the_ttl():
+    cache = QueryCache(max_bytes=1 << 20, ttl=0.05)
+    cache.cached("SELECT * FROM services", (), ("services",), lambda: (b"[]", {}))
+    assert cache.get(("SELECT * FROM services", ())) is not None
+
+    time.sleep(0.1)
+    assert cache.get(("SELECT * FROM services", ())) is None
+    assert cache.stats()["expired"] == 1
@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+
+from conftest import future_day
+from db import configure_pool, get_connection
+from utility.booking_utility import (
+    ReservationError,
+    create_reservation,
+    create_reservations,
+    delete_reservation,
+    update_reservation,
+)
+
+
+def booked(service_id):
+    """Prenotazioni del servizio: id -> (start_date, end_date, capacity_requested)."""
+    with get_connection() as conn:
+        rows = conn.execute("""
+            SELECT id, start_date, end_date, capacity_requested FROM bookings WHERE service_id = ?
+        """, (service_id,)).fetchall()
+    return {row["id"]: (row["start_date"], row["end_date"], row["capacity_requested"]) for row in rows}
+
+def occupancy(service_id):
+    """Indice di occupazione del servizio: giorno -> posti prenotati."""
+    with get_connection() as conn:
+        rows = conn.execute("""
+            SELECT day, booked FROM service_day_occupancy WHERE service_id = ? AND booked > 0
+        """, (service_id,)).fetchall()
+    return {row["day"]: row["booked"] for row in rows}
+
+
+def test_create_reservation_rejects_overbooking(service, admin):
+    start = date.fromisoformat(future_day(10))
+    end = date.fromisoformat(future_day(11))
+    first = create_reservation(admin["id"], service, start, end, capacity_requested=2)
+    assert first["total_price"] == 40
+
+    with pytest.raises(ReservationError) as error:
+        create_reservation(admin["id"], service, end, end)
+    assert error.value.code == 400
+    assert list(booked(service)) == [first["id"]]
+    assert occupancy(service) == {future_day(10): 2, future_day(11): 2}
+
+def test_concurrent_reservations_do_not_exceed_capacity(service, admin):
+    day = date.fromisoformat(future_day(20))
+
+    def reserve(_):
+        try:
+            return create_reservation(admin["id"], service, day, day)
+        except ReservationError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(reserve, range(8)))
+
+    created = [result for result in results if result is not None]
+    assert len(created) == 2
+    assert sorted(booked(service)) == sorted(result["id"] for result in created)
+    assert occupancy(service) == {future_day(20): 2}
+
+def test_concurrent_updates_and_creations_do_not_deadlock(service, admin):
+    day = date.fromisoformat(future_day(25))
+    booking = create_reservation(admin["id"], service, day, day)
+
+    def update(attempt):
+        try:
+            update_reservation(booking["id"], {"capacity_requested": 1 + attempt % 2}, admin)
+        except ReservationError:
+            pass
+
+    def reserve(_):
+        try:
+            create_reservation(admin["id"], service, day, day)
+        except ReservationError:
+            pass
+
+    # pool più piccolo dei thread: con i lock acquisiti dopo la connessione
+    # gli aggiornamenti occuperebbero il pool e le richieste andrebbero in timeout
+    configure_pool(size=2, timeout=2)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(update if attempt % 2 else reserve, attempt) for attempt in range(16)]
+            for future in futures:
+                future.result()
+    finally:
+        configure_pool()
+
+    total = sum(capacity for _, _, capacity in booked(service).values())
+    assert total <= 2
+    assert occupancy(service) == {future_day(25): total}
+
+def test_delete_frees_the_booked_days_once(service, admin):
+    start = date.fromisoformat(future_day(26))
+    end = date.fromisoformat(future_day(27))
+    kept = create_reservation(admin["id"], service, start, start)
+    deleted = create_reservation(admin["id"], service, start, end)
+
+    delete_reservation(deleted["id"], admin)
+    assert occupancy(service) == {future_day(26): 1}
+
+    with pytest.raises(ReservationError) as error:
+        delete_reservation(deleted["id"], admin)
+    assert error.value.code == 404
+    assert list(booked(service)) == [kept["id"]]
+    assert occupancy(service) == {future_day(26): 1}
+
+def test_concurrent_deletes_free_the_booked_days_once(service, admin):
+    day = date.fromisoformat(future_day(28))
+    create_reservation(admin["id"], service, day, day)
+    booking = create_reservation(admin["id"], service, day, day)
+
+    def delete(_):
+        try:
+            delete_reservation(booking["id"], admin)
+            return 200
+        except ReservationError as e:
+            return e.code
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        codes = list(executor.map(delete, range(8)))
+
+    assert sorted(codes) == [200] + [404] * 7
+    assert occupancy(service) == {future_day(28): 1}
+
+def test_batch_counts_earlier_items_against_capacity(service, admin):
+    items = [
+        {"service_id": service, "start_date": future_day(30), "end_date": future_day(31)},
+        {"service_id": service, "start_date": future_day(31), "end_date": future_day(32)},
+        {"service_id": service, "start_date": future_day(31), "end_date": future_day(31)},
+    ]
+    results = create_reservations(items, admin, atomic=False)
+
+    assert [result["status"] for result in results] == [201, 201, 400]
+    assert occupancy(service) == {future_day(30): 1, future_day(31): 2, future_day(32): 1}
+
+def test_atomic_batch_is_rolled_back_when_an_item_fails(service, admin):
+    items = [
+        {"service_id": service, "start_date": future_day(40), "end_date": future_day(40)},
+        {"service_id": service, "start_date": future_day(41), "end_date": future_day(41), "capacity_requested": 3},
+        {"service_id": service, "start_date": "non-una-data", "end_date": future_day(41)},
+        {"service_id": service, "start_date": 20300101, "end_date": future_day(41)},
+    ]
+    results = create_reservations(items, admin, atomic=True)
+
+    assert [result["status"] for result in results] == [409, 400, 400, 400]
+    assert booked(service) == {}
+    assert occupancy(service) == {}
+
+def test_batch_returns_the_ids_of_the_inserted_rows(service, admin):
+    # un buco nella sequenza degli id non deve spostare gli id restituiti
+    create_reservation(admin["id"], service, date.fromisoformat(future_day(50)), date.fromisoformat(future_day(50)))
+    with get_connection() as conn:
+        conn.execute("DELETE FROM bookings WHERE id = (SELECT MAX(id) FROM bookings)")
+        conn.commit()
+
+    items = [
+        {"service_id": service, "start_date": future_day(60 + offset), "end_date": future_day(60 + offset),
+            "capacity_requested": 1 + offset % 2}
+        for offset in range(4)
+    ]
+    results = create_reservations(items, admin, atomic=False)
+
+    rows = booked(service)
+    assert len(rows) == 4
+    for result in results:
+        booking = result["booking"]
+        assert rows[booking["id"]] == (booking["start_date"], booking["end_date"], booking["capacity_requested"])
@@ -0,0 +1,24 @@
+import time
+
+from utility.session_token import issue_token, revoke_token, revoke_user, verify_token
+
+
+def test_revoke_user_rejects_only_tokens_issued_before_it():
+    before = issue_token(9001, "user")
+    time.sleep(0.002)
+    revoke_user(9001)
+    time.sleep(0.002)
+    # nuovo login nello stesso secondo della revoca
+    after = issue_token(9001, "user")
+
+    assert verify_token(before) is None
+    assert verify_token(after) == {"id": 9001, "role": "user"}
+
+def test_revoked_or_tampered_tokens_are_rejected():
+    token = issue_token(9002, "admin")
+    assert verify_token(token) == {"id": 9002, "role": "admin"}
+    assert verify_token(token[:-2] + ("AA" if not token.endswith("AA") else "BB")) is None
+
+    revoke_token(token)
+    assert verify_token(token) is None
+    assert verify_token(issue_token(9002, "admin")) is not None
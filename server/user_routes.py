@@ -2,9 +2,37 @@ import json
 import sqlite3
 from db import get_connection
 from utility.authentication import authenticate
-from utility.utility import set_headers
+from utility.utility import (
+    cache_validator_headers,
+    parse_query,
+    send_json_rows,
+    send_not_modified,
+    set_headers,
+)
+from utility.pagination import (
+    QueryError,
+    decode_cursor,
+    keyset_batches,
+    keyset_condition,
+    order_clause,
+    pagination_headers,
+    parse_limit,
+    parse_sort,
+    split_page,
+)
 from utility.session import create_session, delete_session
-import bcrypt
+from utility.session_token import SESSION_MODE, issue_token, revoke_token, revoke_user
+from utility.versions import is_not_modified, record_write, row_etag
+from utility.session_cache import invalidate_user
+from utility.logger import get_logger
+from utility.passwords import (
+    check_password,
+    hash_password,
+    needs_rehash,
+    rehash_in_background,
+)
+
+logger = get_logger("users")
 
 def handle_login(handler):
     """
@@ -12,19 +40,17 @@ def handle_login(handler):
     JSON: {"username":"...","password":"..."}
     Verifica l'utente e crea una sessione
     """
-    print("Ricevuta richiesta di login")
     try:
         content_length = int(handler.headers.get("Content-Length", 0))
         body = handler.rfile.read(content_length).decode("utf-8")
         data = json.loads(body)
         username = data["username"]
         password = data["password"]
-        print(f"Tentativo di login per l'utente: {username}")
+        logger.debug("Tentativo di login per l'utente: %s", username)
     except (ValueError, KeyError, json.JSONDecodeError):
-        print("Errore nel parsing della richiesta di login")
+        logger.debug("Errore nel parsing della richiesta di login")
         error_bytes = json.dumps({"error": "JSON non valido o campi mancanti"}).encode("utf-8")
         set_headers(handler, 400, error_bytes)
-        handler.wfile.write(error_bytes)
         return
 
     # ricerca dell'utente nel database
@@ -38,21 +64,26 @@ def handle_login(handler):
         row = c.fetchone()
 
     if row is None:
-        print(f"Utente non trovato: {username}")
+        logger.info("Login fallito, utente non trovato: %s", username)
         error_response = json.dumps({"error": "Utente inesistente"}).encode("utf-8")
         set_headers(handler, 401, error_response)
-        handler.wfile.write(error_response)
         return
 
     user_id, db_username, db_hashed_pw, email, role = row
-    print(f"Utente trovato: {db_username}, Ruolo: {role}")
 
-    # controllo per password, bcrypt.checkpw ritorna True se la password è corretta
-    if bcrypt.checkpw(password.encode("utf-8"), db_hashed_pw.encode("utf-8")):
-        print(f"Password corretta per l'utente: {username}")
+    # controllo per password, check_password ritorna True se la password è corretta
+    if check_password(password, db_hashed_pw):
+        # hash calcolato con un cost factor diverso da quello attuale: viene
+        # ricalcolato in background ora che la password in chiaro è disponibile
+        if needs_rehash(db_hashed_pw):
+            rehash_in_background(password, lambda new_hash: _save_password_hash(user_id, db_hashed_pw, new_hash))
         # password corretta, crea sessione nel database e la gestisce nel be
-        session_id = create_session(user_id)
-        print(f"Sessione creata: {session_id}")
+        # (in modalità token il cookie contiene direttamente il token firmato)
+        if SESSION_MODE == "token":
+            session_id = issue_token(user_id, role)
+        else:
+            session_id = create_session(user_id)
+        logger.info("Login effettuato", extra={"user_id": user_id, "role": role})
         
         user_obj = {
             "id": user_id,
@@ -73,12 +104,17 @@ def handle_login(handler):
         
         #tramite metodo set headers impostiamo header extra necessari per passare il session_id al fe
         set_headers(handler, 200, response_data, extra_headers=extra_headers)
-        handler.wfile.write(response_data)
     else:
-        print(f"Password errata per l'utente: {username}")
+        logger.info("Login fallito, password errata per l'utente: %s", username)
         error_response = json.dumps({"error": "Username o password errati"}).encode("utf-8")
         set_headers(handler, 401, error_response)
-        handler.wfile.write(error_response)
+
+def _save_password_hash(user_id, old_hash, new_hash):
+    """Sostituisce l'hash della password solo se nel frattempo non è stata cambiata."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?", (new_hash, user_id, old_hash))
+        conn.commit()
 
 def handle_logout(handler):
     """POST /logout - Elimina la sessione dell'utente."""
@@ -86,7 +122,6 @@ def handle_logout(handler):
     if not cookies:
         error_response = json.dumps({"error": "Nessuna sessione attiva"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     session_id = None
@@ -98,10 +133,12 @@ def handle_logout(handler):
     if not session_id:
         error_response = json.dumps({"error": "Nessuna sessione attiva"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
-    delete_session(session_id)
+    if SESSION_MODE == "token":
+        revoke_token(session_id)
+    else:
+        delete_session(session_id)
 
     # imposta il cookie di sessione come scaduto (normalmente si utilizza con la funzione logout)
     response_data = json.dumps({"message": "Logout effettuato con successo"}).encode("utf-8")
@@ -114,36 +151,89 @@ def handle_logout(handler):
         response_data=response_data,
         extra_headers=extra_headers
     )
-    handler.wfile.write(response_data)
+
+# campi ordinabili di GET /users -> colonna SQL
+USER_SORT_FIELDS = {
+    "id": "id",
+    "username": "username",
+}
 
 def handle_get_all_users(handler,authenticated_user):
-    """GET /users - Ritorna tutti gli utenti senza le password."""
+    """
+    GET /users - Ritorna tutti gli utenti senza le password.
+    Parametri di query opzionali:
+    - limit, cursor: paginazione keyset; il cursore della pagina successiva
+      è restituito nell'header X-Next-Cursor
+    - sort: id, username (prefisso "-" per l'ordine decrescente)
+    - role: filtro per ruolo; username: filtro per prefisso dello username
+    """
     # tramite autorizzazione, permette solo agli utenti con ruolo admin
     # di vedere tutti gli utenti
     if authenticated_user["role"] != "admin":
         error_response = json.dumps({"error": "Autorizzazione richiesta"}).encode("utf-8")
         set_headers(handler, 403, error_response)
-        handler.wfile.write(error_response)
         return
 
+    query = parse_query(handler.path)
+    try:
+        limit = parse_limit(query)
+        sort_field, sort_column, descending = parse_sort(query, USER_SORT_FIELDS)
+        cursor = decode_cursor(query.get("cursor"))
+    except QueryError as e:
+        error_response = json.dumps({"error": str(e)}).encode("utf-8")
+        set_headers(handler, 400, error_response)
+        return
+
+    conditions = []
+    params = []
+    if query.get("role"):
+        conditions.append("role = ?")
+        params.append(query["role"])
+    if query.get("username"):
+        # escape dei caratteri jolly di LIKE nel prefisso cercato
+        prefix = query["username"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append("username LIKE ? ESCAPE '\\'")
+        params.append(prefix + "%")
+    if cursor:
+        condition, cursor_params = keyset_condition(sort_column, "id", descending, cursor)
+        conditions.append(condition)
+        params.extend(cursor_params)
+
+    sql = "SELECT id, username, email, role FROM users"
+    if limit is None:
+        # lista completa: righe lette a blocchi e inviate in streaming
+        batches = keyset_batches(sql, conditions, params, sort_column, "id", descending,
+            lambda row: (row[sort_field], row["id"]))
+        send_json_rows(handler, batches, _serialize_user, extra_headers=pagination_headers(None))
+        return
+
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " " + order_clause(sort_column, "id", descending)
+    # una riga in piu' per sapere se esiste una pagina successiva
+    sql += " LIMIT ?"
+    params.append(limit + 1)
+
     with get_connection() as conn:
         c = conn.cursor()
-        c.execute("SELECT id, username, email, role FROM users")
-        rows = c.fetchall()
-    
-    results = []
-    for row in rows:
-        results.append({
-            "id": row["id"],
-            "username": row["username"],
-            "email": row["email"],
-            "role": row["role"]
-        })
+        c.execute(sql, params)
+        rows = c.fetchmany(limit + 1)
+
+    rows, next_cursor = split_page(rows, limit, sort_field)
+    results = [_serialize_user(row) for row in rows]
 
     response_data = json.dumps(results).encode("utf-8")
 
-    set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
+    set_headers(handler, 200, response_data, extra_headers=pagination_headers(next_cursor))
+
+def _serialize_user(row):
+    """Converte una riga della tabella users (senza password) in dizionario."""
+    return {
+        "id": row["id"],
+        "username": row["username"],
+        "email": row["email"],
+        "role": row["role"]
+    }
 
 def handle_get_user_by_id(handler, user_id):
     """GET /users/<id> - Ritorna il singolo utente se esiste."""
@@ -152,7 +242,6 @@ def handle_get_user_by_id(handler, user_id):
     except ValueError:
         error_response = json.dumps({"error": "ID non valido"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
     
     with get_connection() as conn:
@@ -170,35 +259,28 @@ def handle_get_user_by_id(handler, user_id):
         response_data = json.dumps(result).encode("utf-8")
 
         set_headers(handler, 200, response_data)
-        handler.wfile.write(response_data)
     else:
         error_response = json.dumps({"error": "User non trovato"}).encode("utf-8")
         set_headers(handler, 404, error_response)
-        handler.wfile.write(error_response)   
 
-def handle_get_current_user(handler):
+def handle_get_current_user(handler, authenticated_user):
     """
     GET /current-user
-    Ritorna i dettagli dell'utente autenticato in base al cookie session_id.
+    Ritorna i dettagli dell'utente autenticato (sessione gia' verificata dal middleware).
+    Se l'utente non è cambiato dall'ETag indicato in If-None-Match risponde 304.
     """
-    session_id = handler.headers.get("Cookie", "").split("session_id=")[-1].split(";")[0]
-    
-    if not session_id:
-        error_response = json.dumps({"error": "Sessione non trovata"}).encode("utf-8")
-        set_headers(handler, 401, error_response)
-        print("sessione non valida")
-        
-        handler.wfile.write(error_response)
+    etag = row_etag("users", authenticated_user["id"])
+    if is_not_modified(handler, etag):
+        send_not_modified(handler, etag)
         return
 
     with get_connection() as conn:
         c = conn.cursor()
         c.execute("""
-            SELECT u.id, u.username, u.email, u.role
-            FROM sessions s
-            JOIN users u ON s.user_id = u.id
-            WHERE s.session_id = ?
-        """, (session_id,))
+            SELECT id, username, email, role
+            FROM users
+            WHERE id = ?
+        """, (authenticated_user["id"],))
         user = c.fetchone()
 
     if user:
@@ -209,15 +291,11 @@ def handle_get_current_user(handler):
             "role": user["role"]
         }
         response_data = json.dumps(response).encode("utf-8")
-        print(response_data)
-        set_headers(handler, 200, response_data)
-        handler.wfile.write(response_data)
+        set_headers(handler, 200, response_data, extra_headers=cache_validator_headers(etag))
     else:
         error_response = json.dumps({"error": "Sessione non valida"}).encode("utf-8")
-        print("sessione non valida")
-        
+        logger.debug("Sessione non valida")
         set_headers(handler, 401, error_response)
-        handler.wfile.write(error_response)      
 
 def is_valid_password(password: str) -> bool:
     """
@@ -258,7 +336,6 @@ def handle_create_user(handler):
     except json.JSONDecodeError:
         error_response = json.dumps({"error": "JSON non valido"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     # dati utente
@@ -271,25 +348,22 @@ def handle_create_user(handler):
     if not username or not password or not email:
         error_response = json.dumps({"error": "Tutti i campi sono obbligatori"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     # validazione formato della email
     if "@" not in email or "." not in email or email.index("@") > email.rindex("."):
         error_response = json.dumps({"error": "Email non valida"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
     # validazione password
     if not is_valid_password(password):
         error_response = json.dumps({"error": "Password non valida la password deve avere la seguente froma:  almeno 8 caratteri, "
                 "almeno una lettera minuscola, almeno una lettera maiuscola, un numero e un carattere speciale."}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
     
-    # hashing della  password tramite l'utililizzo di bcrypt
-    hashed_pw = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    # hashing della  password tramite l'utililizzo di bcrypt (executor dedicato)
+    hashed_pw = hash_password(password)
 
     with get_connection() as conn:
         c = conn.cursor()
@@ -304,8 +378,8 @@ def handle_create_user(handler):
             # error per gestire violazioni UNIQUE su username o email
             error_response = json.dumps({"error": f"Violazione di unicità: {str(e)}"}).encode("utf-8")
             set_headers(handler, 400, error_response)
-            handler.wfile.write(error_response)
             return
+    record_write("users", created=True)
     
     new_user = {
         "id": new_id,
@@ -315,7 +389,6 @@ def handle_create_user(handler):
     response_data = json.dumps(new_user).encode("utf-8")
 
     set_headers(handler, 201, response_data)
-    handler.wfile.write(response_data)
 
 def handle_update_user(handler, user_id):
     """PUT /users/<id> - Aggiorna i campi di un utente (username, password, email)."""
@@ -324,7 +397,6 @@ def handle_update_user(handler, user_id):
     except ValueError:
         error_response = json.dumps({"error": "ID non valido"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
     
     content_length = int(handler.headers.get("Content-Length", 0))
@@ -335,7 +407,6 @@ def handle_update_user(handler, user_id):
     except json.JSONDecodeError:
         error_response = json.dumps({"error": "JSON non valido"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     # campi aggiornabili dell'user
@@ -344,6 +415,10 @@ def handle_update_user(handler, user_id):
     new_password = data.get("password", None)
     email = data.get("email", None)
 
+    # processo per la password qualora presente. viene hashata con bcrypt prima
+    # di prendere una connessione, per non occupare il pool durante l'hash
+    new_hashed_pw = hash_password(new_password) if new_password else None
+
     with get_connection() as conn:
         c = conn.cursor()
         # check per vedere se l'utente esiste nel db
@@ -352,7 +427,6 @@ def handle_update_user(handler, user_id):
         if not row:
             error_response = json.dumps({"error": "Utente non trovato"}).encode("utf-8")
             set_headers(handler, 404, error_response)
-            handler.wfile.write(error_response)
             return
 
         existing_id, existing_username, existing_hashed_pw, existing_email = row
@@ -361,12 +435,8 @@ def handle_update_user(handler, user_id):
         updated_username = username if username is not None else existing_username
         updated_email = email if email is not None else existing_email
 
-        # processo per la password qualora presente. viene hashata con bcrypt
-        # se non presente si mantiene la password esistente
-        if new_password is not None and len(new_password) > 0:
-            hashed_pw = bcrypt.hashpw(new_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-        else:
-            hashed_pw = existing_hashed_pw
+        # se la password non è presente si mantiene quella esistente
+        hashed_pw = new_hashed_pw if new_hashed_pw is not None else existing_hashed_pw
 
         # andiamo ad aggiornare il DB
         try:
@@ -380,9 +450,12 @@ def handle_update_user(handler, user_id):
             # gestiamo errori per violazioni di tipo UNIQUE su username o email
             error_response = json.dumps({"error": f"Violazione di unicità: {str(e)}"}).encode("utf-8")
             set_headers(handler, 400, error_response)
-            handler.wfile.write(error_response)
             return
 
+    # i dati dell'utente in cache per le sue sessioni non sono piu' validi
+    invalidate_user(user_id)
+    record_write("users", user_id)
+
     updated_user = {
         "id": user_id,
         "username": updated_username,
@@ -392,7 +465,6 @@ def handle_update_user(handler, user_id):
     }
     response_data = json.dumps(updated_user).encode("utf-8")
     set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
 
 def handle_delete_user(handler, user_id):
     """DELETE /users/<id> - Elimina l'utente dal DB."""
@@ -401,7 +473,6 @@ def handle_delete_user(handler, user_id):
     except ValueError:
         error_response = json.dumps({"error": "Invalid ID"}).encode("utf-8")
         set_headers(handler, 400, error_response)
-        handler.wfile.write(error_response)
         return
 
     with get_connection() as conn:
@@ -412,11 +483,13 @@ def handle_delete_user(handler, user_id):
         if not row:
             error_response = json.dumps({"error": "User not found"}).encode("utf-8")
             set_headers(handler, 404, error_response)
-            handler.wfile.write(error_response)
             return
 
         c.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
+    invalidate_user(user_id)
+    # i token gia' emessi restano validi fino alla scadenza: vanno revocati
+    revoke_user(user_id)
+    record_write("users", user_id)
     response_data = json.dumps({"message": f"User {user_id} deleted"}).encode("utf-8")
     set_headers(handler, 200, response_data)
-    handler.wfile.write(response_data)
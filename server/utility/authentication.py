@@ -1,37 +1,20 @@
 import json
-from db import get_connection
 from utility.utility import set_headers
-from utility.session import get_user_id_from_session
+from utility.session import get_session_id, get_session_user
+from utility.session_token import SESSION_MODE, verify_token
 
 
 def authenticate(handler):
-    """Verifica la sessione dell'utente."""
-    with get_connection() as conn:
-        c = conn.cursor()
-        cookies = handler.headers.get("Cookie")
-        if not cookies:
-            return None
-        session_id = None
-        for cookie in cookies.split(";"):
-            if "session_id=" in cookie:
-                session_id = cookie.strip().split("session_id=")[1]
-                break
-        if not session_id:
-            return None
-        user_id = get_user_id_from_session(session_id)
-        if not user_id:
-            return None
-        # recuprera i dettagli dell'utente tramite l'id della sessione sfruttando la relazione delle tabelle a db
-        c.execute("SELECT id, username, email, role FROM users WHERE id = ?", (user_id,))
-        row = c.fetchone()
-        if row:
-            return {
-                "id": row["id"],
-                "username": row["username"],
-                "email": row["email"],
-                "role": row["role"]
-            }
+    """
+    Verifica la sessione dell'utente e ne restituisce i dettagli (dalla cache se disponibili).
+    In modalità token la firma del cookie viene verificata senza accedere al db.
+    """
+    session_id = get_session_id(handler)
+    if not session_id:
         return None
+    if SESSION_MODE == "token":
+        return verify_token(session_id)
+    return get_session_user(session_id)
 
 def verify_authentication(handler):
     """
@@ -46,7 +29,6 @@ def verify_authentication(handler):
     if not authenticated_user:
         error_response = json.dumps({"error": "E' necessario autenticarsi!"}).encode("utf-8")
         set_headers(handler, 401, error_response)
-        handler.wfile.write(error_response)
         handler.close_connection = True
         return None
     
@@ -1,7 +1,32 @@
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import os
 import sqlite3
+import threading
 
 from db import get_connection
+from utility.metrics import register_metrics
+
+# numero di lock in cui vengono ripartiti i servizi: prenotazioni di servizi
+# diversi usano lock diversi (salvo collisioni) e procedono in parallelo
+RESERVATION_LOCK_STRIPES = int(os.environ.get("RESERVATION_LOCK_STRIPES", "64"))
+# ampiezza massima (giorni) del periodo delle ricerche di disponibilità
+AVAILABILITY_MAX_DAYS = int(os.environ.get("AVAILABILITY_MAX_DAYS", "731"))
+# numero massimo di prenotazioni in una singola richiesta POST /bookings/batch
+BOOKING_BATCH_MAX_SIZE = int(os.environ.get("BOOKING_BATCH_MAX_SIZE", "500"))
+
+_service_locks = tuple(threading.Lock() for _ in range(RESERVATION_LOCK_STRIPES))
+_stats_lock = threading.Lock()
+_stats = {"created": 0, "updated": 0, "deleted": 0, "rejected": 0, "lock_waits": 0, "batches": 0}
+
+
+class ReservationError(Exception):
+    """Prenotazione rifiutata: code e message vengono inviati al client."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
 
 
 def validate_booking_data(data):
@@ -26,66 +51,481 @@ def validate_booking_data(data):
         if start_date > end_date:
             return {"error": "La data di inizio deve essere precedente alla data di fine"}
         return {"start_date": start_date, "end_date": end_date}
-    except ValueError:
+    except (TypeError, ValueError):
+        # TypeError: date che non sono stringhe (es. numeri nel JSON)
         return {"error": "Formato data non valido. Utilizzare YYYY-MM-DD"}
 
 
-def get_service_capacity(service_id):
-    """Recupera la disponibilita'/capacita' del servizio dal database."""
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("SELECT capacity FROM services WHERE id = ?", (service_id,))
-        service_row = c.fetchone()
-        return service_row["capacity"] if service_row else None
+def booking_days(start_date, end_date):
+    """Ritorna la lista dei giorni (YYYY-MM-DD) occupati da una prenotazione, estremi inclusi."""
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
+    num_days = (end_date - start_date).days + 1
+    return [(start_date + timedelta(days=offset)).isoformat() for offset in range(num_days)]
 
-def check_availability(service_id, start_date, end_date, capacity_requested, service_capacity, exclude_booking_id=None):
-    """Verifica la disponibilità del servizio per il periodo selezionato, escludendo una prenotazione specifica se necessario."""
-    with get_connection() as conn:
-        c = conn.cursor()
+def update_occupancy(c, service_id, start_date, end_date, delta):
+    """
+    Aggiunge delta posti (negativo per liberarli) all'indice service_day_occupancy
+    per ogni giorno della prenotazione. Usa il cursore c, quindi la modifica fa
+    parte della stessa transazione della scrittura sulla tabella bookings.
+    """
+    days = booking_days(start_date, end_date)
+    add_occupancy(c, [(service_id, day, delta) for day in days])
+    if delta < 0:
+        # rimuove i giorni rimasti senza prenotazioni per mantenere l'indice compatto
+        c.execute("""
+            DELETE FROM service_day_occupancy
+            WHERE service_id = ? AND day BETWEEN ? AND ? AND booked <= 0
+        """, (service_id, days[0], days[-1]))
 
-        query = """
-            SELECT SUM(capacity_requested) as total_booked
-            FROM bookings
-            WHERE service_id = ? AND (
-                (start_date <= ? AND end_date > ?) OR
-                (start_date < ? AND end_date >= ?)
-            )
-        """
-        params = [service_id, end_date, start_date, end_date, start_date]
-
-        # viene aggiunta la verifica per escludere una prenotazione specifica
-        # se exclude_booking_id è valorizzato
-        if exclude_booking_id is not None:
-            query += " AND id != ?"
-            params.append(exclude_booking_id)
-
-        c.execute(query, params)
-        total_booked = c.fetchone()["total_booked"] or 0
-
-    return total_booked + capacity_requested <= service_capacity
-
-def save_booking(user_id, service_id, start_date, end_date, capacity_requested, status):
-    """Salva la prenotazione nel database e restituisce l'ID della nuova prenotazione."""
+def add_occupancy(c, rows):
+    """Somma all'indice service_day_occupancy le righe (service_id, giorno, posti)."""
+    c.executemany("""
+        INSERT INTO service_day_occupancy (service_id, day, booked)
+        VALUES (?, ?, ?)
+        ON CONFLICT (service_id, day) DO UPDATE SET booked = booked + excluded.booked
+    """, rows)
+
+@contextmanager
+def service_locks(*service_ids):
+    """
+    Acquisisce i lock dei servizi indicati, in ordine crescente di stripe per
+    evitare deadlock tra richieste che coinvolgono gli stessi servizi.
+    I lock vanno acquisiti prima di BEGIN IMMEDIATE: chi attende un servizio
+    occupato si mette in coda qui invece di ripetere il busy_timeout di SQLite.
+    """
+    stripes = sorted({service_id % len(_service_locks) for service_id in service_ids})
+    acquired = []
     try:
-        with get_connection() as conn:
+        for stripe in stripes:
+            lock = _service_locks[stripe]
+            if not lock.acquire(blocking=False):
+                with _stats_lock:
+                    _stats["lock_waits"] += 1
+                lock.acquire()
+            acquired.append(lock)
+        yield
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+def parse_reservation_fields(service_id, capacity_requested):
+    """Converte service_id e capacity_requested in interi positivi, o solleva ReservationError."""
+    try:
+        service_id = int(service_id)
+        capacity_requested = int(capacity_requested)
+    except (TypeError, ValueError):
+        raise ReservationError(400, "service_id e capacity_requested devono essere numeri interi")
+    if capacity_requested < 1:
+        raise ReservationError(400, "capacity_requested deve essere almeno 1")
+    return service_id, capacity_requested
+
+def load_service(c, service_id):
+    """Ritorna capacità e prezzo giornaliero del servizio, o solleva ReservationError (404)."""
+    c.execute("SELECT capacity, price FROM services WHERE id = ?", (service_id,))
+    service = c.fetchone()
+    if service is None:
+        raise ReservationError(404, "Servizio non trovato")
+    return service
+
+def check_capacity(c, service_id, start_date, end_date, capacity_requested, service_capacity):
+    """
+    Verifica giornaliera della disponibilità: in nessun giorno del periodo i posti
+    già prenotati più quelli richiesti possono superare la capacità del servizio.
+    Solleva ReservationError (400) se il servizio non è disponibile.
+    """
+    c.execute("""
+        SELECT MAX(booked) AS max_booked
+        FROM service_day_occupancy
+        WHERE service_id = ? AND day BETWEEN ? AND ?
+    """, (service_id, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
+    max_booked = c.fetchone()["max_booked"] or 0
+    if max_booked + capacity_requested > service_capacity:
+        raise ReservationError(400, "Disponibilita' del servizio insufficiente per il periodo selezionato")
+
+def total_price(daily_price, start_date, end_date, capacity_requested):
+    """Prezzo della prenotazione: prezzo giornaliero per giorni (estremi inclusi) per posti."""
+    return daily_price * ((end_date - start_date).days + 1) * capacity_requested
+
+def create_reservation(user_id, service_id, start_date, end_date, capacity_requested=1, status="pending"):
+    """
+    Crea una prenotazione: verifica del servizio, controllo della capacità, calcolo
+    del prezzo, inserimento e aggiornamento dell'indice di occupazione avvengono in
+    un'unica transazione BEGIN IMMEDIATE, quindi due richieste concorrenti non
+    possono superare insieme la capacità. Le date sono già validate
+    (validate_booking_data). Ritorna la prenotazione creata come dizionario.
+    """
+    service_id, capacity_requested = parse_reservation_fields(service_id, capacity_requested)
+    try:
+        with service_locks(service_id), get_connection() as conn:
             c = conn.cursor()
-            
-            c.execute("SELECT price FROM services WHERE id = ?", (service_id,))
-            service = c.fetchone()
-            if not service:
-                return None
-
-            daily_price = service["price"]
-            num_days = (end_date - start_date).days + 1
-            total_price = daily_price * num_days * capacity_requested
-            
-            
+            c.execute("BEGIN IMMEDIATE")
+            service = load_service(c, service_id)
+            check_capacity(c, service_id, start_date, end_date, capacity_requested, service["capacity"])
+            price = total_price(service["price"], start_date, end_date, capacity_requested)
             c.execute("""
                 INSERT INTO bookings (user_id, service_id, start_date, end_date, capacity_requested, status, total_price)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (user_id, service_id, start_date.strftime("%Y-%m-%d"),
-                end_date.strftime("%Y-%m-%d"), capacity_requested, status, total_price))
+                end_date.strftime("%Y-%m-%d"), capacity_requested, status, price))
+            booking_id = c.lastrowid
+            update_occupancy(c, service_id, start_date, end_date, capacity_requested)
             conn.commit()
-            return c.lastrowid
+    except ReservationError:
+        _count("rejected")
+        raise
     except sqlite3.IntegrityError:
-        return None
+        _count("rejected")
+        raise ReservationError(400, "Errore durante il salvataggio della prenotazione")
+
+    _count("created")
+    return {
+        "id": booking_id,
+        "user_id": user_id,
+        "service_id": service_id,
+        "start_date": start_date.strftime("%Y-%m-%d"),
+        "end_date": end_date.strftime("%Y-%m-%d"),
+        "capacity_requested": capacity_requested,
+        "status": status,
+        "total_price": price,
+    }
+
+def update_reservation(booking_id, data, authenticated_user):
+    """
+    Modifica una prenotazione con i campi presenti in data. Rilettura della
+    prenotazione, controllo dei permessi, validazione, verifica della capacità
+    (senza contare i posti della prenotazione stessa), prezzo e scrittura
+    avvengono in un'unica transazione BEGIN IMMEDIATE.
+    Ritorna la prenotazione aggiornata come dizionario.
+    """
+    user_id = authenticated_user["id"]
+    role = authenticated_user["role"]
+
+    while True:
+        # servizio attuale, necessario per scegliere i lock: la connessione viene
+        # rilasciata subito, perché i lock vanno sempre acquisiti prima del pool
+        with get_connection() as conn:
+            current = conn.execute("SELECT service_id FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+        if current is None:
+            raise ReservationError(404, "Prenotazione non trovata")
+        requested_service_id = data.get("service_id", current["service_id"])
+        try:
+            requested_service_id = int(requested_service_id)
+        except (TypeError, ValueError):
+            raise ReservationError(400, "service_id deve essere un numero intero")
+
+        try:
+            with service_locks(current["service_id"], requested_service_id), get_connection() as conn:
+                c = conn.cursor()
+                c.execute("BEGIN IMMEDIATE")
+                c.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,))
+                existing = c.fetchone()
+                if existing is None:
+                    raise ReservationError(404, "Prenotazione non trovata")
+                if existing["service_id"] != current["service_id"]:
+                    # spostata su un altro servizio nel frattempo: i lock acquisiti non
+                    # coprono più il servizio attuale, si riparte con quelli giusti
+                    conn.rollback()
+                    continue
+
+                # un admin può modificare tutte le prenotazioni, un utente solo le sue
+                if existing["user_id"] != user_id and role != "admin":
+                    raise ReservationError(403, "Accesso negato alla prenotazione")
+
+                validation_result = validate_booking_data({
+                    "service_id": requested_service_id,
+                    "start_date": data.get("start_date", existing["start_date"]),
+                    "end_date": data.get("end_date", existing["end_date"]),
+                })
+                if validation_result.get("error"):
+                    raise ReservationError(400, validation_result["error"])
+                start_date = validation_result["start_date"]
+                end_date = validation_result["end_date"]
+                service_id, capacity_requested = parse_reservation_fields(
+                    requested_service_id, data.get("capacity_requested", existing["capacity_requested"]))
+                status = "pending" if role == "user" else data.get("status", existing["status"])
+
+                service = load_service(c, service_id)
+                # libera i posti attuali prima del controllo: in caso di errore il
+                # rollback della transazione (all'uscita dal blocco) li ripristina
+                update_occupancy(c, existing["service_id"], existing["start_date"],
+                    existing["end_date"], -existing["capacity_requested"])
+                check_capacity(c, service_id, start_date, end_date, capacity_requested, service["capacity"])
+                update_occupancy(c, service_id, start_date, end_date, capacity_requested)
+                price = total_price(service["price"], start_date, end_date, capacity_requested)
+                c.execute("""
+                    UPDATE bookings
+                    SET service_id = ?, start_date = ?, end_date = ?, capacity_requested = ?, status = ?, total_price = ?
+                    WHERE id = ?
+                """, (service_id, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+                    capacity_requested, status, price, booking_id))
+                conn.commit()
+        except ReservationError:
+            _count("rejected")
+            raise
+        break
+
+    _count("updated")
+    return {
+        "id": booking_id,
+        "service_id": service_id,
+        "start_date": start_date.strftime("%Y-%m-%d"),
+        "end_date": end_date.strftime("%Y-%m-%d"),
+        "capacity_requested": capacity_requested,
+        "status": status,
+        "total_price": price,
+    }
+
+def delete_reservation(booking_id, authenticated_user):
+    """
+    Elimina una prenotazione e libera i giorni occupati. Rilettura della
+    prenotazione, controllo dei permessi, eliminazione e aggiornamento dell'indice
+    di occupazione avvengono in un'unica transazione BEGIN IMMEDIATE: due
+    eliminazioni concorrenti della stessa prenotazione liberano i posti una volta sola.
+    """
+    while True:
+        # servizio della prenotazione, necessario per scegliere il lock prima del pool
+        with get_connection() as conn:
+            current = conn.execute("SELECT service_id FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+        if current is None:
+            raise ReservationError(404, "Prenotazione non trovata")
+
+        with service_locks(current["service_id"]), get_connection() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                SELECT user_id, service_id, start_date, end_date, capacity_requested
+                FROM bookings
+                WHERE id = ?
+            """, (booking_id,))
+            booking = c.fetchone()
+            if booking is None:
+                raise ReservationError(404, "Prenotazione non trovata")
+            if booking["service_id"] != current["service_id"]:
+                # spostata su un altro servizio nel frattempo: si riparte con il lock giusto
+                conn.rollback()
+                continue
+            if booking["user_id"] != authenticated_user["id"] and authenticated_user["role"] != "admin":
+                raise ReservationError(403, "Accesso negato alla prenotazione")
+
+            c.execute("DELETE FROM bookings WHERE id = ?", (booking_id,))
+            if c.rowcount != 1:
+                raise ReservationError(404, "Prenotazione non trovata")
+            update_occupancy(c, booking["service_id"], booking["start_date"],
+                booking["end_date"], -booking["capacity_requested"])
+            conn.commit()
+        break
+
+    _count("deleted")
+
+def create_reservations(items, authenticated_user, atomic=True):
+    """
+    Crea un lotto di prenotazioni in un'unica transazione BEGIN IMMEDIATE.
+    Ogni elemento viene validato come in POST /bookings; la capacità viene verificata
+    giorno per giorno contando anche le prenotazioni del lotto già accettate, quindi
+    due elementi sovrapposti non possono superare insieme la capacità.
+    Con atomic=True basta un elemento rifiutato per annullare l'intero lotto,
+    altrimenti vengono inserite solo le prenotazioni valide.
+    Ritorna la lista dei risultati, uno per elemento e nello stesso ordine:
+    {"index", "status": 201, "booking"} oppure {"index", "status", "error"}.
+    """
+    results = [None] * len(items)
+    accepted = []
+    for index, data in enumerate(items):
+        if not isinstance(data, dict):
+            results[index] = {"index": index, "status": 400, "error": "Prenotazione non valida"}
+            continue
+        validation_result = validate_booking_data(data)
+        if validation_result.get("error"):
+            results[index] = {"index": index, "status": 400, "error": validation_result["error"]}
+            continue
+        try:
+            service_id, capacity_requested = parse_reservation_fields(
+                data["service_id"], data.get("capacity_requested", 1))
+            user_id = int(data["user_id"]) if data.get("user_id") else authenticated_user["id"]
+        except (TypeError, ValueError):
+            results[index] = {"index": index, "status": 400, "error": "user_id deve essere un numero intero"}
+            continue
+        except ReservationError as e:
+            results[index] = {"index": index, "status": e.code, "error": e.message}
+            continue
+        accepted.append({
+            "index": index,
+            "user_id": user_id,
+            "service_id": service_id,
+            "start_date": validation_result["start_date"],
+            "end_date": validation_result["end_date"],
+            "capacity_requested": capacity_requested,
+            "status": data.get("status", "pending"),
+        })
+
+    service_ids = sorted({item["service_id"] for item in accepted})
+    created = []
+    with service_locks(*service_ids), get_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        services = {}
+        if service_ids:
+            placeholders = ", ".join("?" * len(service_ids))
+            c.execute(f"SELECT id, capacity, price FROM services WHERE id IN ({placeholders})", service_ids)
+            services = {row["id"]: row for row in c.fetchall()}
+        user_ids = sorted({item["user_id"] for item in accepted})
+        known_users = set()
+        if user_ids:
+            placeholders = ", ".join("?" * len(user_ids))
+            c.execute(f"SELECT id FROM users WHERE id IN ({placeholders})", user_ids)
+            known_users = {row["id"] for row in c.fetchall()}
+
+        # occupazione attuale dei giorni coinvolti, una query per servizio
+        occupancy = {}
+        for service_id in services:
+            items_for_service = [item for item in accepted if item["service_id"] == service_id]
+            c.execute("""
+                SELECT day, booked FROM service_day_occupancy
+                WHERE service_id = ? AND day BETWEEN ? AND ?
+            """, (service_id,
+                min(item["start_date"] for item in items_for_service).isoformat(),
+                max(item["end_date"] for item in items_for_service).isoformat()))
+            occupancy.update(((service_id, row["day"]), row["booked"]) for row in c.fetchall())
+
+        for item in accepted:
+            service = services.get(item["service_id"])
+            if item["user_id"] not in known_users:
+                results[item["index"]] = {"index": item["index"], "status": 400, "error": "Utente non trovato"}
+                continue
+            if service is None:
+                results[item["index"]] = {"index": item["index"], "status": 404, "error": "Servizio non trovato"}
+                continue
+            keys = [(item["service_id"], day) for day in booking_days(item["start_date"], item["end_date"])]
+            if max(occupancy.get(key, 0) for key in keys) + item["capacity_requested"] > service["capacity"]:
+                results[item["index"]] = {"index": item["index"], "status": 400,
+                    "error": "Disponibilita' del servizio insufficiente per il periodo selezionato"}
+                continue
+            # i posti accettati contano per gli elementi successivi del lotto
+            for key in keys:
+                occupancy[key] = occupancy.get(key, 0) + item["capacity_requested"]
+            item["keys"] = keys
+            item["total_price"] = total_price(
+                service["price"], item["start_date"], item["end_date"], item["capacity_requested"])
+            created.append(item)
+
+        rejected = len(items) - len(created)
+        if atomic and rejected:
+            conn.rollback()
+            created = []
+        elif created:
+            # un inserimento per riga: l'id di ogni prenotazione è il suo lastrowid
+            for item in created:
+                c.execute("""
+                    INSERT INTO bookings (user_id, service_id, start_date, end_date, capacity_requested, status, total_price)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (item["user_id"], item["service_id"], item["start_date"].isoformat(),
+                    item["end_date"].isoformat(), item["capacity_requested"], item["status"], item["total_price"]))
+                item["id"] = c.lastrowid
+            deltas = {}
+            for item in created:
+                for key in item["keys"]:
+                    deltas[key] = deltas.get(key, 0) + item["capacity_requested"]
+            add_occupancy(c, [(service_id, day, delta) for (service_id, day), delta in deltas.items()])
+            conn.commit()
+
+    for item in accepted:
+        if results[item["index"]] is None:
+            if atomic and rejected:
+                results[item["index"]] = {"index": item["index"], "status": 409,
+                    "error": "Lotto annullato: altre prenotazioni non sono valide"}
+                continue
+            results[item["index"]] = {"index": item["index"], "status": 201, "booking": {
+                "id": item["id"],
+                "user_id": item["user_id"],
+                "service_id": item["service_id"],
+                "start_date": item["start_date"].isoformat(),
+                "end_date": item["end_date"].isoformat(),
+                "capacity_requested": item["capacity_requested"],
+                "status": item["status"],
+                "total_price": item["total_price"],
+            }}
+
+    _count("batches")
+    _count("created", len(created))
+    _count("rejected", len(items) - len(created))
+    return results
+
+def service_calendar(service_id, start_date, end_date):
+    """
+    Ritorna i posti prenotati e disponibili giorno per giorno del servizio nel
+    periodo indicato (estremi inclusi), o None se il servizio non esiste.
+    L'indice service_day_occupancy contiene già i posti prenotati per giorno,
+    quindi basta una sola lettura per intervallo invece di una verifica per giorno.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT capacity, active FROM services WHERE id = ?", (service_id,))
+        service = c.fetchone()
+        if service is None:
+            return None
+        c.execute("""
+            SELECT day, booked FROM service_day_occupancy
+            WHERE service_id = ? AND day BETWEEN ? AND ?
+        """, (service_id, start_date.isoformat(), end_date.isoformat()))
+        booked_by_day = dict(c.fetchall())
+
+    capacity = service["capacity"]
+    days = []
+    for day in booking_days(start_date, end_date):
+        booked = booked_by_day.get(day, 0)
+        days.append({"date": day, "booked": booked, "available": max(capacity - booked, 0)})
+    return {
+        "service_id": service_id,
+        "capacity": capacity,
+        "active": bool(service["active"]),
+        "from": start_date.isoformat(),
+        "to": end_date.isoformat(),
+        "min_available": min(day["available"] for day in days),
+        "days": days,
+    }
+
+def available_services(start_date, end_date, capacity_requested):
+    """
+    Ritorna i servizi attivi con almeno capacity_requested posti liberi in ogni
+    giorno del periodo, con il prezzo totale per il periodo e i posti richiesti.
+    Una sola query valuta tutti i servizi: il massimo dei posti prenotati nel
+    periodo viene letto dall'indice service_day_occupancy per ogni servizio.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT s.id, s.name, s.description, s.capacity, s.price,
+                s.capacity - COALESCE(MAX(o.booked), 0) AS available
+            FROM services s
+            LEFT JOIN service_day_occupancy o
+                ON o.service_id = s.id AND o.day BETWEEN ? AND ?
+            WHERE s.active = 1
+            GROUP BY s.id
+            HAVING available >= ?
+            ORDER BY s.price, s.id
+        """, (start_date.isoformat(), end_date.isoformat(), capacity_requested))
+        rows = c.fetchall()
+
+    return [{
+        "id": row["id"],
+        "name": row["name"],
+        "description": row["description"],
+        "capacity": row["capacity"],
+        "available": row["available"],
+        "price": row["price"],
+        "total_price": total_price(row["price"], start_date, end_date, capacity_requested),
+    } for row in rows]
+
+def reservation_stats():
+    """Ritorna i contatori del motore di prenotazione."""
+    with _stats_lock:
+        return dict(_stats)
+
+register_metrics("reservations", reservation_stats)
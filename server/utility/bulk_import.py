@@ -0,0 +1,367 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from db import get_connection
+from utility.booking_utility import add_occupancy, booking_days
+from utility.logger import get_logger
+from utility.metrics import register_metrics
+from utility.passwords import hash_passwords
+
+# righe inserite per ogni transazione (una executemany per blocco)
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "1000"))
+# righe rifiutate riportate nel dettaglio del risultato (le altre sono solo contate)
+IMPORT_MAX_REPORTED_ERRORS = int(os.environ.get("IMPORT_MAX_REPORTED_ERRORS", "100"))
+
+IMPORT_FORMATS = ("ndjson", "csv")
+
+logger = get_logger("import")
+
+_stats_lock = threading.Lock()
+_stats = {"imports": 0, "inserted": 0, "rejected": 0}
+
+
+class ImportRowError(ValueError):
+    """Riga non valida: viene scartata e riportata nel risultato dell'import."""
+
+
+class BoundedStream(io.RawIOBase):
+    """Espone al più length byte di uno stream (es. il corpo di una richiesta HTTP)."""
+
+    def __init__(self, raw, length):
+        self._raw = raw
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._remaining <= 0:
+            return 0
+        data = self._raw.read(min(len(buffer), self._remaining))
+        self._remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _decoded_lines(stream):
+    """
+    Decodifica le righe dello stream una alla volta. I byte non UTF-8 vengono
+    conservati come surrogati (surrogateescape) così la riga può essere rifiutata
+    singolarmente invece di interrompere l'import (vedi _is_utf8).
+    """
+    if isinstance(stream, io.RawIOBase):
+        stream = io.BufferedReader(stream)
+    for index, line in enumerate(stream):
+        text = line.decode("utf-8", "surrogateescape")
+        yield text.removeprefix("\ufeff") if index == 0 else text
+
+def _is_utf8(text):
+    try:
+        text.encode("utf-8")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+def iter_records(stream, format):
+    """
+    Legge i record da uno stream binario senza caricarlo in memoria.
+    Ritorna coppie (numero di riga, dizionario); le righe non valide (JSON o
+    codifica diversa da UTF-8) producono un ImportRowError al posto del dizionario.
+    """
+    lines = _decoded_lines(stream)
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            if not all(_is_utf8(text) for text in (*record, *record.values()) if isinstance(text, str)):
+                yield reader.line_num, ImportRowError("Codifica non valida: il file deve essere in UTF-8")
+                continue
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        if not _is_utf8(line):
+            yield line_number, ImportRowError("Codifica non valida: il file deve essere in UTF-8")
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield line_number, ImportRowError("JSON non valido")
+            continue
+        if not isinstance(record, dict):
+            record = ImportRowError("La riga deve contenere un oggetto JSON")
+        yield line_number, record
+
+
+# --- conversione dei campi ---
+
+def _text(record, field, required=False):
+    value = record.get(field)
+    value = value.strip() if isinstance(value, str) else value
+    if value in (None, ""):
+        if required:
+            raise ImportRowError(f"Campo obbligatorio mancante: {field}")
+        return None
+    return str(value)
+
+def _number(record, field, convert, default=None, minimum=None):
+    value = record.get(field)
+    if value in (None, ""):
+        if default is None:
+            raise ImportRowError(f"Campo obbligatorio mancante: {field}")
+        return default
+    try:
+        value = convert(value)
+    except (TypeError, ValueError):
+        raise ImportRowError(f"Valore non valido per {field}: {value}")
+    if minimum is not None and value < minimum:
+        raise ImportRowError(f"{field} deve essere almeno {minimum}")
+    return value
+
+def _flag(record, field, default=1):
+    value = record.get(field)
+    if value in (None, ""):
+        return default
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ("1", "true", "si", "yes"):
+            return 1
+        if value in ("0", "false", "no"):
+            return 0
+        raise ImportRowError(f"Valore non valido per {field}: {value}")
+    return 1 if value else 0
+
+def _date(record, field):
+    value = _text(record, field, required=True)
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise ImportRowError(f"Formato data non valido per {field}. Utilizzare YYYY-MM-DD")
+
+
+# --- tabelle importabili ---
+
+class TableImporter:
+    """
+    Conversione e inserimento delle righe di una tabella. Le sottoclassi
+    definiscono table, sql e prepare(record), che converte un record nella tupla
+    di valori di sql o solleva ImportRowError.
+    """
+    table = None
+    sql = None
+
+    def prepare_batch(self, rows):
+        """Elaborazione del blocco prima dell'inserimento (fuori dalla transazione)."""
+
+    def finish_batch(self, c, rows):
+        """Operazioni aggiuntive sulle righe inserite, nella stessa transazione."""
+
+
+class ServiceImporter(TableImporter):
+    table = "services"
+    sql = """
+        INSERT INTO services (name, description, capacity, price, active)
+        VALUES (?, ?, ?, ?, ?)
+    """
+
+    def prepare(self, record):
+        return (
+            _text(record, "name", required=True),
+            _text(record, "description") or "",
+            _number(record, "capacity", int, minimum=0),
+            _number(record, "price", float, minimum=0),
+            _flag(record, "active"),
+        )
+
+
+class _PlainPassword(str):
+    """Password in chiaro in attesa di hashing."""
+
+
+class UserImporter(TableImporter):
+    """
+    Utenti: la colonna password contiene la password in chiaro (l'hash viene
+    calcolato per blocco dai worker dedicati), password_hash un hash bcrypt già calcolato.
+    """
+    table = "users"
+    sql = """
+        INSERT INTO users (username, password, email, role)
+        VALUES (?, ?, ?, ?)
+    """
+
+    def prepare(self, record):
+        username = _text(record, "username", required=True)
+        email = _text(record, "email", required=True)
+        if "@" not in email or "." not in email or email.index("@") > email.rindex("."):
+            raise ImportRowError("Email non valida")
+        role = _text(record, "role") or "user"
+        if role not in ("user", "admin"):
+            raise ImportRowError(f"Ruolo non valido: {role}")
+        password_hash = _text(record, "password_hash")
+        if password_hash is not None:
+            if not password_hash.startswith("$2"):
+                raise ImportRowError("password_hash deve essere un hash bcrypt")
+            return (username, password_hash, email, role)
+        # la password in chiaro viene sostituita dall'hash in prepare_batch
+        return (username, _PlainPassword(_text(record, "password", required=True)), email, role)
+
+    def prepare_batch(self, rows):
+        """Sostituisce le password in chiaro del blocco con gli hash bcrypt (worker dedicati agli import)."""
+        pending = [index for index, row in enumerate(rows) if isinstance(row[1][1], _PlainPassword)]
+        hashes = hash_passwords([rows[index][1][1] for index in pending])
+        for index, hashed in zip(pending, hashes):
+            line_number, row = rows[index]
+            rows[index] = (line_number, (row[0], hashed, row[2], row[3]))
+
+
+class BookingImporter(TableImporter):
+    """
+    Prenotazioni storiche: le date possono essere passate e la capacità non viene
+    verificata; l'indice di occupazione viene aggiornato nella stessa transazione.
+    Se total_price manca viene calcolato dal prezzo del servizio.
+    """
+    table = "bookings"
+    sql = """
+        INSERT INTO bookings (user_id, service_id, start_date, end_date, status, capacity_requested, total_price)
+        VALUES (?, ?, ?, ?, ?, ?,
+            COALESCE(?, (SELECT price FROM services WHERE id = ?) * (julianday(?) - julianday(?) + 1) * ?))
+    """
+
+    def prepare(self, record):
+        user_id = _number(record, "user_id", int)
+        service_id = _number(record, "service_id", int)
+        start_date = _date(record, "start_date")
+        end_date = _date(record, "end_date")
+        if start_date > end_date:
+            raise ImportRowError("La data di inizio deve essere precedente alla data di fine")
+        status = _text(record, "status") or "pending"
+        capacity_requested = _number(record, "capacity_requested", int, default=1, minimum=1)
+        price = record.get("total_price")
+        total_price = None if price in (None, "") else _number(record, "total_price", float, minimum=0)
+        start, end = start_date.isoformat(), end_date.isoformat()
+        return (user_id, service_id, start, end, status, capacity_requested,
+            total_price, service_id, end, start, capacity_requested)
+
+    def finish_batch(self, c, rows):
+        deltas = {}
+        for row in rows:
+            service_id, start, end, capacity_requested = row[1], row[2], row[3], row[5]
+            for day in booking_days(start, end):
+                deltas[(service_id, day)] = deltas.get((service_id, day), 0) + capacity_requested
+        add_occupancy(c, [(service_id, day, delta) for (service_id, day), delta in deltas.items()])
+
+
+IMPORTERS = {
+    "services": ServiceImporter,
+    "users": UserImporter,
+    "bookings": BookingImporter,
+}
+
+
+class ImportReport:
+    """Avanzamento e risultato di un import."""
+
+    def __init__(self, table):
+        self.table = table
+        self.processed = 0
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_number, message):
+        self.rejected += 1
+        if len(self.errors) < IMPORT_MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_number, "error": message})
+
+    def as_dict(self):
+        return {
+            "table": self.table,
+            "processed": self.processed,
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "errors": sorted(self.errors, key=lambda error: error["line"]),
+        }
+
+
+def _insert_batch(importer, rows, report):
+    """
+    Inserisce un blocco di righe (numero di riga, valori) in una transazione.
+    Se executemany viola un vincolo (es. username duplicato), il blocco viene
+    ripetuto riga per riga per scartare solo le righe non valide.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany(importer.sql, [values for _, values in rows])
+            inserted = rows
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            c.execute("BEGIN IMMEDIATE")
+            inserted = []
+            for line_number, values in rows:
+                try:
+                    c.execute(importer.sql, values)
+                    inserted.append((line_number, values))
+                except sqlite3.IntegrityError as e:
+                    report.reject(line_number, f"Violazione di vincolo: {e}")
+        importer.finish_batch(c, [values for _, values in inserted])
+        conn.commit()
+    report.inserted += len(inserted)
+
+def import_records(table, stream, format="ndjson", batch_size=None, progress=None):
+    """
+    Importa nella tabella indicata (services, users o bookings) i record letti
+    in streaming da stream (binario, NDJSON o CSV). Le righe vengono inserite a
+    blocchi di batch_size, ciascuno nella propria transazione: la memoria usata
+    dipende dal blocco e non dalla dimensione del file. Le righe non valide
+    vengono scartate e riportate. progress, se indicato, viene chiamata con il
+    report dopo ogni blocco. Ritorna l'ImportReport finale.
+    """
+    if table not in IMPORTERS:
+        raise ValueError(f"Tabella non importabile: {table}")
+    if format not in IMPORT_FORMATS:
+        raise ValueError(f"Formato non supportato: {format}")
+    importer = IMPORTERS[table]()
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report = ImportReport(table)
+
+    def flush(rows):
+        importer.prepare_batch(rows)
+        _insert_batch(importer, rows, report)
+        if progress is not None:
+            progress(report)
+
+    rows = []
+    for line_number, record in iter_records(stream, format):
+        report.processed += 1
+        try:
+            if isinstance(record, ImportRowError):
+                raise record
+            rows.append((line_number, importer.prepare(record)))
+        except ImportRowError as e:
+            report.reject(line_number, str(e))
+            continue
+        if len(rows) >= batch_size:
+            flush(rows)
+            rows = []
+    if rows:
+        flush(rows)
+
+    with _stats_lock:
+        _stats["imports"] += 1
+        _stats["inserted"] += report.inserted
+        _stats["rejected"] += report.rejected
+    logger.info("Import %s completato", table, extra=report.as_dict() | {"errors": len(report.errors)})
+    return report
+
+def import_stats():
+    """Ritorna i totali degli import eseguiti."""
+    with _stats_lock:
+        return dict(_stats)
+
+register_metrics("import", import_stats)
@@ -0,0 +1,150 @@
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+from utility.metrics import register_metrics
+
+# livello minimo dei messaggi (DEBUG, INFO, WARNING, ERROR)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# formato delle righe: "json" (una riga JSON per messaggio) o "text"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# messaggi mantenuti in coda prima di essere scartati se il thread di scrittura è in ritardo
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# identificativo della richiesta in corso nel thread corrente
+_request_id = contextvars.ContextVar("request_id", default=None)
+# attributi standard di un LogRecord, esclusi dai campi extra delle righe JSON
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "request_id"}
+
+_listener = None
+_dropped = 0
+_dropped_lock = threading.Lock()
+
+
+def get_logger(name):
+    """Ritorna il logger del modulo indicato."""
+    return logging.getLogger(f"server.{name}")
+
+def start_request(headers=None):
+    """
+    Assegna l'identificativo di correlazione alla richiesta corrente: usa l'header
+    X-Request-ID del client se presente, altrimenti ne genera uno nuovo.
+    """
+    request_id = headers.get("X-Request-ID") if headers is not None else None
+    if not request_id or len(request_id) > 64:
+        request_id = uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    return request_id
+
+def current_request_id():
+    """Ritorna l'identificativo della richiesta in corso, o None."""
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Aggiunge l'identificativo della richiesta al record nel thread che lo produce."""
+
+    def filter(self, record):
+        record.request_id = _request_id.get() or "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formatta ogni record come una riga JSON, includendo i campi passati con extra=."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", "-") != "-":
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler che non blocca mai: con la coda piena il messaggio viene scartato."""
+
+    def prepare(self, record):
+        """
+        Risolve messaggio e traceback nel thread chiamante (gli argomenti potrebbero
+        cambiare prima della scrittura) senza formattare la riga, lasciata al formatter
+        del thread di scrittura.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _dropped_lock:
+                _dropped += 1
+
+
+def setup_logging(level=None):
+    """
+    Configura il logging del server: i messaggi vengono accodati dai thread delle
+    richieste e scritti su stdout da un thread in background.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger("server")
+    root.setLevel(level or LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+def shutdown_logging():
+    """Scrive i messaggi ancora in coda e ferma il thread di scrittura."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def logging_stats():
+    """Ritorna i messaggi in coda e quelli scartati."""
+    with _dropped_lock:
+        dropped = _dropped
+    return {
+        "queued": _listener.queue.qsize() if _listener is not None else 0,
+        "dropped": dropped,
+    }
+
+register_metrics("logging", logging_stats)
@@ -0,0 +1,16 @@
+import threading
+
+# funzioni che restituiscono un dizionario di metriche, indicizzate per nome
+_providers = {}
+_lock = threading.Lock()
+
+def register_metrics(name, provider):
+    """Registra una funzione che restituisce le metriche di un componente."""
+    with _lock:
+        _providers[name] = provider
+
+def collect_metrics():
+    """Raccoglie le metriche di tutti i componenti registrati."""
+    with _lock:
+        providers = list(_providers.items())
+    return {name: provider() for name, provider in providers}
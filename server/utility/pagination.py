@@ -0,0 +1,166 @@
+import base64
+import json
+import os
+from datetime import datetime, timedelta
+from db import get_connection
+
+# numero massimo di elementi restituibili in una singola pagina
+MAX_PAGE_LIMIT = int(os.environ.get("MAX_PAGE_LIMIT", "500"))
+# righe lette da ogni query delle liste complete inviate in streaming
+STREAM_FETCH_SIZE = int(os.environ.get("STREAM_FETCH_SIZE", "10000"))
+
+
+class QueryError(ValueError):
+    """Parametro di query non valido: il messaggio viene restituito al client con un 400."""
+
+
+def parse_limit(query, default=None):
+    """Legge il parametro limit (1..MAX_PAGE_LIMIT). Senza limit ritorna default."""
+    value = query.get("limit")
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise QueryError("Parametro limit non valido")
+    if limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise QueryError(f"Il parametro limit deve essere compreso tra 1 e {MAX_PAGE_LIMIT}")
+    return limit
+
+def parse_sort(query, allowed_fields, default="id"):
+    """
+    Legge il parametro sort (es. "start_date" o "-start_date" per l'ordine decrescente).
+    allowed_fields: dizionario campo -> colonna SQL.
+    Ritorna la tupla (campo, colonna, decrescente).
+    """
+    value = query.get("sort", default)
+    descending = value.startswith("-")
+    field = value.lstrip("-")
+    if field not in allowed_fields:
+        raise QueryError(f"Ordinamento non supportato: {field}. Valori ammessi: {', '.join(allowed_fields)}")
+    return field, allowed_fields[field], descending
+
+def parse_int(query, name):
+    """Legge un parametro intero opzionale."""
+    value = query.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryError(f"Parametro {name} non valido")
+
+def parse_date(query, name):
+    """Legge un parametro data opzionale in formato YYYY-MM-DD."""
+    value = query.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        raise QueryError(f"Parametro {name} non valido. Utilizzare YYYY-MM-DD")
+
+def parse_date_range(query, max_days, default_days=30):
+    """
+    Legge il periodo from-to (YYYY-MM-DD, estremi inclusi) come coppia di date.
+    Senza from il periodo inizia oggi, senza to dura default_days giorni;
+    il periodo non può superare max_days giorni.
+    """
+    date_from = parse_date(query, "from")
+    date_to = parse_date(query, "to")
+    start = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else datetime.now().date()
+    end = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else start + timedelta(days=default_days - 1)
+    if start > end:
+        raise QueryError("La data from deve essere precedente alla data to")
+    if (end - start).days + 1 > max_days:
+        raise QueryError(f"Il periodo richiesto non può superare {max_days} giorni")
+    return start, end
+
+def encode_cursor(sort_value, row_id):
+    """Codifica in un token opaco la posizione dell'ultimo elemento della pagina."""
+    raw = json.dumps([sort_value, row_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Decodifica il token prodotto da encode_cursor; ritorna (sort_value, id) o None."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        return sort_value, int(row_id)
+    except (ValueError, TypeError):
+        raise QueryError("Parametro cursor non valido")
+
+def keyset_condition(column, id_column, descending, cursor):
+    """
+    Ritorna la condizione SQL (e i parametri) che seleziona gli elementi successivi
+    al cursore, ordinando per (column, id_column).
+    """
+    sort_value, row_id = cursor
+    op = "<" if descending else ">"
+    if column == id_column:
+        return f"{id_column} {op} ?", [row_id]
+    return f"({column} {op} ? OR ({column} = ? AND {id_column} {op} ?))", [sort_value, sort_value, row_id]
+
+def keyset_batches(select, conditions, params, sort_column, id_column, descending, row_key,
+                   plain_rows=False, fetch_size=None):
+    """
+    Genera le righe di una lista completa a blocchi di fetch_size, con una query per
+    blocco che riparte dall'ultima riga letta (come la paginazione con cursore).
+    Ogni blocco usa una propria connessione, rilasciata prima di restituirlo: nessuna
+    connessione ne' transazione di lettura resta aperta mentre il client riceve la
+    risposta. Le righe inserite durante l'invio possono comparire nei blocchi successivi.
+    select, conditions, params: query senza WHERE, condizioni e relativi parametri.
+    row_key(row): ritorna (valore di ordinamento, id) della riga.
+    plain_rows: righe come tuple invece di sqlite3.Row (es. per l'export).
+    """
+    fetch_size = fetch_size or STREAM_FETCH_SIZE
+    order = order_clause(sort_column, id_column, descending)
+    cursor = None
+    while True:
+        page_conditions, page_params = list(conditions), list(params)
+        if cursor is not None:
+            condition, condition_params = keyset_condition(sort_column, id_column, descending, cursor)
+            page_conditions.append(condition)
+            page_params.extend(condition_params)
+        sql = select
+        if page_conditions:
+            sql += " WHERE " + " AND ".join(page_conditions)
+        sql += f" {order} LIMIT ?"
+        with get_connection() as conn:
+            c = conn.cursor()
+            if plain_rows:
+                c.row_factory = None
+            c.execute(sql, page_params + [fetch_size])
+            rows = c.fetchall()
+        if rows:
+            yield rows
+        if len(rows) < fetch_size:
+            return
+        cursor = row_key(rows[-1])
+
+def order_clause(column, id_column, descending):
+    """Clausola ORDER BY coerente con keyset_condition."""
+    direction = "DESC" if descending else "ASC"
+    if column == id_column:
+        return f"ORDER BY {id_column} {direction}"
+    return f"ORDER BY {column} {direction}, {id_column} {direction}"
+
+def split_page(rows, limit, sort_field):
+    """
+    Data una lista di limit + 1 righe, ritorna (righe della pagina, cursore successivo).
+    Il cursore è None se non ci sono altre pagine.
+    """
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[sort_field], last["id"])
+
+def pagination_headers(next_cursor):
+    """Header da aggiungere alla risposta per comunicare il cursore della pagina successiva."""
+    headers = {"Access-Control-Expose-Headers": "X-Next-Cursor"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return headers
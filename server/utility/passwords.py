@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from utility.metrics import register_metrics
+
+# cost factor di bcrypt per i nuovi hash (ogni +1 raddoppia il tempo di calcolo)
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+# numero massimo di hash calcolati in parallelo: le altre richieste attendono in coda
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# hash calcolati in parallelo dalle operazioni massive (es. import di utenti)
+PASSWORD_BULK_WORKERS = int(os.environ.get("PASSWORD_BULK_WORKERS", str(max(1, os.cpu_count() or 1))))
+
+# bcrypt rilascia il GIL durante il calcolo: un pool di thread limitato basta
+# a sfruttare piu' core senza lasciare che una raffica di login li occupi tutti
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+# pool separato per le operazioni massive: login e registrazioni non restano
+# in coda dietro a migliaia di hash di un import
+_bulk_executor = ThreadPoolExecutor(max_workers=PASSWORD_BULK_WORKERS, thread_name_prefix="password-hash-bulk")
+_lock = threading.Lock()
+_queued = 0
+_active = 0
+_completed = 0
+_rehashed = 0
+_bulk_hashed = 0
+_total_wait = 0.0
+_total_hash_time = 0.0
+_max_hash_time = 0.0
+
+
+def _submit(operation, *args):
+    """Accoda operation nell'executor e ne registra attesa e durata nelle metriche."""
+    global _queued
+    submitted_at = time.monotonic()
+    with _lock:
+        _queued += 1
+
+    def task():
+        global _queued, _active, _completed, _total_wait, _total_hash_time, _max_hash_time
+        started_at = time.monotonic()
+        with _lock:
+            _queued -= 1
+            _active += 1
+        try:
+            return operation(*args)
+        finally:
+            hash_time = time.monotonic() - started_at
+            with _lock:
+                _active -= 1
+                _completed += 1
+                _total_wait += started_at - submitted_at
+                _total_hash_time += hash_time
+                _max_hash_time = max(_max_hash_time, hash_time)
+
+    return _executor.submit(task)
+
+def _run(operation, *args):
+    """Esegue operation nell'executor e ne attende il risultato."""
+    return _submit(operation, *args).result()
+
+def _hash(password):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
+
+def _check(password, hashed_password):
+    return bcrypt.checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+def hash_password(password):
+    """Calcola l'hash bcrypt della password con il cost factor configurato."""
+    return _run(_hash, password)
+
+def check_password(password, hashed_password):
+    """Verifica la password rispetto all'hash salvato. Ritorna True se corrisponde."""
+    return _run(_check, password, hashed_password)
+
+def hash_passwords(passwords):
+    """
+    Calcola gli hash di più password (es. import massivo) con i worker dedicati
+    alle operazioni massive, separati da quelli delle richieste. Ritorna gli hash
+    nello stesso ordine.
+    """
+    global _bulk_hashed
+    hashes = list(_bulk_executor.map(_hash, passwords))
+    with _lock:
+        _bulk_hashed += len(hashes)
+    return hashes
+
+def get_hash_rounds(hashed_password):
+    """Estrae il cost factor da un hash bcrypt ($2b$<rounds>$...); None se non riconosciuto."""
+    parts = hashed_password.split("$")
+    try:
+        return int(parts[2])
+    except (IndexError, ValueError):
+        return None
+
+def needs_rehash(hashed_password):
+    """True se l'hash e' stato calcolato con un cost factor diverso da quello configurato."""
+    return get_hash_rounds(hashed_password) != BCRYPT_ROUNDS
+
+def rehash_in_background(password, save):
+    """
+    Ricalcola l'hash con il cost factor attuale senza bloccare la richiesta.
+    save: funzione chiamata con il nuovo hash (es. per aggiornare il db).
+    """
+    def task():
+        global _rehashed
+        save(_hash(password))
+        with _lock:
+            _rehashed += 1
+    # passa da _submit come gli altri hash: attesa e durata compaiono nelle metriche
+    _submit(task)
+
+def password_hash_stats():
+    """Ritorna profondita' della coda e latenze degli hash."""
+    with _lock:
+        return {
+            "workers": PASSWORD_HASH_WORKERS,
+            "rounds": BCRYPT_ROUNDS,
+            "queued": _queued,
+            "active": _active,
+            "completed": _completed,
+            "rehashed": _rehashed,
+            "bulk_workers": PASSWORD_BULK_WORKERS,
+            "bulk_hashed": _bulk_hashed,
+            "avg_wait_ms": round(_total_wait / _completed * 1000, 2) if _completed else 0.0,
+            "avg_hash_ms": round(_total_hash_time / _completed * 1000, 2) if _completed else 0.0,
+            "max_hash_ms": round(_max_hash_time * 1000, 2),
+        }
+
+register_metrics("password_hash", password_hash_stats)
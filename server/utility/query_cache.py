@@ -0,0 +1,175 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from utility.metrics import register_metrics
+
+# memoria massima (byte) delle risposte in cache; 0 disabilita la cache
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", "16777216"))
+# dimensione massima (byte) di una singola risposta in cache
+QUERY_CACHE_MAX_ENTRY_SIZE = int(os.environ.get("QUERY_CACHE_MAX_ENTRY_SIZE", "1048576"))
+# secondi massimi di validità di una voce (0 = nessuna scadenza): limita il tempo in
+# cui restano visibili le scritture di altri processi, che non invalidano la cache
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", "30"))
+
+# tabella di destinazione di INSERT / REPLACE / UPDATE / DELETE
+_WRITE_TARGET = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)",
+    re.IGNORECASE)
+# commenti SQL iniziali (-- fino a fine riga, /* ... */)
+_LEADING_COMMENTS = re.compile(r"^(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/)*", re.DOTALL)
+# istruzione principale di una query WITH che modifica dati
+_WRITE_KEYWORD = re.compile(r"\b(?:INSERT|REPLACE|UPDATE|DELETE)\b", re.IGNORECASE)
+# istruzioni che non modificano dati
+_READ_ONLY = ("SELECT", "PRAGMA", "EXPLAIN", "BEGIN", "COMMIT", "END", "ROLLBACK", "SAVEPOINT", "RELEASE", "VALUES")
+# tag che invalida tutte le voci (es. istruzioni DDL o non riconosciute)
+ALL_TABLES = "*"
+
+
+@lru_cache(maxsize=1024)
+def written_tables(sql):
+    """
+    Ritorna l'insieme delle tabelle modificate da un'istruzione SQL: vuoto per le
+    letture, {ALL_TABLES} per le istruzioni che non si possono attribuire a una tabella.
+    """
+    sql = _LEADING_COMMENTS.sub("", sql, count=1)
+    words = sql.split(None, 1)
+    if words and words[0].upper() == "WITH":
+        # WITH ... SELECT è una lettura; altrimenti conta l'istruzione dopo le CTE
+        keyword = _WRITE_KEYWORD.search(sql)
+        if keyword is None:
+            return frozenset()
+        sql = sql[keyword.start():]
+    match = _WRITE_TARGET.match(sql)
+    if match:
+        return frozenset((match.group(1).lower(),))
+    if not words or words[0].upper() in _READ_ONLY:
+        return frozenset()
+    return frozenset((ALL_TABLES,))
+
+
+class QueryCache:
+    """
+    Cache LRU delle risposte serializzate di query in sola lettura.
+    Ogni voce è associata alle tabelle lette dalla query e viene eliminata al
+    commit di una scrittura su una di esse. La memoria occupata è limitata a
+    max_bytes: oltre il limite vengono eliminate le voci usate meno di recente.
+    Le invalidazioni riguardano solo le scritture di questo processo: con più
+    processi o nodi sullo stesso database le voci restano valide al più ttl secondi.
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, max_entry_size=QUERY_CACHE_MAX_ENTRY_SIZE,
+                 ttl=QUERY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_entry_size = min(max_entry_size, max_bytes)
+        self.ttl = ttl
+        # chiave -> (risposta, tabelle, dimensione, scadenza)
+        self._entries = OrderedDict()
+        # tabella -> chiavi delle voci che la leggono
+        self._keys_by_table = {}
+        # tabella -> numero di invalidazioni: una risposta calcolata prima di
+        # un'invalidazione non deve essere inserita dopo di essa
+        self._generations = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0, "skipped": 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def generation(self, tables):
+        """Ritorna le generazioni correnti delle tabelle, da leggere prima della query."""
+        with self._lock:
+            return tuple(self._generations.get(table, 0) for table in (*tables, ALL_TABLES))
+
+    def get(self, key):
+        """Ritorna la risposta in cache per la chiave, o None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] is not None and entry[3] <= time.monotonic():
+                self._remove(key)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, response, tables, generation):
+        """
+        Inserisce una risposta (corpo in byte e header) associata alle tabelle lette.
+        generation: valore di generation(tables) letto prima della query.
+        """
+        body, headers = response
+        size = len(key[0]) + len(body) + sum(len(name) + len(value) for name, value in headers.items())
+        with self._lock:
+            if size > self.max_entry_size or generation != tuple(
+                    self._generations.get(table, 0) for table in (*tables, ALL_TABLES)):
+                self._stats["skipped"] += 1
+                return
+            self._remove(key)
+            expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+            self._entries[key] = (response, tables, size, expires_at)
+            self._size += size
+            for table in tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        """Elimina una voce e i relativi riferimenti (con _lock acquisito)."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, tables, size, _ = entry
+        self._size -= size
+        for table in tables:
+            keys = self._keys_by_table.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+    def invalidate(self, tables):
+        """Elimina le voci che leggono una delle tabelle (ALL_TABLES: tutte le voci)."""
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                keys = list(self._entries) if table == ALL_TABLES else list(self._keys_by_table.get(table, ()))
+                for key in keys:
+                    self._remove(key)
+            self._stats["invalidations"] += 1
+
+    def cached(self, sql, params, tables, build):
+        """
+        Read-through: ritorna la risposta (corpo, header) per la query dalla cache,
+        altrimenti la calcola con build() (che esegue la query e serializza il
+        risultato) e la inserisce. tables: tabelle lette dalla query.
+        """
+        if not self.enabled:
+            return build()
+        key = (sql, tuple(params))
+        response = self.get(key)
+        if response is not None:
+            return response
+        generation = self.generation(tables)
+        response = build()
+        self.put(key, response, tuple(tables), generation)
+        return response
+
+    def stats(self):
+        """Ritorna i contatori di utilizzo e la memoria occupata."""
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size, max_bytes=self.max_bytes,
+                ttl=self.ttl)
+
+
+query_cache = QueryCache()
+
+register_metrics("query_cache", query_cache.stats)
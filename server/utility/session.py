@@ -1,6 +1,12 @@
 import uuid
 from datetime import datetime, timedelta, timezone
 from db import get_connection
+from utility.session_cache import (
+    cache_generation,
+    cache_user,
+    get_cached_user,
+    invalidate_session,
+)
 
 def create_session(user_id, duration_minutes=60):
     """Crea una nuova sessione per l'utente e ritorna l'ID di sessione."""
@@ -32,38 +38,131 @@ def get_session_id(handler):
             return value
     return None
 
-def get_user_id_from_session(session_id):
-    """restituisce l'ID dell'utente associato alla sessione se la sessione è valida, altrimenti None."""
+def parse_session_expiry(expires_at):
+    """Converte il campo expires_at della tabella sessions in un datetime UTC."""
+    return datetime.fromisoformat(expires_at).replace(tzinfo=timezone.utc)
+
+def get_session_user(session_id):
+    """
+    Restituisce il dizionario dell'utente associato alla sessione se la sessione è valida,
+    altrimenti None. Usa la cache delle sessioni e, in caso di miss, una sola query
+    che unisce sessions e users.
+    """
+    user = get_cached_user(session_id)
+    if user is not None:
+        return user
+
+    generation = cache_generation()
     with get_connection() as conn:
         c = conn.cursor()
         c.execute("""
-            SELECT user_id, expires_at FROM sessions WHERE session_id = ?
+            SELECT u.id, u.username, u.email, u.role, s.expires_at
+            FROM sessions s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.session_id = ?
         """, (session_id,))
         row = c.fetchone()
-        if row:
-            expires_at = datetime.strptime(row["expires_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-            if datetime.now(timezone.utc) < expires_at:
-                return row["user_id"]
-            else:
-                # eliminare la sessione scaduta 
-                delete_session(session_id)
+    if not row:
         return None
 
+    expires_at = parse_session_expiry(row["expires_at"])
+    if datetime.now(timezone.utc) >= expires_at:
+        # eliminare la sessione scaduta
+        delete_session(session_id)
+        return None
+
+    user = {
+        "id": row["id"],
+        "username": row["username"],
+        "email": row["email"],
+        "role": row["role"]
+    }
+    cache_user(session_id, user, expires_at.timestamp(), generation)
+    return user
+
+def get_user_id_from_session(session_id):
+    """restituisce l'ID dell'utente associato alla sessione se la sessione è valida, altrimenti None."""
+    user = get_session_user(session_id)
+    return user["id"] if user else None
+
 def delete_session(session_id):
-    """Elimina la sessione dal database."""
+    """Elimina la sessione dal database e dalla cache."""
     with get_connection() as conn:
         c = conn.cursor()
         c.execute("""
             DELETE FROM sessions WHERE session_id = ?
         """, (session_id,))
         conn.commit()
+    invalidate_session(session_id)
 
-def clean_expired_sessions():
-    """Elimina tutte le sessioni scadute dal database."""
-    with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("""
-            DELETE FROM sessions WHERE expires_at < ?
-        """, (datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),))
-        conn.commit()
+def clean_expired_sessions(batch_size=None):
+    """
+    Elimina le sessioni scadute dal database e ritorna il numero di righe eliminate.
+    Con batch_size le righe vengono eliminate a blocchi, ciascuno nella propria
+    transazione, per non trattenere a lungo il lock di scrittura.
+    """
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    if not batch_size:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                DELETE FROM sessions WHERE expires_at < ?
+            """, (now,))
+            conn.commit()
+            return c.rowcount
+
+    deleted = 0
+    while True:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                DELETE FROM sessions WHERE rowid IN (
+                    SELECT rowid FROM sessions WHERE expires_at < ? LIMIT ?
+                )
+            """, (now, batch_size))
+            conn.commit()
+            count = c.rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+def trim_user_sessions(max_per_user, batch_size=500):
+    """
+    Mantiene al più max_per_user sessioni per utente eliminando le meno recenti.
+    Le sessioni da eliminare vengono scelte con una lettura fuori dalla transazione
+    di scrittura, poi eliminate per id a blocchi di batch_size, ciascuno in una
+    transazione breve. Ritorna il numero di sessioni eliminate.
+    """
+    # sessioni scelte per ogni lettura: la scansione non si ripete a ogni blocco
+    scan_size = batch_size * 20
+    deleted = 0
+    while True:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT session_id FROM (
+                    SELECT session_id, ROW_NUMBER() OVER (
+                        PARTITION BY user_id ORDER BY created_at DESC, rowid DESC
+                    ) AS position
+                    FROM sessions
+                )
+                WHERE position > ?
+                LIMIT ?
+            """, (max_per_user, scan_size))
+            excess = [row[0] for row in c.fetchall()]
+
+        for start in range(0, len(excess), batch_size):
+            session_ids = excess[start:start + batch_size]
+            with get_connection() as conn:
+                c = conn.cursor()
+                c.execute("BEGIN IMMEDIATE")
+                c.executemany("DELETE FROM sessions WHERE session_id = ?", [(session_id,) for session_id in session_ids])
+                conn.commit()
+            # le sessioni eliminate non sono scadute: vanno rimosse anche dalla cache
+            for session_id in session_ids:
+                invalidate_session(session_id)
+            deleted += len(session_ids)
 
+        if len(excess) < scan_size:
+            return deleted
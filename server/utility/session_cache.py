@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from repoze.lru import ExpiringLRUCache
+from utility.metrics import register_metrics
+
+# numero massimo di sessioni mantenute in memoria
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1024"))
+# secondi massimi di validita' di una voce in cache, indipendentemente dalla scadenza della sessione
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "60"))
+
+# session_id -> dizionario dell'utente autenticato
+_cache = ExpiringLRUCache(SESSION_CACHE_SIZE, default_timeout=SESSION_CACHE_TTL)
+# user_id -> insieme dei session_id in cache, per invalidare tutte le sessioni di un utente
+_sessions_by_user = {}
+_lock = threading.Lock()
+# incrementato a ogni invalidazione: un risultato letto dal db prima di
+# un'invalidazione non deve essere inserito in cache dopo di essa
+_generation = 0
+_invalidations = 0
+
+
+def cache_generation():
+    """Ritorna la generazione corrente della cache, da leggere prima della query al db."""
+    return _generation
+
+def get_cached_user(session_id):
+    """Ritorna una copia dell'utente associato alla sessione se presente in cache, altrimenti None."""
+    user = _cache.get(session_id)
+    return dict(user) if user is not None else None
+
+def cache_user(session_id, user, expires_at, generation):
+    """
+    Inserisce in cache l'utente associato alla sessione.
+    expires_at: timestamp (epoch) di scadenza della sessione.
+    generation: valore di cache_generation() letto prima della query al db.
+    """
+    timeout = min(SESSION_CACHE_TTL, expires_at - time.time())
+    if timeout <= 0:
+        return
+    with _lock:
+        if generation != _generation:
+            return
+        _cache.put(session_id, dict(user), timeout=timeout)
+        # le sessioni espulse dalla LRU non vengono notificate: l'indice viene
+        # ripulito qui, per l'utente corrente e periodicamente per tutti
+        sessions = _sessions_by_user.setdefault(user["id"], set())
+        sessions.difference_update([sid for sid in sessions if sid not in _cache.data])
+        sessions.add(session_id)
+        if len(_sessions_by_user) > 2 * SESSION_CACHE_SIZE:
+            _prune_index()
+
+def _prune_index():
+    """Rimuove dall'indice per utente le sessioni non più in cache (con _lock acquisito)."""
+    for user_id in list(_sessions_by_user):
+        sessions = _sessions_by_user[user_id]
+        sessions.difference_update([sid for sid in sessions if sid not in _cache.data])
+        if not sessions:
+            del _sessions_by_user[user_id]
+
+def invalidate_session(session_id):
+    """Rimuove una sessione dalla cache (logout o eliminazione della sessione)."""
+    global _generation, _invalidations
+    with _lock:
+        _generation += 1
+        _invalidations += 1
+        entry = _cache.data.get(session_id)
+        _cache.invalidate(session_id)
+        if entry is not None:
+            user = entry[1]
+            sessions = _sessions_by_user.get(user["id"])
+            if sessions:
+                sessions.discard(session_id)
+                if not sessions:
+                    del _sessions_by_user[user["id"]]
+
+def invalidate_user(user_id):
+    """Rimuove dalla cache tutte le sessioni di un utente (modifica, eliminazione o cambio ruolo)."""
+    global _generation, _invalidations
+    with _lock:
+        _generation += 1
+        _invalidations += 1
+        for session_id in _sessions_by_user.pop(user_id, ()):
+            _cache.invalidate(session_id)
+
+def clear_session_cache():
+    """Svuota completamente la cache delle sessioni."""
+    global _generation
+    with _lock:
+        _generation += 1
+        _cache.clear()
+        _sessions_by_user.clear()
+
+def session_cache_stats():
+    """Ritorna i contatori di utilizzo della cache delle sessioni."""
+    return {
+        "size": _cache.size,
+        "entries": len(_cache.data),
+        "lookups": _cache.lookups,
+        "hits": _cache.hits,
+        "misses": _cache.misses,
+        "evictions": _cache.evictions,
+        "invalidations": _invalidations,
+        "indexed_users": len(_sessions_by_user),
+    }
+
+register_metrics("session_cache", session_cache_stats)
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from utility.logger import get_logger
+from utility.metrics import register_metrics
+from utility.session import clean_expired_sessions, trim_user_sessions
+
+# secondi tra due pulizie della tabella sessions (0 disabilita il thread)
+SESSION_REAPER_INTERVAL = float(os.environ.get("SESSION_REAPER_INTERVAL", "60"))
+# sessioni eliminate per transazione
+SESSION_REAPER_BATCH_SIZE = int(os.environ.get("SESSION_REAPER_BATCH_SIZE", "500"))
+# sessioni mantenute per utente, le meno recenti vengono eliminate (0 = nessun limite)
+SESSION_MAX_PER_USER = int(os.environ.get("SESSION_MAX_PER_USER", "0"))
+
+logger = get_logger("session_reaper")
+
+
+class SessionReaper:
+    """
+    Thread in background che elimina periodicamente le sessioni scadute e,
+    se configurato, quelle in eccesso per utente. Le eliminazioni avvengono a
+    blocchi, quindi le richieste in scrittura attendono al più un blocco.
+    """
+
+    def __init__(self, interval=SESSION_REAPER_INTERVAL, batch_size=SESSION_REAPER_BATCH_SIZE,
+                 max_per_user=SESSION_MAX_PER_USER):
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.max_per_user = max_per_user
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "runs": 0,
+            "errors": 0,
+            "expired_purged": 0,
+            "capped_purged": 0,
+            "last_run_ms": 0.0,
+            "last_run_at": None,
+        }
+
+    def start(self):
+        """Avvia il thread; non fa nulla se l'intervallo è 0."""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="session-reaper", daemon=True)
+        self._thread.start()
+        logger.info("Pulizia delle sessioni ogni %s secondi", self.interval)
+
+    def stop(self, timeout=5):
+        """Ferma il thread attendendo la fine della pulizia in corso."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self):
+        # la prima pulizia avviene subito: all'avvio la tabella può contenere molte sessioni scadute
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                with self._lock:
+                    self._stats["errors"] += 1
+                logger.exception("Errore durante la pulizia delle sessioni")
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        """Esegue una pulizia completa e ritorna (sessioni scadute, sessioni in eccesso) eliminate."""
+        started_at = time.perf_counter()
+        expired = clean_expired_sessions(self.batch_size)
+        capped = trim_user_sessions(self.max_per_user, self.batch_size) if self.max_per_user > 0 else 0
+        elapsed = time.perf_counter() - started_at
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["expired_purged"] += expired
+            self._stats["capped_purged"] += capped
+            self._stats["last_run_ms"] = round(elapsed * 1000, 2)
+            self._stats["last_run_at"] = time.time()
+        if expired or capped:
+            logger.info("Sessioni eliminate: %s scadute, %s in eccesso", expired, capped,
+                extra={"duration_ms": round(elapsed * 1000, 2)})
+        return expired, capped
+
+    def stats(self):
+        """Ritorna i contatori delle pulizie eseguite."""
+        with self._lock:
+            return dict(self._stats, interval=self.interval, batch_size=self.batch_size,
+                max_per_user=self.max_per_user)
+
+
+session_reaper = SessionReaper()
+
+register_metrics("session_reaper", session_reaper.stats)
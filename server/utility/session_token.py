@@ -0,0 +1,165 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from utility.logger import get_logger
+from utility.metrics import register_metrics
+
+# "db": sessioni nella tabella sessions; "token": cookie firmato verificato senza accessi al db
+SESSION_MODE = os.environ.get("SESSION_MODE", "db")
+# chiavi HMAC nel formato "id:segreto" separate da virgole: la prima firma i nuovi
+# token, le successive sono accettate solo in verifica (rotazione delle chiavi)
+SESSION_TOKEN_KEYS = os.environ.get("SESSION_TOKEN_KEYS", "")
+
+SESSION_MODES = ("db", "token")
+
+logger = get_logger("session_token")
+
+
+def load_token_keys(value=SESSION_TOKEN_KEYS):
+    """
+    Ritorna la lista ordinata di coppie (id, chiave) da SESSION_TOKEN_KEYS.
+    Solleva ValueError per voci non valide o id duplicati.
+    """
+    keys = []
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        key_id, _, secret = entry.partition(":")
+        if not key_id.isalnum() or not secret:
+            raise ValueError(f"Chiave di sessione non valida: {key_id or entry}")
+        if any(key_id == existing for existing, _ in keys):
+            raise ValueError(f"Id di chiave duplicato: {key_id}")
+        keys.append((key_id, secret.encode("utf-8")))
+    return keys
+
+if SESSION_MODE not in SESSION_MODES:
+    raise ValueError(f"Modalità di sessione sconosciuta: {SESSION_MODE}")
+
+_keys = load_token_keys()
+# senza chiavi configurate ne viene generata una valida solo per questo processo
+_generated_key = not _keys
+if _generated_key:
+    _keys = [("local", secrets.token_bytes(32))]
+_keys_by_id = dict(_keys)
+
+# denylist in memoria: jti -> scadenza del token revocato
+_revoked_tokens = {}
+# user_id -> (istante della revoca, scadenza della voce): rifiuta i token emessi prima
+_revoked_users = {}
+_max_duration = 0
+_lock = threading.Lock()
+_stats = {"issued": 0, "verified": 0, "rejected": 0, "revoked": 0}
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(key, message):
+    return hmac.new(key, message.encode("ascii"), hashlib.sha256).digest()
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def issue_token(user_id, role, duration_minutes=60):
+    """Crea un token firmato con la chiave attiva per l'utente indicato."""
+    global _max_duration
+    now = time.time()
+    payload = {
+        "uid": user_id,
+        "role": role,
+        # al millisecondo (per difetto): un token emesso subito dopo revoke_user,
+        # nello stesso secondo, deve risultare successivo alla revoca
+        "iat": int(now * 1000) / 1000,
+        "exp": int(now) + duration_minutes * 60,
+        "jti": secrets.token_urlsafe(9),
+    }
+    key_id, key = _keys[0]
+    message = f"{key_id}.{_b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))}"
+    with _lock:
+        _stats["issued"] += 1
+        _max_duration = max(_max_duration, duration_minutes * 60)
+    return f"{message}.{_b64encode(_sign(key, message))}"
+
+def _decode(token):
+    """Ritorna il payload del token se la firma è valida, altrimenti None (scadenza non verificata)."""
+    try:
+        message, _, signature = token.rpartition(".")
+        key_id, _, encoded_payload = message.partition(".")
+        key = _keys_by_id.get(key_id)
+        if key is None or not hmac.compare_digest(_sign(key, message), _b64decode(signature)):
+            return None
+        payload = json.loads(_b64decode(encoded_payload))
+    except (ValueError, UnicodeError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+def verify_token(token):
+    """
+    Ritorna il dizionario dell'utente (id e ruolo) se il token è firmato con una
+    chiave nota, non è scaduto e non è stato revocato, altrimenti None.
+    """
+    payload = _decode(token)
+    now = time.time()
+    if payload is None or payload.get("exp", 0) <= now:
+        _count("rejected")
+        return None
+    with _lock:
+        revoked_user = _revoked_users.get(payload["uid"])
+        if payload["jti"] in _revoked_tokens or (revoked_user and payload["iat"] <= revoked_user[0]):
+            _stats["rejected"] += 1
+            return None
+        _stats["verified"] += 1
+    return {"id": payload["uid"], "role": payload["role"]}
+
+def _prune(now):
+    """Rimuove dalla denylist le voci relative a token ormai scaduti (con _lock acquisito)."""
+    for jti in [jti for jti, expires_at in _revoked_tokens.items() if expires_at <= now]:
+        del _revoked_tokens[jti]
+    for user_id in [user_id for user_id, (_, until) in _revoked_users.items() if until <= now]:
+        del _revoked_users[user_id]
+
+def revoke_token(token):
+    """Revoca un singolo token (logout) fino alla sua scadenza."""
+    payload = _decode(token)
+    now = time.time()
+    if payload is None or payload.get("exp", 0) <= now:
+        return
+    with _lock:
+        _prune(now)
+        _revoked_tokens[payload["jti"]] = payload["exp"]
+        _stats["revoked"] += 1
+
+def revoke_user(user_id):
+    """Revoca tutti i token emessi finora per l'utente (es. utente eliminato)."""
+    now = time.time()
+    with _lock:
+        _prune(now)
+        # i token emessi prima della revoca scadono al più entro la durata massima
+        _revoked_users[user_id] = (now, now + max(_max_duration, 3600))
+        _stats["revoked"] += 1
+
+def check_token_keys():
+    """Segnala all'avvio la modalità di sessione e l'assenza di chiavi configurate."""
+    if SESSION_MODE != "token":
+        return
+    if _generated_key:
+        logger.warning("SESSION_TOKEN_KEYS non impostata: chiave generata, "
+            "i token non sopravvivono al riavvio e non sono validi su altri nodi")
+    logger.info("Sessioni con token firmati, chiave attiva: %s", _keys[0][0],
+        extra={"keys": [key_id for key_id, _ in _keys]})
+
+def token_stats():
+    """Ritorna i contatori dei token e la dimensione della denylist."""
+    with _lock:
+        return dict(_stats, mode=SESSION_MODE, active_key=_keys[0][0],
+            denylist_tokens=len(_revoked_tokens), denylist_users=len(_revoked_users))
+
+register_metrics("session_tokens", token_stats)
@@ -0,0 +1,220 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    # dipendenza opzionale: se non installata vengono prodotte solo le varianti gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content-Type per estensione dei file statici
+CONTENT_TYPES = {
+    ".html": "text/html",
+    ".css": "text/css",
+    ".js": "application/javascript",
+    ".json": "application/json",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".ico": "image/x-icon",
+    ".svg": "image/svg+xml",
+}
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# secondi minimi tra due controlli dell'mtime dello stesso file
+STATIC_REFRESH_INTERVAL = float(os.environ.get("STATIC_REFRESH_INTERVAL", "1"))
+# dimensione minima (byte) perche' un file venga compresso
+STATIC_COMPRESSION_MIN_SIZE = int(os.environ.get("STATIC_COMPRESSION_MIN_SIZE", "256"))
+# Content-Type testuali per cui conviene produrre varianti compresse
+COMPRESSIBLE_TYPES = {"text/html", "text/css", "application/javascript", "application/json", "image/svg+xml"}
+# ordine di preferenza delle codifiche a parita' di q-value
+ENCODING_PREFERENCE = ("br", "gzip", "identity")
+# cartelle da non precaricare
+_SKIPPED_DIRECTORIES = {"node_modules", ".git"}
+
+
+def get_content_type(file_path):
+    """Restituisce il Content-Type in base all'estensione del file."""
+    return CONTENT_TYPES.get(os.path.splitext(file_path)[1].lower(), DEFAULT_CONTENT_TYPE)
+
+
+def parse_accept_encoding(header):
+    """Converte l'header Accept-Encoding in un dizionario codifica -> q-value."""
+    encodings = {}
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name] = q
+    return encodings
+
+def compress_variants(content):
+    """Produce le varianti compresse del contenuto, tenendo solo quelle piu' piccole dell'originale."""
+    variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content, quality=11)
+    return {encoding: data for encoding, data in variants.items() if len(data) < len(content)}
+
+
+class StaticAsset:
+    """File statico caricato in memoria con i relativi header di cache."""
+
+    def __init__(self, file_path, content, mtime):
+        self.file_path = file_path
+        self.content = content
+        self.mtime = mtime
+        self.size = len(content)
+        self.content_type = get_content_type(file_path)
+        self.etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.checked_at = time.monotonic()
+        self.headers = {
+            "ETag": self.etag,
+            "Last-Modified": self.last_modified,
+            # il browser puo' tenere il file ma deve rivalidarlo a ogni utilizzo
+            "Cache-Control": "no-cache",
+        }
+
+        # varianti precompresse: codifica -> (contenuto, header)
+        self.variants = {"identity": (content, self.headers)}
+        if self.content_type in COMPRESSIBLE_TYPES and self.size >= STATIC_COMPRESSION_MIN_SIZE:
+            for encoding, data in compress_variants(content).items():
+                self.variants[encoding] = (data, {
+                    **self.headers,
+                    # ogni rappresentazione ha un ETag forte distinto
+                    "ETag": f'{self.etag[:-1]}-{encoding}"',
+                    "Content-Encoding": encoding,
+                })
+        if len(self.variants) > 1:
+            for _, headers in self.variants.values():
+                headers["Vary"] = "Accept-Encoding"
+
+    def select_variant(self, accept_encoding):
+        """
+        Sceglie la variante migliore in base all'header Accept-Encoding.
+        Ritorna la tupla (contenuto, header); in mancanza di alternative
+        accettate dal client viene usata la variante non compressa.
+        """
+        if len(self.variants) == 1 or not accept_encoding:
+            return self.variants["identity"]
+        accepted = parse_accept_encoding(accept_encoding)
+        wildcard = accepted.get("*", 0.0)
+        best, best_q = "identity", -1.0
+        for encoding in ENCODING_PREFERENCE:
+            if encoding not in self.variants:
+                continue
+            q = accepted.get(encoding, 1.0 if encoding == "identity" else wildcard)
+            if q > best_q and q > 0:
+                best, best_q = encoding, q
+        return self.variants[best]
+
+    def is_not_modified(self, request_headers, etag=None):
+        """Verifica gli header If-None-Match / If-Modified-Since della richiesta."""
+        etag = etag or self.etag
+        if_none_match = request_headers.get("If-None-Match")
+        if if_none_match is not None:
+            # If-None-Match ha la precedenza su If-Modified-Since
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+        if_modified_since = request_headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(self.mtime) <= since
+        return False
+
+
+class AssetCache:
+    """
+    Cache in memoria dei file statici del frontend.
+    I file vengono caricati all'avvio e ricaricati quando cambia il loro mtime.
+    """
+
+    def __init__(self, base_path, refresh_interval=STATIC_REFRESH_INTERVAL):
+        self.base_path = os.path.realpath(base_path)
+        self.refresh_interval = refresh_interval
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Carica in memoria tutti i file statici con estensione conosciuta."""
+        for directory, subdirectories, files in os.walk(self.base_path):
+            subdirectories[:] = [d for d in subdirectories if d not in _SKIPPED_DIRECTORIES]
+            for file_name in files:
+                if os.path.splitext(file_name)[1].lower() in CONTENT_TYPES:
+                    self._load(os.path.join(directory, file_name))
+        return len(self._assets)
+
+    def _resolve(self, requested_path):
+        """Ritorna il percorso assoluto del file richiesto o None se esce dalla cartella base."""
+        file_path = os.path.realpath(os.path.join(self.base_path, requested_path))
+        if os.path.commonpath([self.base_path, file_path]) != self.base_path:
+            return None
+        return file_path
+
+    def _load(self, file_path):
+        """Legge il file dal disco e lo inserisce in cache."""
+        try:
+            stat = os.stat(file_path)
+            with open(file_path, "rb") as f:
+                content = f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            with self._lock:
+                self._assets.pop(file_path, None)
+            return None
+        asset = StaticAsset(file_path, content, stat.st_mtime)
+        with self._lock:
+            self._assets[file_path] = asset
+        return asset
+
+    def get(self, requested_path):
+        """Restituisce lo StaticAsset per il percorso richiesto (relativo alla cartella base) o None."""
+        file_path = self._resolve(requested_path)
+        if file_path is None:
+            return None
+
+        asset = self._assets.get(file_path)
+        if asset is None:
+            return self._load(file_path)
+
+        now = time.monotonic()
+        if now - asset.checked_at >= self.refresh_interval:
+            asset.checked_at = now
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                with self._lock:
+                    self._assets.pop(file_path, None)
+                return None
+            if stat.st_mtime != asset.mtime or stat.st_size != asset.size:
+                return self._load(file_path)
+        return asset
+
+    def stats(self):
+        """Ritorna il numero di file e i byte mantenuti in cache."""
+        with self._lock:
+            assets = list(self._assets.values())
+        return {
+            "files": len(assets),
+            "bytes": sum(asset.size for asset in assets),
+            "compressed_bytes": {
+                encoding: sum(len(asset.variants[encoding][0]) for asset in assets if encoding in asset.variants)
+                for encoding in ENCODING_PREFERENCE if encoding != "identity"
+            },
+        }
@@ -1,13 +1,59 @@
 import json
+import os
+import threading
+import zlib
 from urllib.parse import urlparse, parse_qs
+from utility.metrics import register_metrics
 from utility.session import get_session_id, get_user_id_from_session
+from utility.static_cache import parse_accept_encoding
 
-def set_headers(
-    handler, code=200,
-    response_data=b'',
-    content_type="application/json",
-    extra_headers=None, 
-    origin="http://localhost:8000"):
+# righe lette dal cursore e serializzate per ogni chunk delle risposte in streaming
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "500"))
+# compressione gzip delle risposte JSON per i client che la accettano ("0" per disattivarla)
+API_COMPRESSION = os.environ.get("API_COMPRESSION", "1") != "0"
+# dimensione minima (byte) di una risposta JSON da comprimere
+API_COMPRESSION_MIN_SIZE = int(os.environ.get("API_COMPRESSION_MIN_SIZE", "1024"))
+# livello di compressione gzip (1 = piu' veloce, 9 = piu' compatto)
+API_COMPRESSION_LEVEL = int(os.environ.get("API_COMPRESSION_LEVEL", "6"))
+# Content-Type delle risposte API che possono essere compresse
+COMPRESSIBLE_API_TYPES = {"application/json", "application/x-ndjson", "text/csv; charset=utf-8"}
+
+_compression_lock = threading.Lock()
+_compression_stats = {"responses": 0, "streams": 0, "bytes_in": 0, "bytes_out": 0}
+
+def _count_compression(bytes_in, bytes_out, streamed=False):
+    with _compression_lock:
+        _compression_stats["streams" if streamed else "responses"] += 1
+        _compression_stats["bytes_in"] += bytes_in
+        _compression_stats["bytes_out"] += bytes_out
+
+def compression_stats():
+    """Ritorna il numero di risposte compresse e il rapporto di compressione complessivo."""
+    with _compression_lock:
+        stats = dict(_compression_stats)
+    stats["ratio"] = round(stats["bytes_out"] / stats["bytes_in"], 3) if stats["bytes_in"] else None
+    return stats
+
+register_metrics("api_compression", compression_stats)
+
+def _accepts_gzip(handler):
+    """True se il client accetta risposte gzip (q-value maggiore di zero)."""
+    accepted = parse_accept_encoding(handler.headers.get("Accept-Encoding"))
+    return accepted.get("gzip", accepted.get("*", 0.0)) > 0
+
+def negotiate_compression(handler):
+    """
+    Sceglie la codifica della risposta in base all'header Accept-Encoding e la salva
+    in handler.response_encoding ("gzip" o None), letta da set_headers e set_stream_headers.
+    """
+    handler.response_encoding = "gzip" if API_COMPRESSION and _accepts_gzip(handler) else None
+    return handler.response_encoding
+
+def _gzip_compressor():
+    # wbits=31: formato gzip (header e checksum) invece di zlib
+    return zlib.compressobj(API_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+def _send_common_headers(handler, code, content_type, extra_headers, origin):
     handler.send_response(code)
     handler.send_header("Access-Control-Allow-Origin", origin)
     handler.send_header("Content-Type", content_type)
@@ -21,12 +67,154 @@ def set_headers(
     if extra_headers:
         for header, value in extra_headers.items():
             handler.send_header(header, value)
-    
+
+def set_headers(
+    handler, code=200,
+    response_data=b'',
+    content_type="application/json",
+    extra_headers=None, 
+    origin="http://localhost:8000"):
+    """
+    Invia status, header e corpo (response_data) della risposta.
+    Le risposte JSON di almeno API_COMPRESSION_MIN_SIZE byte vengono compresse
+    in gzip se negoziato da negotiate_compression (middleware delle rotte API).
+    """
+    if API_COMPRESSION and content_type in COMPRESSIBLE_API_TYPES:
+        extra_headers = {**(extra_headers or {}), "Vary": "Accept-Encoding"}
+        if len(response_data) >= API_COMPRESSION_MIN_SIZE and getattr(handler, "response_encoding", None) == "gzip":
+            compressor = _gzip_compressor()
+            compressed = compressor.compress(response_data) + compressor.flush()
+            _count_compression(len(response_data), len(compressed))
+            extra_headers["Content-Encoding"] = "gzip"
+            response_data = compressed
+
+    _send_common_headers(handler, code, content_type, extra_headers, origin)
     content_length = str(len(response_data))
     handler.send_header("Content-Length", content_length)
     handler.end_headers()
+    if response_data:
+        handler.wfile.write(response_data)
+
+def cache_validator_headers(etag):
+    """Header delle risposte con ETag: il client deve sempre rivalidare la copia in cache."""
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+def send_not_modified(handler, etag, origin="http://localhost:8000"):
+    """Risponde 304 senza corpo: la copia in cache del client e' ancora valida."""
+    handler.send_response(304)
+    handler.send_header("Access-Control-Allow-Origin", origin)
+    handler.send_header("Access-Control-Allow-Credentials", "true")
+    if API_COMPRESSION:
+        handler.send_header("Vary", "Accept-Encoding")
+    for header, value in cache_validator_headers(etag).items():
+        handler.send_header(header, value)
+    handler.end_headers()
+
+class ChunkedResponse:
+    """
+    Corpo di una risposta inviata in Transfer-Encoding: chunked, compresso in gzip
+    al volo se negoziato. Ogni write() produce subito un chunk (flush del compressore)
+    cosi' il client riceve i dati man mano che vengono prodotti.
+    """
+
+    def __init__(self, handler, compressor=None):
+        self.handler = handler
+        self.compressor = compressor
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _write_chunk(self, data):
+        if data:
+            self.bytes_out += len(data)
+            self.handler.wfile.write(b"%x\r\n%b\r\n" % (len(data), data))
+
+    def write(self, data):
+        """Scrive un blocco del corpo (i blocchi vuoti vengono ignorati)."""
+        if not data:
+            return
+        self.bytes_in += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._write_chunk(data)
+
+    def close(self):
+        """Chiude la risposta con il chunk finale vuoto."""
+        if self.compressor is not None:
+            self._write_chunk(self.compressor.flush())
+            _count_compression(self.bytes_in, self.bytes_out, streamed=True)
+        self.handler.wfile.write(b"0\r\n\r\n")
+
+def set_stream_headers(
+    handler, code=200,
+    content_type="application/json",
+    extra_headers=None,
+    origin="http://localhost:8000"):
+    """
+    Come set_headers, ma per una risposta inviata in Transfer-Encoding: chunked.
+    Ritorna il ChunkedResponse su cui scrivere il corpo.
+    """
+    compressor = None
+    if API_COMPRESSION and content_type in COMPRESSIBLE_API_TYPES:
+        extra_headers = {**(extra_headers or {}), "Vary": "Accept-Encoding"}
+        if getattr(handler, "response_encoding", None) == "gzip":
+            compressor = _gzip_compressor()
+            extra_headers["Content-Encoding"] = "gzip"
+    _send_common_headers(handler, code, content_type, extra_headers, origin)
+    handler.send_header("Transfer-Encoding", "chunked")
+    handler.end_headers()
+    return ChunkedResponse(handler, compressor)
+
+def _chunks(batches, batch_size):
+    """Suddivide i blocchi di righe in chunk di al più batch_size righe."""
+    for rows in batches:
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+def send_json_rows(handler, batches, serialize_row, code=200, extra_headers=None, batch_size=None):
+    """
+    Invia come lista JSON le righe prodotte a blocchi da batches (es.
+    pagination.keyset_batches), in streaming: ogni chunk contiene al più
+    batch_size righe serializzate, cosi' la memoria usata non dipende dal
+    numero di righe.
+    serialize_row: funzione che converte una riga in un oggetto serializzabile.
+    Con client HTTP/1.0 (che non supportano il chunked) la risposta viene bufferizzata.
+    """
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    if handler.request_version != "HTTP/1.1":
+        response_data = json.dumps([serialize_row(row) for rows in batches for row in rows]).encode("utf-8")
+        set_headers(handler, code, response_data, extra_headers=extra_headers)
+        return
+
+    response = set_stream_headers(handler, code, extra_headers=extra_headers)
+    prefix = "["
+    for rows in _chunks(batches, batch_size):
+        chunk = prefix + ", ".join(json.dumps(serialize_row(row)) for row in rows)
+        response.write(chunk.encode("utf-8"))
+        prefix = ", "
+    # se non ci sono righe il prefisso è ancora "[" e la risposta è "[]"
+    response.write(b"[]" if prefix == "[" else b"]")
+    response.close()
     
 
+def send_stream_rows(handler, batches, encode_rows, content_type, header=b"", code=200, extra_headers=None, batch_size=None):
+    """
+    Come send_json_rows, per formati a righe (CSV, NDJSON): encode_rows converte
+    un blocco di righe nei byte da inviare, header (es. l'intestazione CSV)
+    viene inviato prima delle righe.
+    """
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    if handler.request_version != "HTTP/1.1":
+        response_data = header + b"".join(encode_rows(rows) for rows in batches)
+        set_headers(handler, code, response_data, content_type, extra_headers=extra_headers)
+        return
+
+    response = set_stream_headers(handler, code, content_type, extra_headers=extra_headers)
+    response.write(header)
+    for rows in _chunks(batches, batch_size):
+        response.write(encode_rows(rows))
+    response.close()
+
+
 def parse_path(path):
     # separa il percorso principale dai parametri di query
     parsed_url = urlparse(path)
@@ -44,6 +232,24 @@ def parse_path(path):
 
 
 
+def parse_route_path(path):
+    """
+    Converte il percorso in un pattern confrontabile con il registro delle rotte:
+    i segmenti numerici diventano ":id" e vengono restituiti a parte.
+    Es. "/bookings/12?x=1" -> ("bookings/:id", ["12"]).
+    """
+    path_without_query = urlparse(path).path.strip("/")
+    segments = []
+    ids = []
+    for segment in path_without_query.split("/"):
+        if segment.isdigit():
+            segments.append(":id")
+            ids.append(segment)
+        else:
+            segments.append(segment)
+    return "/".join(segments), ids
+
+
 def parse_query(path):
     # analizza i parametri di query e restituisce un dizionario
     parsed_url = urlparse(path)
@@ -57,7 +263,6 @@ def verify_session(handler):
     if not session_id:
         error_response = json.dumps({"error": "Sessione non valida o non fornita"}).encode("utf-8")
         set_headers(handler, 401, error_response)
-        handler.wfile.write(error_response)
         return
 
     # verifica l'utente associato alla sessione
@@ -65,7 +270,6 @@ def verify_session(handler):
     if not user_id:
         error_response = json.dumps({"error": "Sessione scaduta o non valida"}).encode("utf-8")
         set_headers(handler, 401, error_response)
-        handler.wfile.write(error_response)
         return
 
 def extrapolate_user_id_from_session(handler):
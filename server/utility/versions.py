@@ -0,0 +1,71 @@
+import secrets
+import threading
+from utility.metrics import register_metrics
+
+# prefisso degli ETag, diverso a ogni avvio: i contatori in memoria ripartono da zero
+_epoch = secrets.token_hex(4)
+
+# tabella -> [scritture totali, modifiche/eliminazioni, modifiche di righe non identificate]
+_tables = {}
+# (tabella, id) -> modifiche/eliminazioni della riga
+_rows = {}
+_lock = threading.Lock()
+_stats = {"writes": 0, "conditional_requests": 0, "not_modified": 0}
+
+
+def record_write(table, row_id=None, created=False):
+    """
+    Registra una scrittura confermata (dopo il commit) su una tabella.
+    row_id: riga modificata o eliminata; None se le righe non sono note (es. cascade).
+    created: la scrittura ha solo inserito nuove righe.
+    """
+    with _lock:
+        counters = _tables.setdefault(table, [0, 0, 0])
+        counters[0] += 1
+        if not created:
+            counters[1] += 1
+            if row_id is None:
+                counters[2] += 1
+            else:
+                _rows[(table, row_id)] = _rows.get((table, row_id), 0) + 1
+        _stats["writes"] += 1
+
+def table_etag(table):
+    """ETag di una risorsa che dipende dall'intera tabella (es. una lista)."""
+    with _lock:
+        version = _tables.get(table, (0,))[0]
+    return f'W/"{_epoch}-{table}.{version}"'
+
+def row_etag(table, row_id, *depends_on):
+    """
+    ETag di una singola riga. depends_on: tabelle collegate (es. tramite join) le
+    cui modifiche ed eliminazioni cambiano la risorsa; gli inserimenti sono ignorati.
+    """
+    with _lock:
+        parts = [f"{table}{row_id}.{_rows.get((table, row_id), 0)}.{_tables.get(table, (0, 0, 0))[2]}"]
+        parts += [f"{name}.{_tables.get(name, (0, 0))[1]}" for name in depends_on]
+    return f'W/"{_epoch}-{"-".join(parts)}"'
+
+def is_not_modified(handler, etag, exists=False):
+    """
+    True se l'header If-None-Match della richiesta contiene l'ETag (confronto debole).
+    exists: la risorsa esiste di sicuro (es. una lista); solo in quel caso "*"
+    corrisponde, altrimenti una riga inesistente risponderebbe 304 invece di 404.
+    """
+    if_none_match = handler.headers.get("If-None-Match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    matched = (exists and "*" in tags) or etag.removeprefix("W/") in tags
+    with _lock:
+        _stats["conditional_requests"] += 1
+        _stats["not_modified"] += matched
+    return matched
+
+def version_stats():
+    """Ritorna i contatori delle scritture registrate e delle richieste condizionali."""
+    with _lock:
+        return dict(_stats, tables={table: counters[0] for table, counters in _tables.items()},
+            tracked_rows=len(_rows))
+
+register_metrics("versions", version_stats)